@@ -1,3 +1,5 @@
+import calendar
+import posixpath
 import uuid
 from datetime import datetime, timedelta
 from functools import partial
@@ -10,17 +12,25 @@ from cryptography.x509.oid import NameOID
 from josepy.jwa import RS256
 from josepy.jwk import JWKRSA
 
+import pem
+
 from treq.client import HTTPClient
 
-from twisted.internet.defer import succeed
+from twisted.internet.defer import gatherResults, succeed
+from twisted.logger import LogLevel, Logger
 from twisted.web.client import Agent
 
-from txacme.client import Client as txacme_Client, JWSClient
+from txacme.client import (
+    Client as txacme_Client, JSON_CONTENT_TYPE, JWSClient, ServerError)
 from txacme.interfaces import ICertificateStore
+from txacme.store import DirectoryStore
 from txacme.util import generate_private_key
 
 from zope.interface import implementer
 
+from marathon_acme.clients import UnknownCertificateError
+from marathon_acme.coalesce import Coalescer
+
 
 def _load_pem_private_key_bytes(key_bytes):
     return serialization.load_pem_private_key(
@@ -85,18 +95,77 @@ def maybe_key_vault(client, mount_path):
     return d.addCallback(get_or_create_key)
 
 
-def create_txacme_client_creator(key, reactor, url, alg=RS256):
+class PersistentJWSClient(JWSClient):
+    """
+    A ``txacme.client.JWSClient`` that can be used with a persistent
+    connection pool (https://github.com/mithrandi/txacme/issues/86).
+
+    Nonces wait on hand between requests over kept-alive connections, and the
+    ACME server may have expired them by the time they are used, rejecting
+    the request with a ``badNonce`` error. txacme only retries such a request
+    once, so POSTs that are still rejected with ``badNonce`` are retried a few
+    more times. The server doesn't act on a request with a bad nonce, so this
+    is safe. Requests that fail in any other way, including those whose
+    response is lost with the connection, are never retried as ACME POSTs
+    such as new-order and finalize aren't idempotent.
+    """
+
+    log = Logger()
+
+    def __init__(self, treq_client, key, alg, bad_nonce_retries=2, **kwargs):
+        """
+        :param bad_nonce_retries:
+            The number of times to make a POST again if it is still rejected
+            with a ``badNonce`` error after txacme's own retry.
+        """
+        super(PersistentJWSClient, self).__init__(
+            treq_client, key, alg, **kwargs)
+        self._bad_nonce_retries = bad_nonce_retries
+
+    def post(self, url, obj, content_type=JSON_CONTENT_TYPE, **kwargs):
+        return self._post_retrying(
+            url, obj, content_type, kwargs, self._bad_nonce_retries)
+
+    def _post_retrying(self, url, obj, content_type, kwargs, retries):
+        d = super(PersistentJWSClient, self).post(
+            url, obj, content_type, **kwargs)
+        if retries <= 0:
+            return d
+
+        def retry_bad_nonce(failure):
+            failure.trap(ServerError)
+            if not _is_bad_nonce(failure.value.message):
+                return failure
+
+            self.log.info(
+                'ACME server rejected the nonce for a request to {url}, '
+                'retrying', url=url)
+            return self._post_retrying(
+                url, obj, content_type, kwargs, retries - 1)
+
+        return d.addErrback(retry_bad_nonce)
+
+
+def _is_bad_nonce(acme_error):
+    # Ignore the namespace of the error type, which differs between versions
+    # of the ACME spec
+    return acme_error.typ.split(':')[-1] == 'badNonce'
+
+
+def create_txacme_client_creator(key, reactor, url, alg=RS256, pool=None):
     """
     Create a creator for txacme clients to provide to the txacme service. See
-    ``txacme.client.Client.from_url()``. We create the underlying JWSClient
-    with a non-persistent pool to avoid
-    https://github.com/mithrandi/txacme/issues/86.
+    ``txacme.client.Client.from_url()``.
+
+    :param pool:
+        The connection pool to use. If None, a non-persistent pool is used.
 
     :return: a callable that returns a deffered that returns the client
     """
     # Creating an Agent without specifying a pool gives us the default pool
     # which is non-persistent.
-    jws_client = JWSClient(HTTPClient(agent=Agent(reactor)), key, alg)
+    agent = Agent(reactor, pool=pool)
+    jws_client = PersistentJWSClient(HTTPClient(agent=agent), key, alg)
 
     return partial(txacme_Client.from_url, reactor, url, key, alg, jws_client)
 
@@ -135,33 +204,254 @@ def generate_wildcard_pem_bytes():
     ))
 
 
+def get_server_names(cert_store):
+    """
+    Get the names of the certificates in a certificate store. If the store has
+    a ``server_names()`` method, it is used so that the certificates don't all
+    have to be read, else this falls back to ``as_dict()``.
+
+    :return: A Deferred that fires with a list of server names.
+    """
+    server_names = getattr(cert_store, 'server_names', None)
+    if server_names is not None:
+        return server_names()
+
+    return cert_store.as_dict().addCallback(lambda certs: list(certs.keys()))
+
+
+def cert_not_after(pem_objects):
+    """
+    Get the time at which the first of the certificates in a list of PEM
+    objects expires.
+
+    :return:
+        The time in seconds since the epoch, or None if there are no
+        certificates.
+    """
+    not_afters = [
+        x509.load_pem_x509_certificate(
+            o.as_bytes(), default_backend()).not_valid_after
+        for o in pem_objects if isinstance(o, pem.Certificate)]
+    if not not_afters:
+        return None
+    return calendar.timegm(min(not_afters).utctimetuple())
+
+
+def get_expiries(cert_store):
+    """
+    Get the expiry times of the certificates in a certificate store. If the
+    store has an ``expiries()`` method, it is used so that the certificates
+    don't all have to be read, else this falls back to ``as_dict()``.
+
+    :return:
+        A Deferred that fires with a dict of server names to the time in
+        seconds since the epoch at which their certificate expires.
+    """
+    expiries = getattr(cert_store, 'expiries', None)
+    if expiries is not None:
+        return expiries()
+
+    return cert_store.as_dict().addCallback(lambda certs: dict(
+        (name, cert_not_after(pem_objects))
+        for name, pem_objects in certs.items()))
+
+
+@implementer(ICertificateStore)
+class ListingDirectoryStore(DirectoryStore):
+    """
+    A ``txacme.store.DirectoryStore`` that can list the names of the
+    certificates it stores without reading them.
+    """
+
+    def server_names(self):
+        return succeed([fn[:-4] for fn in self.path.listdir()
+                        if fn.endswith(u'.pem')])
+
+
+def _check_store_response(certificate_store_response):
+    if certificate_store_response is not None:
+        raise RuntimeError(
+            "Wrapped certificate store returned something non-None. Don't "
+            'know what to do with %r.' % (certificate_store_response,))
+
+
 @implementer(ICertificateStore)
 class MlbCertificateStore(object):
     """
     An ``ICertificateStore`` that wraps another ``ICertificateStore`` but
     calls marathon-lb for a USR1 signal to be triggered when a certificate is
-    stored.
+    stored. If a clock is given, the reloads for bursts of stored
+    certificates are coalesced into a single reload.
+
+    If an HAProxy runtime API client is given, certificates that HAProxy
+    already knows about are instead updated in place through the runtime API
+    and marathon-lb is only reloaded for new certificates, or if the update
+    fails.
     """
 
-    def __init__(self, certificate_store, mlb_client):
+    log = Logger()
+
+    def __init__(self, certificate_store, mlb_client, clock=None,
+                 reload_quiet_period=0, reload_max_delay=None,
+                 haproxy_client=None, haproxy_cert_dir=None):
+        """
+        :param certificate_store: The ``ICertificateStore`` to wrap.
+        :param mlb_client: The marathon-lb API client.
+        :param clock:
+            The ``IReactorTime`` provider to use to coalesce reloads. If None,
+            marathon-lb is reloaded for every stored certificate.
+        :param reload_quiet_period:
+            Amount of time in seconds to wait for certificates to stop being
+            stored before reloading marathon-lb.
+        :param reload_max_delay:
+            Maximum amount of time in seconds to delay a reload while waiting
+            for certificates to stop being stored. If None, there is no
+            maximum.
+        :param haproxy_client:
+            The ``HAProxyRuntimeClient`` to use to update certificates without
+            reloading. If None, marathon-lb is reloaded for every certificate.
+        :param haproxy_cert_dir:
+            The directory that HAProxy loads the certificates from. Required
+            with ``haproxy_client``.
+        """
+        if haproxy_client is not None and haproxy_cert_dir is None:
+            raise ValueError(
+                'haproxy_cert_dir is required to use the HAProxy runtime API')
+
         self.certificate_store = certificate_store
         self.mlb_client = mlb_client
+        self.haproxy_client = haproxy_client
+        self._haproxy_cert_dir = haproxy_cert_dir
+
+        self._reload_coalescer = None
+        if clock is not None:
+            self._reload_coalescer = Coalescer(
+                self._reload, clock, quiet_period=reload_quiet_period,
+                max_delay=reload_max_delay)
 
     def get(self, server_name):
         return self.certificate_store.get(server_name)
 
     def store(self, server_name, pem_objects):
         d = self.certificate_store.store(server_name, pem_objects)
-        # Trigger a marathon-lb reload each time a certificate changes
-        d.addCallback(self._trigger_signal_usr1)
-        return d
-
-    def _trigger_signal_usr1(self, certificate_store_response):
-        if certificate_store_response is not None:
-            raise RuntimeError(
-                "Wrapped certificate store returned something non-None. Don't "
-                'know what to do with %r.' % (certificate_store_response,))
+        d.addCallback(_check_store_response)
+        return d.addCallback(
+            lambda _: self.certificate_stored(server_name, pem_objects))
+
+    def certificate_stored(self, server_name, pem_objects):
+        """
+        Update marathon-lb for a certificate that has been stored in the
+        wrapped certificate store.
+
+        :return:
+            A Deferred that fires with the result of the marathon-lb reload
+            that covers the certificate, if any.
+        """
+        if self.haproxy_client is not None:
+            return self._update_haproxy(server_name, pem_objects)
+
+        # Trigger a marathon-lb reload each time a certificate changes. The
+        # result is that of the reload that covers this certificate.
+        return self._trigger_signal_usr1()
+
+    def _update_haproxy(self, server_name, pem_objects):
+        path = posixpath.join(self._haproxy_cert_dir, server_name + '.pem')
+        pem_data = ''.join(o.as_text() for o in pem_objects)
+        d = self.haproxy_client.update_cert(path, pem_data)
+
+        def fall_back_to_reload(failure):
+            if failure.check(UnknownCertificateError):
+                self.log.info(
+                    "Certificate '{server_name}' is new to HAProxy. Reloading "
+                    'marathon-lb...', server_name=server_name)
+            else:
+                self.log.failure(
+                    "Failed to update certificate '{server_name}' through the "
+                    'HAProxy runtime API. Reloading marathon-lb...', failure,
+                    LogLevel.error, server_name=server_name)
+            return self._trigger_signal_usr1()
+
+        return d.addErrback(fall_back_to_reload)
+
+    def _trigger_signal_usr1(self):
+        if self._reload_coalescer is None:
+            return self.mlb_client.mlb_signal_usr1()
+        return self._reload_coalescer.trigger()
+
+    def _reload(self, stored_count):
+        self.log.info('Reloading marathon-lb for {count} stored '
+                      'certificates', count=stored_count)
         return self.mlb_client.mlb_signal_usr1()
 
+    def stop(self):
+        """
+        Cancel any pending coalesced reload.
+        """
+        if self._reload_coalescer is not None:
+            self._reload_coalescer.stop()
+
     def as_dict(self):
         return self.certificate_store.as_dict()
+
+    def server_names(self):
+        return get_server_names(self.certificate_store)
+
+    def expiries(self):
+        return get_expiries(self.certificate_store)
+
+
+@implementer(ICertificateStore)
+class GroupCertificateStore(object):
+    """
+    An ``ICertificateStore`` that wraps another ``ICertificateStore`` shared
+    by several marathon-lb groups. When a certificate is stored, only the
+    marathon-lb instances of the groups that serve its server name are
+    updated, each through the group's own ``MlbCertificateStore``.
+    """
+
+    def __init__(self, certificate_store, mlb_stores, get_groups):
+        """
+        :param certificate_store: The ``ICertificateStore`` to wrap.
+        :param mlb_stores:
+            A dict of group names to the ``MlbCertificateStore`` for each
+            group. These should wrap the same certificate store.
+        :param get_groups:
+            Function to call with a server name to get the names of the
+            groups that serve it. If it returns no groups, e.g. because the
+            apps haven't been fetched yet, every group is updated.
+        """
+        self.certificate_store = certificate_store
+        self.mlb_stores = mlb_stores
+        self._get_groups = get_groups
+
+    def get(self, server_name):
+        return self.certificate_store.get(server_name)
+
+    def store(self, server_name, pem_objects):
+        groups = self._get_groups(server_name)
+        if not groups:
+            groups = self.mlb_stores.keys()
+        mlb_stores = [self.mlb_stores[group] for group in sorted(groups)]
+
+        d = self.certificate_store.store(server_name, pem_objects)
+        d.addCallback(_check_store_response)
+        d.addCallback(lambda _: gatherResults(
+            [mlb_store.certificate_stored(server_name, pem_objects)
+             for mlb_store in mlb_stores], consumeErrors=True))
+        return d.addCallback(lambda _: None)
+
+    def stop(self):
+        """
+        Cancel any pending coalesced reloads for every group.
+        """
+        for mlb_store in self.mlb_stores.values():
+            mlb_store.stop()
+
+    def as_dict(self):
+        return self.certificate_store.as_dict()
+
+    def server_names(self):
+        return get_server_names(self.certificate_store)
+
+    def expiries(self):
+        return get_expiries(self.certificate_store)
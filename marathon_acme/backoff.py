@@ -0,0 +1,176 @@
+import json
+import random
+
+from twisted.internet.defer import succeed
+from twisted.logger import Logger
+
+
+class FileFailureStore(object):
+    """
+    Persists domain failure state as JSON in a file.
+    """
+
+    def __init__(self, path):
+        """
+        :param twisted.python.filepath.FilePath path:
+            The path to the file to store the state in.
+        """
+        self._path = path
+
+    def _read(self):
+        if not self._path.exists():
+            return {}
+        return json.loads(self._path.getContent().decode('utf-8'))
+
+    def load(self):
+        return succeed(self._read())
+
+    def update(self, changes):
+        failures = self._read()
+        for domain, failure in changes.items():
+            if failure is None:
+                failures.pop(domain, None)
+            else:
+                failures[domain] = failure
+        self._path.setContent(json.dumps(failures).encode('utf-8'))
+        return succeed(None)
+
+
+class FailureBackoff(object):
+    """
+    A negative cache of domains for which certificate issuance recently
+    failed. Each consecutive failure for a domain doubles the amount of time
+    before issuance is retried for it, up to a maximum, with some random
+    jitter so that domains that failed together aren't retried together.
+    """
+
+    log = Logger()
+
+    def __init__(self, clock, store=None, base_delay=300,
+                 max_delay=24 * 60 * 60, random=random.random):
+        """
+        :param clock: The ``IReactorTime`` provider to use.
+        :param store:
+            The store to persist failures in so that they survive restarts and
+            are shared with other instances. It must have ``load()`` and
+            ``update(changes)`` methods that return Deferreds, where
+            ``changes`` maps each changed domain to its new failure state, or
+            to None if it was cleared. If None, failures are only kept in
+            memory.
+        :param base_delay:
+            The amount of time in seconds to back off for after the first
+            failure.
+        :param max_delay:
+            The maximum amount of time in seconds to back off for.
+        :param random:
+            A function returning a random float in [0, 1) for the jitter.
+        """
+        self._clock = clock
+        self._store = store
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._random = random
+
+        self._failures = {}
+
+    def load(self):
+        """
+        Load the persisted failures, if there is a store, replacing those in
+        memory. Other instances may have changed them since they were last
+        loaded.
+        """
+        if self._store is None:
+            return succeed(None)
+
+        def loaded(failures):
+            self._failures = failures
+            self.log.info('Loaded issuance failure backoff for {count} '
+                          'domains', count=len(failures))
+        return self._store.load().addCallback(loaded)
+
+    def _save(self, domains):
+        if self._store is None:
+            return succeed(None)
+
+        # Only write the domains that changed so that we don't overwrite
+        # changes made by other instances to other domains
+        return self._store.update(
+            dict((domain, self._failures.get(domain)) for domain in domains))
+
+    def record_failure(self, domain, error):
+        """
+        Record that issuance failed for a domain and back off retrying it.
+
+        :return: A Deferred that fires when the failure has been persisted.
+        """
+        failure = self._failures.get(domain, {'failures': 0})
+        failures = failure['failures'] + 1
+
+        delay = min(self._max_delay, self._base_delay * 2 ** (failures - 1))
+        # Jitter the delay to somewhere between half and all of the delay
+        delay *= 0.5 + self._random() / 2
+
+        self._failures[domain] = {
+            'failures': failures,
+            'retry_at': self._clock.seconds() + delay,
+            'error': error,
+        }
+        self.log.warn(
+            "Backing off issuing certificate for '{domain}' for {delay:.0f}s "
+            'after {failures} failures', domain=domain, delay=delay,
+            failures=failures)
+        return self._save([domain])
+
+    def record_success(self, domain):
+        """
+        Record that issuance succeeded for a domain, clearing any backoff.
+
+        :return: A Deferred that fires when the change has been persisted.
+        """
+        if domain not in self._failures:
+            return succeed(None)
+
+        del self._failures[domain]
+        return self._save([domain])
+
+    def retry_delay(self, domain):
+        """
+        Get the amount of time in seconds until issuance may be retried for
+        the domain. 0 if it may be retried now.
+        """
+        failure = self._failures.get(domain)
+        if failure is None:
+            return 0
+        return max(0, failure['retry_at'] - self._clock.seconds())
+
+    def reset(self, domain=None):
+        """
+        Clear the backoff for a domain, or for all domains.
+
+        :return:
+            A Deferred that fires with the list of domains that were reset
+            once the change has been persisted.
+        """
+        if domain is None:
+            reset = sorted(self._failures.keys())
+            self._failures = {}
+        elif domain in self._failures:
+            reset = [domain]
+            del self._failures[domain]
+        else:
+            return succeed([])
+
+        self.log.info('Reset issuance failure backoff for domains: {domains}',
+                      domains=reset)
+        return self._save(reset).addCallback(lambda _: reset)
+
+    def status(self):
+        """
+        Get the backoff state for each domain as a JSON-serializable object.
+        """
+        now = self._clock.seconds()
+        return dict((domain, {
+            'failures': failure['failures'],
+            'error': failure['error'],
+            'retry_in': max(0, failure['retry_at'] - now),
+        }) for domain, failure in self._failures.items())
@@ -0,0 +1,139 @@
+import re
+
+from twisted.internet.defer import succeed
+from twisted.logger import Logger
+from twisted.web.http import NOT_FOUND, SERVICE_UNAVAILABLE
+from twisted.web.resource import NoResource, Resource
+from twisted.web.server import NOT_DONE_YET
+
+from txacme.interfaces import IResponder
+
+from zope.interface import implementer
+
+# ACME tokens are base64url-encoded
+_TOKEN_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+@implementer(IResponder)
+class VaultKvHttp01Responder(object):
+    """
+    An ``http-01`` challenge responder that shares the challenge responses
+    between marathon-acme instances through a Vault key/value version 2
+    secret engine, so that any instance can answer the validation requests
+    for a challenge started by any other instance.
+    """
+
+    challenge_type = u'http-01'
+    log = Logger()
+
+    def __init__(self, client, mount_path, path='challenges'):
+        """
+        :param client: The Vault API client.
+        :param mount_path: The Vault key/value mount path.
+        :param path:
+            The path under which to store the challenge responses in the
+            key/value engine.
+        """
+        self._client = client
+        self._mount_path = mount_path
+        self._path = path
+        # The challenges started by this instance can be answered without
+        # reading from Vault
+        self._key_authorizations = {}
+
+        self.resource = _ChallengeResource(self)
+
+    def _token_path(self, token):
+        return '{}/{}'.format(self._path, token)
+
+    def start_responding(self, server_name, challenge, response):
+        token = challenge.encode('token')
+        key_authorization = response.key_authorization
+        self._key_authorizations[token] = key_authorization
+
+        d = self._client.create_or_update_kv2(
+            self._token_path(token), {'key_authorization': key_authorization},
+            mount_path=self._mount_path)
+        return d.addCallback(lambda _: None)
+
+    def stop_responding(self, server_name, challenge, response):
+        token = challenge.encode('token')
+        self._key_authorizations.pop(token, None)
+
+        d = self._client.delete_kv2_metadata(
+            self._token_path(token), mount_path=self._mount_path)
+        # The challenge is finished, so failing to clean up shouldn't fail
+        # the issuance
+        d.addErrback(lambda f: self.log.failure(
+            "Error removing the response for challenge '{token}'", f,
+            token=token))
+        return d.addCallback(lambda _: None)
+
+    def get_key_authorization(self, token):
+        """
+        Get the key authorization to respond to a challenge with.
+
+        :return:
+            A Deferred that fires with the key authorization, or None if
+            there is no challenge with the token.
+        """
+        key_authorization = self._key_authorizations.get(token)
+        if key_authorization is not None:
+            return succeed(key_authorization)
+
+        # Don't let arbitrary paths through to Vault
+        if not _TOKEN_RE.match(token):
+            return succeed(None)
+
+        d = self._client.read_kv2(
+            self._token_path(token), mount_path=self._mount_path)
+
+        def get_key_authorization(response):
+            if response is None:
+                return None
+            return response['data']['data'].get('key_authorization')
+
+        return d.addCallback(get_key_authorization)
+
+
+class _ChallengeResource(Resource):
+    def __init__(self, responder):
+        Resource.__init__(self)
+        self._responder = responder
+
+    def getChild(self, path, request):
+        try:
+            token = path.decode('ascii')
+        except UnicodeDecodeError:
+            return NoResource()
+        return _ChallengeResponseResource(self._responder, token)
+
+
+class _ChallengeResponseResource(Resource):
+    isLeaf = True
+    log = Logger()
+
+    def __init__(self, responder, token):
+        Resource.__init__(self)
+        self._responder = responder
+        self._token = token
+
+    def render_GET(self, request):
+        def respond(key_authorization):
+            if key_authorization is None:
+                request.setResponseCode(NOT_FOUND)
+            else:
+                request.setHeader('Content-Type', 'text/plain')
+                request.write(key_authorization.encode('utf-8'))
+            request.finish()
+
+        def error(failure):
+            self.log.failure(
+                "Error reading the response for challenge '{token}'",
+                failure, token=self._token)
+            request.setResponseCode(SERVICE_UNAVAILABLE)
+            request.finish()
+
+        d = self._responder.get_key_authorization(self._token)
+        d.addCallbacks(respond, error)
+        return NOT_DONE_YET
@@ -1,9 +1,11 @@
 import argparse
 import ipaddress
 import os
+import socket
 import sys
 
-from twisted.internet.endpoints import quoteStringArgument
+from twisted.internet.defer import gatherResults
+from twisted.internet.endpoints import clientFromString, quoteStringArgument
 from twisted.internet.task import react
 from twisted.logger import (
     FilteringLogObserver, LogLevel, LogLevelFilterPredicate, Logger,
@@ -12,16 +14,22 @@ from twisted.python.compat import unicode
 from twisted.python.filepath import FilePath
 from twisted.python.url import URL
 
-from txacme.store import DirectoryStore
 from txacme.urls import LETSENCRYPT_DIRECTORY
 
 from marathon_acme import __version__
 from marathon_acme.acme_util import (
-    create_txacme_client_creator, generate_wildcard_pem_bytes, maybe_key,
-    maybe_key_vault)
-from marathon_acme.clients import MarathonClient, MarathonLbClient, VaultClient
+    ListingDirectoryStore, create_txacme_client_creator,
+    generate_wildcard_pem_bytes, maybe_key, maybe_key_vault)
+from marathon_acme.backoff import FileFailureStore
+from marathon_acme.challenges import VaultKvHttp01Responder
+from marathon_acme.clients import (
+    HAProxyRuntimeClient, MarathonClient, MarathonLbClient, VaultClient,
+    default_pool)
+from marathon_acme.leader import VaultLeaderLease
 from marathon_acme.service import MarathonAcme
-from marathon_acme.vault_store import VaultKvCertificateStore
+from marathon_acme.sharding import VaultShardMembership
+from marathon_acme.vault_store import (
+    VaultKvCertificateStore, VaultKvFailureStore)
 
 
 log = Logger()
@@ -54,11 +62,33 @@ def main(reactor, argv=sys.argv[1:], env=os.environ,
                         help='The marathon-lb group to issue certificates for '
                              '(default: %(default)s)',
                         default='external')
+    parser.add_argument('--group-lb', metavar='GROUP=LB[,LB,...]',
+                        help=('Another marathon-lb group to issue '
+                              'certificates for, and the addresses for the '
+                              "marathon-lb HTTP API of that group's "
+                              'instances. Can be given several times. The '
+                              'apps for all the groups are fetched together.'),
+                        action='append',
+                        default=[])
     parser.add_argument('--allow-multiple-certs',
                         help=('Allow multiple certificates for a single app '
                               'port. This allows multiple domains for an app, '
                               'but is not recommended.'),
                         action='store_true')
+    parser.add_argument('--http-persistent-per-host',
+                        help=('The maximum number of idle HTTP connections to '
+                              'keep open to each host for later requests to '
+                              'Marathon, marathon-lb, Vault and the ACME '
+                              'server. Set to 0 to close connections after '
+                              'each request. (default: %(default)s)'),
+                        type=int,
+                        default=2)
+    parser.add_argument('--http-idle-timeout',
+                        help=('Amount of time in seconds after which an idle '
+                              'HTTP connection is closed. '
+                              '(default: %(default)s)'),
+                        type=float,
+                        default=60)
     parser.add_argument('--listen',
                         help='The address for the port to listen on (default: '
                              '%(default)s)',
@@ -70,12 +100,210 @@ def main(reactor, argv=sys.argv[1:], env=os.environ,
                               '(default: %(default)s)'),
                         type=float,
                         default=10)
+    parser.add_argument('--marathon-label-ports',
+                        help=('Only fetch the apps from Marathon that have a '
+                              'MARATHON_ACME_{n}_DOMAIN label for one of this '
+                              'many of their first ports, using label '
+                              'selectors. Domains on later ports are only '
+                              'found from events. Set to 0 to fetch all apps. '
+                              '(default: %(default)s)'),
+                        type=int,
+                        default=0)
+    parser.add_argument('--marathon-leader-routing',
+                        help=('Ask Marathon which instance is the leader and '
+                              'prefer its address, if it is one of the '
+                              '--marathon addresses, so that requests are '
+                              'not proxied to the leader.'),
+                        action='store_true')
+    parser.add_argument('--marathon-circuit-threshold',
+                        help=('The number of consecutive failures after '
+                              'which a Marathon address is only tried once '
+                              'all the others have failed, until it can be '
+                              'pinged again. Set to 0 to always try the '
+                              'addresses in order. (default: %(default)s)'),
+                        type=int,
+                        default=3)
+    parser.add_argument('--marathon-circuit-reset',
+                        help=('Amount of time in seconds between pings of a '
+                              'Marathon address that has failed too many '
+                              'times. (default: %(default)s)'),
+                        type=float,
+                        default=30)
+    parser.add_argument('--marathon-hedge-percentile',
+                        help=('Hedge requests for apps and events: if no '
+                              'response has been received from a Marathon '
+                              'address within this percentile of recent '
+                              'response times, send the same request to the '
+                              'next address and use whichever responds '
+                              'first. Set to 0 to disable. '
+                              '(default: %(default)s)'),
+                        type=float,
+                        default=0)
+    parser.add_argument('--marathon-hedge-delay',
+                        help=('The minimum amount of time in seconds to wait '
+                              'for a response from Marathon before hedging a '
+                              'request. (default: %(default)s)'),
+                        type=float,
+                        default=1)
     parser.add_argument('--sse-timeout',
                         help=('Amount of time in seconds to wait for some '
                               'event data to be received from Marathon. Set '
                               'to 0 to disable. (default: %(default)s)'),
                         type=float,
                         default=60)
+    parser.add_argument('--sync-quiet-period',
+                        help=('Amount of time in seconds to wait for events '
+                              'from Marathon to stop arriving before running '
+                              'a sync. Bursts of events are coalesced into a '
+                              'single sync. Set to 0 to disable. (default: '
+                              '%(default)s)'),
+                        type=float,
+                        default=1)
+    parser.add_argument('--sync-max-delay',
+                        help=('Maximum amount of time in seconds to delay a '
+                              'sync while waiting for events to stop '
+                              'arriving. (default: %(default)s)'),
+                        type=float,
+                        default=10)
+    parser.add_argument('--lb-reload-quiet-period',
+                        help=('Amount of time in seconds to wait for '
+                              'certificates to stop being issued before '
+                              'reloading marathon-lb. Bursts of certificates '
+                              'are coalesced into a single reload. (default: '
+                              '%(default)s)'),
+                        type=float,
+                        default=5)
+    parser.add_argument('--lb-reload-max-delay',
+                        help=('Maximum amount of time in seconds to delay a '
+                              'marathon-lb reload while waiting for '
+                              'certificates to stop being issued. (default: '
+                              '%(default)s)'),
+                        type=float,
+                        default=30)
+    parser.add_argument('--haproxy-socket',
+                        help=('Comma-separated Twisted client endpoint '
+                              'descriptions for the HAProxy runtime API '
+                              '(stats socket) of each HAProxy process, e.g. '
+                              '"unix:/var/run/haproxy/socket". If set, '
+                              'renewed certificates are updated in HAProxy '
+                              'without reloading marathon-lb. Requires '
+                              'HAProxy 2.1 or later.'))
+    parser.add_argument('--haproxy-cert-dir',
+                        help=('The directory that HAProxy loads the '
+                              'certificates from. Required with '
+                              '--haproxy-socket.'))
+    parser.add_argument('--issue-concurrency',
+                        help=('The maximum number of certificates to issue '
+                              'at once. (default: %(default)s)'),
+                        type=int,
+                        default=4)
+    parser.add_argument('--acme-order-limit',
+                        help=('The number of new ACME orders to allow every 3 '
+                              'hours. Orders beyond this are deferred. Set to '
+                              '0 to disable. (default: %(default)s)'),
+                        type=int,
+                        default=300)
+    parser.add_argument('--acme-domain-cert-limit',
+                        help=('The number of certificates to allow per '
+                              'registered domain every week. Orders beyond '
+                              'this are deferred. Set to 0 to disable. '
+                              '(default: %(default)s)'),
+                        type=int,
+                        default=50)
+    parser.add_argument('--failure-backoff',
+                        help=('Amount of time in seconds to wait before '
+                              'retrying to issue a certificate for a domain '
+                              'after a failure. This doubles with each '
+                              'consecutive failure. (default: %(default)s)'),
+                        type=float,
+                        default=300)
+    parser.add_argument('--failure-backoff-max',
+                        help=('Maximum amount of time in seconds to wait '
+                              'before retrying to issue a certificate for a '
+                              'domain after failures. (default: %(default)s)'),
+                        type=float,
+                        default=86400)
+    parser.add_argument('--renew-spread',
+                        help=('Amount of time in seconds to spread '
+                              'certificate renewals over. Each domain is '
+                              'renewed up to this much earlier than 30 days '
+                              'before its certificate expires, by an offset '
+                              'derived from the domain name. Set to 0 to '
+                              'disable. (default: %(default)s)'),
+                        type=float,
+                        default=3 * 24 * 60 * 60)
+    parser.add_argument('--health-max-event-age',
+                        help=('Amount of time in seconds since the last '
+                              'event from Marathon after which marathon-acme '
+                              'reports itself as unhealthy. Set to 0 to '
+                              'disable. (default: %(default)s)'),
+                        type=float,
+                        default=0)
+    parser.add_argument('--health-max-sync-age',
+                        help=('Amount of time in seconds since the last '
+                              'successful sync after which marathon-acme '
+                              'reports itself as unhealthy. Set to 0 to '
+                              'disable. (default: %(default)s)'),
+                        type=float,
+                        default=0)
+    parser.add_argument('--vault-read-concurrency',
+                        help=('The maximum number of certificates to read '
+                              'from Vault at once. (default: %(default)s)'),
+                        type=int,
+                        default=16)
+    parser.add_argument('--vault-read-rate',
+                        help=('The maximum number of certificates to read '
+                              'from Vault per second. Set to 0 to disable. '
+                              '(default: %(default)s)'),
+                        type=float,
+                        default=0)
+    parser.add_argument('--vault-cache-size',
+                        help=('The maximum number of certificates read from '
+                              'Vault to cache in memory. Set to 0 to disable. '
+                              '(default: %(default)s)'),
+                        type=int,
+                        default=1000)
+    parser.add_argument('--vault-live-shards',
+                        help=('The number of keys to shard the live mapping '
+                              'of certificates across in Vault. An existing '
+                              'single-key live mapping is copied into the '
+                              'shards at startup. Set to 0 to use a single '
+                              'key. (default: %(default)s)'),
+                        type=int,
+                        default=0)
+    parser.add_argument('--leader-election',
+                        help=('Elect a leader among marathon-acme replicas '
+                              'using a lease in Vault. Only the leader issues '
+                              'certificates. Requires --vault.'),
+                        action='store_true')
+    parser.add_argument('--leader-id',
+                        help=('A name for this replica that is unique among '
+                              'the replicas. (default: the hostname)'),
+                        default=socket.gethostname())
+    parser.add_argument('--leader-lease-duration',
+                        help=('Amount of time in seconds that the leader can '
+                              'go without renewing its lease before another '
+                              'replica takes over. (default: %(default)s)'),
+                        type=float,
+                        default=30)
+    parser.add_argument('--sharding',
+                        help=('Share out the domains between marathon-acme '
+                              'instances by consistent hashing, with the '
+                              'members tracked in Vault. Each instance only '
+                              'issues and renews certificates for its own '
+                              'domains. Requires --vault.'),
+                        action='store_true')
+    parser.add_argument('--shard-id',
+                        help=('A name for this instance that is unique among '
+                              'the shard members. (default: the hostname)'),
+                        default=socket.gethostname())
+    parser.add_argument('--shard-member-timeout',
+                        help=('Amount of time in seconds that a shard member '
+                              'can go without a heartbeat before its domains '
+                              'are shared out between the other members. '
+                              '(default: %(default)s)'),
+                        type=float,
+                        default=30)
     parser.add_argument('--log-level',
                         help='The minimum severity level to log messages at '
                              '(default: %(default)s)',
@@ -94,6 +322,27 @@ def main(reactor, argv=sys.argv[1:], env=os.environ,
     parser.add_argument('--version', action='version', version=__version__)
 
     args = parser.parse_args(argv)
+    if args.haproxy_socket and not args.haproxy_cert_dir:
+        parser.error('--haproxy-cert-dir is required with --haproxy-socket')
+    extra_groups = {}
+    for group_lb in args.group_lb:
+        group, sep, addrs = group_lb.partition('=')
+        if not sep or not group or not addrs:
+            parser.error(
+                "'%s' does not have the correct form for --group-lb: "
+                'GROUP=LB[,LB,...]' % (group_lb,))
+        if group == args.group or group in extra_groups:
+            parser.error("The group '%s' is given more than once" % (group,))
+        extra_groups[group] = addrs.split(',')
+    if extra_groups and args.haproxy_socket:
+        parser.error('--haproxy-socket cannot be used with --group-lb')
+    if args.leader_election and not args.vault:
+        parser.error('--vault is required with --leader-election')
+    if args.sharding and not args.vault:
+        parser.error('--vault is required with --sharding')
+    if args.sharding and args.leader_election:
+        parser.error('--sharding and --leader-election cannot be used '
+                     'together')
 
     # Set up logging
     init_logging(args.log_level)
@@ -101,11 +350,45 @@ def main(reactor, argv=sys.argv[1:], env=os.environ,
     # Set up marathon-acme
     marathon_addrs = args.marathon.split(',')
     mlb_addrs = args.lb.split(',')
+    haproxy_endpoints = (
+        args.haproxy_socket.split(',') if args.haproxy_socket else None)
 
     sse_timeout = args.sse_timeout if args.sse_timeout > 0 else None
+    marathon_circuit_threshold = (
+        args.marathon_circuit_threshold
+        if args.marathon_circuit_threshold > 0 else None)
+    marathon_hedge_percentile = (
+        args.marathon_hedge_percentile
+        if args.marathon_hedge_percentile > 0 else None)
+    acme_order_limit = (
+        args.acme_order_limit if args.acme_order_limit > 0 else None)
+    acme_domain_cert_limit = (
+        args.acme_domain_cert_limit if args.acme_domain_cert_limit > 0
+        else None)
+
+    health_max_event_age = (
+        args.health_max_event_age if args.health_max_event_age > 0 else None)
+    health_max_sync_age = (
+        args.health_max_sync_age if args.health_max_sync_age > 0 else None)
+
+    vault_read_rate = (
+        args.vault_read_rate if args.vault_read_rate > 0 else None)
+    vault_live_shards = (
+        args.vault_live_shards if args.vault_live_shards > 0 else None)
 
     acme_url = URL.fromText(_to_unicode(args.acme))
 
+    # Marathon, marathon-lb and the ACME server share a pool of connections.
+    # Vault gets its own because its connections may use a client
+    # certificate, which the pool doesn't take into account.
+    pool_kwargs = {
+        'persistent': args.http_persistent_per_host > 0,
+        'max_persistent_per_host': args.http_persistent_per_host,
+        'idle_timeout': args.http_idle_timeout,
+    }
+    pool = default_pool(reactor, **pool_kwargs)
+    pools = [pool]
+
     endpoint_description = parse_listen_addr(args.listen)
 
     log_args = [
@@ -115,9 +398,42 @@ def main(reactor, argv=sys.argv[1:], env=os.environ,
         ('email', args.email),
         ('allow-multiple-certs', args.allow_multiple_certs),
         ('marathon', marathon_addrs),
+        ('marathon-label-ports', args.marathon_label_ports),
+        ('marathon-leader-routing', args.marathon_leader_routing),
+        ('marathon-circuit-threshold', marathon_circuit_threshold),
+        ('marathon-circuit-reset', args.marathon_circuit_reset),
+        ('marathon-hedge-percentile', marathon_hedge_percentile),
+        ('marathon-hedge-delay', args.marathon_hedge_delay),
         ('sse-timeout', sse_timeout),
         ('lb', mlb_addrs),
         ('group', args.group),
+        ('group-lb', extra_groups),
+        ('sync-quiet-period', args.sync_quiet_period),
+        ('sync-max-delay', args.sync_max_delay),
+        ('lb-reload-quiet-period', args.lb_reload_quiet_period),
+        ('lb-reload-max-delay', args.lb_reload_max_delay),
+        ('haproxy-socket', haproxy_endpoints),
+        ('haproxy-cert-dir', args.haproxy_cert_dir),
+        ('issue-concurrency', args.issue_concurrency),
+        ('acme-order-limit', acme_order_limit),
+        ('acme-domain-cert-limit', acme_domain_cert_limit),
+        ('failure-backoff', args.failure_backoff),
+        ('failure-backoff-max', args.failure_backoff_max),
+        ('renew-spread', args.renew_spread),
+        ('health-max-event-age', health_max_event_age),
+        ('health-max-sync-age', health_max_sync_age),
+        ('vault-read-concurrency', args.vault_read_concurrency),
+        ('vault-read-rate', vault_read_rate),
+        ('vault-cache-size', args.vault_cache_size),
+        ('vault-live-shards', vault_live_shards),
+        ('leader-election', args.leader_election),
+        ('leader-id', args.leader_id),
+        ('leader-lease-duration', args.leader_lease_duration),
+        ('sharding', args.sharding),
+        ('shard-id', args.shard_id),
+        ('shard-member-timeout', args.shard_member_timeout),
+        ('http-persistent-per-host', args.http_persistent_per_host),
+        ('http-idle-timeout', args.http_idle_timeout),
         ('endpoint-description', endpoint_description),
     ]
     log_args = ['{}={!r}'.format(k, v) for k, v in log_args]
@@ -125,22 +441,69 @@ def main(reactor, argv=sys.argv[1:], env=os.environ,
         __version__, ', '.join(log_args)))
 
     if args.vault:
-        key_d, cert_store = init_vault_storage(
-            reactor, env, args.storage_path)
+        vault_pool = default_pool(reactor, **pool_kwargs)
+        pools.append(vault_pool)
+        key_d, cert_store, failure_store, replication = init_vault_storage(
+            reactor, env, args.storage_path, pool=vault_pool,
+            read_concurrency=args.vault_read_concurrency,
+            reads_per_second=vault_read_rate,
+            cache_size=args.vault_cache_size,
+            live_shards=vault_live_shards,
+            leader_id=args.leader_id if args.leader_election else None,
+            leader_lease_duration=args.leader_lease_duration,
+            shard_id=args.shard_id if args.sharding else None,
+            shard_member_timeout=args.shard_member_timeout)
     else:
-        key_d, cert_store = init_file_storage(args.storage_path)
+        key_d, cert_store, failure_store = init_file_storage(
+            args.storage_path)
+        replication = {}
 
     # Once we have the client key, create the txacme client creator
-    key_d.addCallback(create_txacme_client_creator, reactor, acme_url)
+    key_d.addCallback(
+        create_txacme_client_creator, reactor, acme_url, pool=pool)
 
     # Once we have the client creator, create the service
     key_d.addCallback(
         create_marathon_acme, cert_store, args.email,
         args.allow_multiple_certs, marathon_addrs, args.marathon_timeout,
-        sse_timeout, mlb_addrs, args.group, reactor)
+        sse_timeout, mlb_addrs, args.group, reactor,
+        sync_quiet_period=args.sync_quiet_period,
+        sync_max_delay=args.sync_max_delay,
+        issue_workers=args.issue_concurrency,
+        acme_order_limit=acme_order_limit,
+        acme_domain_cert_limit=acme_domain_cert_limit,
+        failure_store=failure_store,
+        failure_backoff_base=args.failure_backoff,
+        failure_backoff_max=args.failure_backoff_max,
+        mlb_reload_quiet_period=args.lb_reload_quiet_period,
+        mlb_reload_max_delay=args.lb_reload_max_delay,
+        haproxy_endpoints=haproxy_endpoints,
+        haproxy_cert_dir=args.haproxy_cert_dir,
+        renew_spread=args.renew_spread,
+        health_max_event_age=health_max_event_age,
+        health_max_sync_age=health_max_sync_age,
+        extra_groups=extra_groups,
+        app_label_ports=args.marathon_label_ports,
+        marathon_leader_routing=args.marathon_leader_routing,
+        marathon_circuit_threshold=marathon_circuit_threshold,
+        marathon_circuit_reset=args.marathon_circuit_reset,
+        marathon_hedge_percentile=marathon_hedge_percentile,
+        marathon_hedge_delay=args.marathon_hedge_delay,
+        pool=pool,
+        **replication)
 
     # Finally, run the thing
-    return key_d.addCallback(lambda ma: ma.run(endpoint_description))
+    key_d.addCallback(lambda ma: ma.run(endpoint_description))
+    return key_d.addBoth(_close_pools, pools)
+
+
+def _close_pools(result, pools):
+    """
+    Close the idle connections in the connection pools once we're done so
+    that nothing is left behind in the reactor.
+    """
+    d = gatherResults([pool.closeCachedConnections() for pool in pools])
+    return d.addCallback(lambda _: result)
 
 
 def _to_unicode(string):
@@ -192,7 +555,16 @@ def _create_tx_endpoints_string(args, kwargs):
 def create_marathon_acme(
     client_creator, cert_store, acme_email, allow_multiple_certs,
     marathon_addrs, marathon_timeout, sse_timeout, mlb_addrs, group,
-        reactor):
+        reactor, sync_quiet_period=0, sync_max_delay=None, issue_workers=4,
+        acme_order_limit=None, acme_domain_cert_limit=None, failure_store=None,
+        failure_backoff_base=300, failure_backoff_max=86400,
+        mlb_reload_quiet_period=0, mlb_reload_max_delay=None,
+        haproxy_endpoints=None, haproxy_cert_dir=None, renew_spread=0,
+        health_max_event_age=None, health_max_sync_age=None,
+        leader_lease=None, shard_membership=None, challenge_responder=None,
+        extra_groups=None, app_label_ports=0, marathon_leader_routing=False,
+        marathon_circuit_threshold=3, marathon_circuit_reset=30,
+        marathon_hedge_percentile=None, marathon_hedge_delay=1, pool=None):
     """
     Create a marathon-acme instance.
 
@@ -220,11 +592,98 @@ def create_marathon_acme(
         The marathon-lb group (``HAPROXY_GROUP``) to consider when finding
         app domains.
     :param reactor: The reactor to use.
+    :param sync_quiet_period:
+        Amount of time in seconds to wait for events from Marathon to stop
+        arriving before running a sync.
+    :param sync_max_delay:
+        Maximum amount of time in seconds to delay a sync while waiting for
+        events to stop arriving.
+    :param issue_workers:
+        The maximum number of certificates to issue at once.
+    :param acme_order_limit:
+        The number of new ACME orders to allow every 3 hours.
+    :param acme_domain_cert_limit:
+        The number of certificates to allow per registered domain every week.
+    :param failure_store:
+        The store to persist domain issuance failures in.
+    :param failure_backoff_base:
+        Amount of time in seconds to back off issuing a certificate for a
+        domain after its first failure.
+    :param failure_backoff_max:
+        Maximum amount of time in seconds to back off issuing a certificate
+        for a domain after failures.
+    :param mlb_reload_quiet_period:
+        Amount of time in seconds to wait for certificates to stop being
+        stored before reloading marathon-lb.
+    :param mlb_reload_max_delay:
+        Maximum amount of time in seconds to delay a marathon-lb reload while
+        waiting for certificates to stop being stored.
+    :param haproxy_endpoints:
+        List of client endpoint descriptions for the HAProxy runtime API of
+        each HAProxy process. If None, the runtime API is not used.
+    :param haproxy_cert_dir:
+        The directory that HAProxy loads the certificates from.
+    :param renew_spread:
+        Amount of time in seconds to spread certificate renewals over.
+    :param health_max_event_age:
+        Amount of time in seconds since the last event from Marathon after
+        which the service is unhealthy.
+    :param health_max_sync_age:
+        Amount of time in seconds since the last successful sync after which
+        the service is unhealthy.
+    :param leader_lease:
+        The lease to contend for with other replicas. If None, this replica
+        always acts as the leader.
+    :param shard_membership:
+        The membership of the instances to share out the domains with. If
+        None, this instance owns all the domains.
+    :param challenge_responder:
+        The ``http-01`` challenge responder to use. If None, the challenges
+        are kept in memory.
+    :param extra_groups:
+        A dict of the names of other marathon-lb groups to issue certificates
+        for to the list of addresses for the marathon-lb instances of each
+        group.
+    :param app_label_ports:
+        The number of ports to fetch apps with domain labels for, using label
+        selectors. If 0, all apps are fetched.
+    :param marathon_leader_routing:
+        Whether to prefer the address of the Marathon leader.
+    :param marathon_circuit_threshold:
+        The number of consecutive failures after which a Marathon address is
+        only tried as a last resort. If None, addresses are always tried in
+        order.
+    :param marathon_circuit_reset:
+        Amount of time in seconds between pings of a Marathon address that
+        has failed too many times.
+    :param marathon_hedge_percentile:
+        The percentile of recent Marathon response times after which to hedge
+        requests for apps and events. If None, requests are not hedged.
+    :param marathon_hedge_delay:
+        The minimum amount of time in seconds to wait before hedging a
+        Marathon request.
+    :param pool:
+        The connection pool for the Marathon and marathon-lb clients. If None,
+        each client has its own.
     """
-    marathon_client = MarathonClient(marathon_addrs, timeout=marathon_timeout,
-                                     sse_kwargs={'timeout': sse_timeout},
-                                     reactor=reactor)
-    marathon_lb_client = MarathonLbClient(mlb_addrs, reactor=reactor)
+    marathon_client = MarathonClient(
+        marathon_addrs, timeout=marathon_timeout,
+        sse_kwargs={'timeout': sse_timeout},
+        failure_threshold=marathon_circuit_threshold,
+        reset_timeout=marathon_circuit_reset,
+        leader_routing=marathon_leader_routing,
+        hedge_percentile=marathon_hedge_percentile,
+        hedge_delay=marathon_hedge_delay, reactor=reactor, pool=pool)
+    marathon_lb_client = MarathonLbClient(
+        mlb_addrs, reactor=reactor, pool=pool)
+    extra_mlb_clients = dict(
+        (extra_group, MarathonLbClient(addrs, reactor=reactor, pool=pool))
+        for extra_group, addrs in (extra_groups or {}).items())
+    haproxy_client = None
+    if haproxy_endpoints:
+        haproxy_client = HAProxyRuntimeClient(
+            [clientFromString(reactor, e) for e in haproxy_endpoints],
+            clock=reactor)
 
     return MarathonAcme(
         marathon_client,
@@ -234,7 +693,27 @@ def create_marathon_acme(
         client_creator,
         reactor,
         acme_email,
-        allow_multiple_certs
+        allow_multiple_certs,
+        sync_quiet_period=sync_quiet_period,
+        sync_max_delay=sync_max_delay,
+        issue_workers=issue_workers,
+        acme_order_limit=acme_order_limit,
+        acme_domain_cert_limit=acme_domain_cert_limit,
+        failure_store=failure_store,
+        failure_backoff_base=failure_backoff_base,
+        failure_backoff_max=failure_backoff_max,
+        mlb_reload_quiet_period=mlb_reload_quiet_period,
+        mlb_reload_max_delay=mlb_reload_max_delay,
+        haproxy_client=haproxy_client,
+        haproxy_cert_dir=haproxy_cert_dir,
+        renew_spread=renew_spread,
+        health_max_event_age=health_max_event_age,
+        health_max_sync_age=health_max_sync_age,
+        leader_lease=leader_lease,
+        shard_membership=shard_membership,
+        challenge_responder=challenge_responder,
+        extra_groups=extra_mlb_clients,
+        app_label_ports=app_label_ports
     )
 
 
@@ -283,18 +762,48 @@ def init_logging(log_level):
     globalLogPublisher.addObserver(log_observer)
 
 
-def init_vault_storage(reactor, env, mount_path):
-    vault_client = VaultClient.from_env(reactor=reactor, env=env)
-    cert_store = VaultKvCertificateStore(vault_client, mount_path)
-    key_d = maybe_key_vault(vault_client, mount_path)
-    return key_d, cert_store
+def init_vault_storage(reactor, env, mount_path, read_concurrency=16,
+                       reads_per_second=None, cache_size=1000,
+                       live_shards=None, leader_id=None,
+                       leader_lease_duration=30, shard_id=None,
+                       shard_member_timeout=30, pool=None):
+    vault_client = VaultClient.from_env(reactor=reactor, env=env, pool=pool)
+    cert_store = VaultKvCertificateStore(
+        vault_client, mount_path, read_concurrency=read_concurrency,
+        reads_per_second=reads_per_second, clock=reactor,
+        cache_size=cache_size, live_shards=live_shards)
+    failure_store = VaultKvFailureStore(
+        vault_client, mount_path, clock=reactor)
+
+    # Keyword arguments for MarathonAcme when there are other instances
+    replication = {}
+    if leader_id is not None:
+        replication['leader_lease'] = VaultLeaderLease(
+            vault_client, mount_path, leader_id, reactor,
+            lease_duration=leader_lease_duration,
+            renew_interval=leader_lease_duration / 3.0)
+    if shard_id is not None:
+        replication['shard_membership'] = VaultShardMembership(
+            vault_client, mount_path, shard_id, reactor,
+            member_timeout=shard_member_timeout,
+            heartbeat_interval=shard_member_timeout / 3.0)
+    if replication:
+        # Any instance may receive the validation requests for a challenge
+        replication['challenge_responder'] = VaultKvHttp01Responder(
+            vault_client, mount_path)
+
+    # Make sure the live mapping is in the shards before anything reads it
+    key_d = cert_store.migrate_live()
+    key_d.addCallback(lambda _: maybe_key_vault(vault_client, mount_path))
+    return key_d, cert_store, failure_store, replication
 
 
 def init_file_storage(storage_dir):
     storage_path, certs_path = init_storage_dir(storage_dir)
-    cert_store = DirectoryStore(certs_path)
+    cert_store = ListingDirectoryStore(certs_path)
+    failure_store = FileFailureStore(storage_path.child('failures.json'))
     key_d = maybe_key(storage_path)
-    return key_d, cert_store
+    return key_d, cert_store, failure_store
 
 
 def _main():  # pragma: no cover
@@ -1,7 +1,11 @@
 from marathon_acme.clients._base import HTTPError, get_single_header
+from marathon_acme.clients._tx_util import default_pool
+from marathon_acme.clients.haproxy import (
+    HAProxyRuntimeClient, HAProxyRuntimeError, UnknownCertificateError)
 from marathon_acme.clients.marathon import MarathonClient
 from marathon_acme.clients.marathon_lb import MarathonLbClient
 from marathon_acme.clients.vault import VaultClient
 
-__all__ = ['HTTPError', 'MarathonClient', 'MarathonLbClient', 'VaultClient',
-           'get_single_header']
+__all__ = ['HAProxyRuntimeClient', 'HAProxyRuntimeError', 'HTTPError',
+           'MarathonClient', 'MarathonLbClient', 'UnknownCertificateError',
+           'VaultClient', 'default_pool', 'get_single_header']
@@ -2,11 +2,15 @@ import cgi
 
 from requests.exceptions import HTTPError
 
+from treq.content import content
+
 from twisted.logger import LogLevel, Logger
+from twisted.python.failure import Failure
 
 from uritools import uricompose, uridecode, urisplit
 
 from marathon_acme.clients._tx_util import default_client
+from marathon_acme.metrics import HTTP_REQUEST_DURATION
 
 
 def get_single_header(headers, key):
@@ -32,6 +36,10 @@ def raise_for_status(response):
     Raises a `requests.exceptions.HTTPError` if the response did not succeed.
     Adapted from the Requests library:
     https://github.com/kennethreitz/requests/blob/v2.8.1/requests/models.py#L825-L837
+
+    The body of an unsuccessful response is read before the error is raised
+    so that a persistent connection can go back to the pool, so a Deferred
+    that fails with the error is returned.
     """
     http_error_msg = ''
 
@@ -44,7 +52,11 @@ def raise_for_status(response):
             response.code, uridecode(response.request.absoluteURI))
 
     if http_error_msg:
-        raise HTTPError(http_error_msg, response=response)
+        def raise_error(_):
+            raise HTTPError(http_error_msg, response=response)
+
+        # Raise the error even if the body couldn't be read
+        return content(response).addBoth(raise_error)
 
     return response
 
@@ -64,18 +76,25 @@ def raise_for_header(response, key, expected):
 
 class HTTPClient(object):
     DEFAULT_TIMEOUT = 5
+    # The name of the client in request metrics
+    metrics_client = 'http'
     log = Logger()
 
     def __init__(self, url=None, client=None, timeout=DEFAULT_TIMEOUT,
-                 reactor=None):
+                 reactor=None, pool=None):
         """
         Create a client with the specified default URL.
+
+        :param pool:
+            The connection pool to use if no client is given. If None, a new
+            persistent pool is used.
         """
         self.url = url
         self._timeout = timeout
         # Keep track of the reactor because treq uses it for timeouts in a
         # clumsy way
-        self._client, self._reactor = default_client(reactor, client)
+        self._client, self._reactor = default_client(
+            reactor, client, pool=pool)
 
     def _log_request_response(self, response, method, path, kwargs):
         self.log.debug(
@@ -83,6 +102,24 @@ class HTTPClient(object):
             method=method, path=path, args=kwargs, code=response.code)
         return response
 
+    def _metrics_endpoint(self, path):
+        """
+        Get the endpoint label for request metrics from a request path. The
+        label should have a small number of possible values.
+        """
+        return path
+
+    def _observe_request(self, result, method, url, started):
+        if isinstance(result, Failure):
+            status = 'error'
+        else:
+            status = str(result.code)
+        endpoint = self._metrics_endpoint(urisplit(url).path or '/')
+        HTTP_REQUEST_DURATION.labels(
+            self.metrics_client, method, endpoint, status).observe(
+                self._reactor.seconds() - started)
+        return result
+
     def _log_request_error(self, failure, url):
         self.log.failure('Error performing request to url "{url}"', failure,
                          LogLevel.error, url=url)
@@ -148,8 +185,10 @@ class HTTPClient(object):
 
         kwargs.setdefault('timeout', self._timeout)
 
+        started = self._reactor.seconds()
         d = self._client.request(method, url, reactor=self._reactor, **kwargs)
 
+        d.addBoth(self._observe_request, method, url, started)
         d.addCallback(self._log_request_response, method, url, kwargs)
         d.addErrback(self._log_request_error, url)
 
@@ -0,0 +1,125 @@
+from twisted.logger import Logger
+
+
+class EndpointCircuits(object):
+    """
+    Track the health of a priority-ordered list of endpoints so that requests
+    go to an endpoint that is known to work rather than waiting for failing
+    endpoints to time out.
+
+    Requests stick to the last endpoint that worked. An endpoint that fails
+    several times in a row has its circuit opened and is only tried once all
+    the other endpoints have been tried. Open circuits are probed in the
+    background and closed again once a probe succeeds.
+    """
+
+    log = Logger()
+
+    def __init__(self, endpoints, clock, probe, failure_threshold=3,
+                 reset_timeout=30):
+        """
+        :param endpoints: The priority-ordered list of endpoints.
+        :param clock: The ``IReactorTime`` provider to use.
+        :param probe:
+            Function to call with an endpoint to probe whether it works again.
+            Should return a Deferred that fails if it doesn't.
+        :param failure_threshold:
+            The number of consecutive failures after which an endpoint's
+            circuit is opened. If None, circuits are never opened.
+        :param reset_timeout:
+            Amount of time in seconds to wait after a circuit is opened, or a
+            probe fails, before probing the endpoint.
+        """
+        self.endpoints = endpoints
+        self._clock = clock
+        self._probe = probe
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self.preferred = None
+        self._failures = dict((endpoint, 0) for endpoint in endpoints)
+        # Endpoints with open circuits to the call to probe them
+        self._open = {}
+
+    def is_open(self, endpoint):
+        return endpoint in self._open
+
+    def ordered(self):
+        """
+        Get the endpoints in the order they should be tried: the preferred
+        endpoint, then the others with closed circuits in priority order,
+        then those with open circuits as a last resort.
+        """
+        closed = [e for e in self.endpoints if not self.is_open(e)]
+        if self.preferred in closed:
+            closed.remove(self.preferred)
+            closed.insert(0, self.preferred)
+        return closed + [e for e in self.endpoints if self.is_open(e)]
+
+    def prefer(self, endpoint):
+        """
+        Prefer an endpoint for requests until it fails.
+        """
+        self.preferred = endpoint
+
+    def succeeded(self, endpoint):
+        """
+        Record that a request to an endpoint succeeded, closing its circuit
+        and preferring it.
+        """
+        self._close(endpoint)
+        self.preferred = endpoint
+
+    def failed(self, endpoint):
+        """
+        Record that a request to an endpoint failed, opening its circuit if
+        it has failed too many times in a row.
+        """
+        if self.preferred == endpoint:
+            self.preferred = None
+
+        self._failures[endpoint] += 1
+        if (self._failure_threshold is None or self.is_open(endpoint) or
+                self._failures[endpoint] < self._failure_threshold):
+            return
+
+        self.log.warn(
+            'Endpoint {endpoint} failed {failures} times in a row, only '
+            'trying it as a last resort until it recovers',
+            endpoint=endpoint, failures=self._failures[endpoint])
+        self._schedule_probe(endpoint)
+
+    def _close(self, endpoint):
+        self._failures[endpoint] = 0
+        call = self._open.pop(endpoint, None)
+        if call is None:
+            return
+
+        if call.active():
+            call.cancel()
+        self.log.info('Endpoint {endpoint} recovered', endpoint=endpoint)
+
+    def _schedule_probe(self, endpoint):
+        self._open[endpoint] = self._clock.callLater(
+            self._reset_timeout, self._run_probe, endpoint)
+
+    def _run_probe(self, endpoint):
+        def probe_failed(failure):
+            self.log.debug('Probe of endpoint {endpoint} failed: {message}',
+                           endpoint=endpoint,
+                           message=failure.getErrorMessage())
+            # The circuit may have been closed by a request meanwhile
+            if self.is_open(endpoint):
+                self._schedule_probe(endpoint)
+
+        d = self._probe(endpoint)
+        d.addCallbacks(lambda _: self._close(endpoint), probe_failed)
+        return d
+
+    def stop(self):
+        """
+        Stop probing endpoints with open circuits.
+        """
+        for call in self._open.values():
+            if call.active():
+                call.cancel()
@@ -11,20 +11,45 @@ from zope.interface import implementer
 
 
 def default_client(reactor, client=None, agent=None, contextFactory=None,
-                   pool=None, persistent=False):
+                   pool=None, persistent=True):
     reactor = _default_reactor(reactor)
 
     if client is not None:
         return client, reactor
 
     if agent is None:
-        pool = HTTPConnectionPool(reactor, persistent=persistent)
+        if pool is None:
+            pool = default_pool(reactor, persistent=persistent)
         contextFactory = _default_contextFactory(contextFactory)
         agent = Agent(reactor, contextFactory=contextFactory, pool=pool)
 
     return HTTPClient(agent), reactor
 
 
+def default_pool(reactor, persistent=True, max_persistent_per_host=None,
+                 idle_timeout=None):
+    """
+    Create a connection pool. Persistent pools keep connections open after
+    requests so that later requests to the same host skip the TCP and TLS
+    handshakes. A single pool can be shared by clients for different hosts.
+
+    :param max_persistent_per_host:
+        The maximum number of idle connections to keep open to each host. If
+        None, Twisted's default is used.
+    :param idle_timeout:
+        Amount of time in seconds after which an idle connection is closed. If
+        None, Twisted's default is used.
+    """
+    reactor = _default_reactor(reactor)
+
+    pool = HTTPConnectionPool(reactor, persistent=persistent)
+    if max_persistent_per_host is not None:
+        pool.maxPersistentPerHost = max_persistent_per_host
+    if idle_timeout is not None:
+        pool.cachedConnectionTimeout = idle_timeout
+    return pool
+
+
 def _default_reactor(reactor=None):
     if reactor is None:
         from twisted.internet import reactor
@@ -0,0 +1,153 @@
+from twisted.internet.defer import Deferred, FirstError, gatherResults
+from twisted.internet.endpoints import connectProtocol
+from twisted.internet.protocol import Protocol
+from twisted.logger import Logger
+
+
+class HAProxyRuntimeError(Exception):
+    """
+    Raised when HAProxy's runtime API responds to a command with an error.
+    """
+
+
+class UnknownCertificateError(HAProxyRuntimeError):
+    """
+    Raised when HAProxy doesn't know about a certificate, i.e. it isn't
+    referenced by the HAProxy configuration, and so can't be updated through
+    the runtime API.
+    """
+
+
+class _RuntimeCommandProtocol(Protocol):
+    """
+    Send a single command to the HAProxy runtime API in non-interactive mode
+    and collect the response. HAProxy closes the connection once it has
+    responded.
+    """
+
+    def __init__(self, command):
+        self._command = command
+        self._data = []
+        self.finished = Deferred(self._cancel)
+
+    def _cancel(self, d):
+        # Give up on the response, e.g. after a timeout
+        if self.transport is not None:
+            self.transport.abortConnection()
+
+    def connectionMade(self):
+        self.transport.write(self._command)
+
+    def dataReceived(self, data):
+        self._data.append(data)
+
+    def connectionLost(self, reason):
+        if not self.finished.called:
+            self.finished.callback(b''.join(self._data).decode('utf-8'))
+
+
+def _unwrap_first_error(failure):
+    failure.trap(FirstError)
+    return failure.value.subFailure
+
+
+class HAProxyRuntimeClient(object):
+    """
+    Client for updating certificates in running HAProxy processes through the
+    HAProxy (>= 2.1) runtime API, also known as the stats socket.
+    """
+
+    log = Logger()
+
+    def __init__(self, endpoints, clock=None, timeout=10):
+        """
+        :param endpoints:
+            The list of ``IStreamClientEndpoint`` providers to connect to the
+            runtime API of each HAProxy process with. All processes are
+            updated at once.
+        :param clock:
+            The ``IReactorTime`` provider to use for timeouts. If None,
+            commands don't time out.
+        :param timeout:
+            Amount of time in seconds to wait for a response to a command.
+        """
+        self.endpoints = endpoints
+        self._clock = clock
+        self._timeout = timeout
+
+    def command(self, endpoint, command, payload=None):
+        """
+        Send a command to a single HAProxy process.
+
+        :param endpoint: The endpoint for the process's runtime API.
+        :param str command: The command to send.
+        :param str payload:
+            A payload to send with the command, for commands that take one.
+        :return: A Deferred that fires with the response text.
+        """
+        data = command
+        if payload is not None:
+            # The payload is terminated by an empty line, so it mustn't
+            # contain one itself
+            lines = [line for line in payload.splitlines() if line.strip()]
+            data += ' <<\n' + '\n'.join(lines) + '\n'
+        data += '\n'
+
+        protocol = _RuntimeCommandProtocol(data.encode('utf-8'))
+        d = connectProtocol(endpoint, protocol)
+        d.addCallback(lambda _: protocol.finished)
+        if self._clock is not None:
+            d.addTimeout(self._timeout, self._clock)
+        return d
+
+    def update_cert(self, path, pem_data):
+        """
+        Replace a certificate in all the HAProxy processes without reloading
+        them.
+
+        :param str path:
+            The path of the certificate file as HAProxy knows it.
+        :param str pem_data: The new PEM-encoded certificate and key.
+        :raises UnknownCertificateError:
+            If any HAProxy process doesn't know about the certificate. HAProxy
+            must be reloaded to pick up new certificates.
+        """
+        d = gatherResults(
+            [self._update_cert(e, path, pem_data) for e in self.endpoints],
+            consumeErrors=True)
+        d.addErrback(_unwrap_first_error)
+        return d
+
+    def _update_cert(self, endpoint, path, pem_data):
+        d = self.command(endpoint, 'set ssl cert ' + path, payload=pem_data)
+
+        def check_set(response):
+            if 'Transaction created' in response or (
+                    'Transaction updated' in response):
+                return self.command(endpoint, 'commit ssl cert ' + path)
+
+            if 'not referenced by the configuration' in response:
+                raise UnknownCertificateError(
+                    "HAProxy doesn't know about certificate '%s'" % (path,))
+            raise HAProxyRuntimeError(
+                "Failed to set certificate '%s': %s" % (
+                    path, response.strip()))
+
+        def check_commit(response):
+            if 'Success!' in response:
+                self.log.debug("Updated certificate '{path}' in HAProxy",
+                               path=path)
+                return response
+
+            # Don't leave the transaction open
+            d = self.command(endpoint, 'abort ssl cert ' + path)
+            d.addBoth(lambda _: self._raise_commit_error(path, response))
+            return d
+
+        d.addCallback(check_set)
+        d.addCallback(check_commit)
+        return d
+
+    def _raise_commit_error(self, path, response):
+        raise HAProxyRuntimeError(
+            "Failed to commit certificate '%s': %s" % (path, response.strip()))
@@ -1,15 +1,23 @@
 import json
+import math
+from collections import deque
 
 from requests.exceptions import HTTPError
 
 from treq.content import json_content
 
+from twisted.internet.defer import Deferred, FirstError, gatherResults
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
 from twisted.web.http import OK
 
-from uritools import uridecode
+from uritools import uridecode, urisplit
 
 from marathon_acme.clients._base import (
     HTTPClient, raise_for_header, raise_for_status)
+from marathon_acme.clients._circuit import EndpointCircuits
+from marathon_acme.json_stream import json_array_field_content
+from marathon_acme.metrics import EVENTS
 from marathon_acme.sse_protocol import SseProtocol
 
 
@@ -56,23 +64,107 @@ def sse_content(response, handler, **sse_kwargs):
     return finished
 
 
+def _endpoint_address(endpoint):
+    """
+    Get the ``host:port`` address of an endpoint, in the form Marathon gives
+    the address of the leader in.
+    """
+    parts = urisplit(endpoint)
+    port = parts.getport(default=443 if parts.scheme == 'https' else 80)
+    return '%s:%d' % (parts.gethost(), port)
+
+
+class _DiscardProtocol(Protocol):
+    """
+    A protocol that stops a response body from being received.
+    """
+
+    def connectionMade(self):
+        self.transport.stopProducing()
+
+
 class MarathonClient(HTTPClient):
-    def __init__(self, endpoints, sse_kwargs=None, **kwargs):
+    metrics_client = 'marathon'
+
+    # The number of request latencies to take the hedge delay percentile of
+    HEDGE_SAMPLES = 100
+    # The number of request latencies needed before using the percentile
+    HEDGE_MIN_SAMPLES = 10
+
+    def __init__(self, endpoints, sse_kwargs=None, failure_threshold=3,
+                 reset_timeout=30, leader_routing=False, hedge_percentile=None,
+                 hedge_delay=1, **kwargs):
         """
         :param endpoints:
             A priority-ordered list of Marathon endpoints. Each endpoint will
             be tried one-by-one until the request succeeds or all endpoints
-            fail.
+            fail. Requests stick to the last endpoint that worked.
+        :param failure_threshold:
+            The number of consecutive failures after which an endpoint is only
+            tried as a last resort, until a background probe of it succeeds.
+            If None, endpoints are always tried in priority order.
+        :param reset_timeout:
+            Amount of time in seconds to wait between probes of an endpoint
+            that has failed too many times.
+        :param leader_routing:
+            Whether to ask Marathon which instance is the leader and prefer
+            the endpoint for that instance, if it is one of the endpoints,
+            saving the non-leader instances from proxying requests to it.
+        :param hedge_percentile:
+            If given, requests that are hedged send the same request to the
+            next endpoint if no response headers have been received within
+            this percentile of the latencies of recent requests. Whichever
+            response is received first is used and the other request is
+            cancelled. If None, requests are never hedged.
+        :param hedge_delay:
+            The delay in seconds before hedging a request until enough
+            requests have been made to take the percentile of, and the
+            minimum delay after that.
         """
         super(MarathonClient, self).__init__(**kwargs)
         self.endpoints = endpoints
         self._sse_kwargs = {} if sse_kwargs is None else sse_kwargs
+        # Set to False if Marathon rejects label selectors
+        self._label_selectors_supported = True
+
+        self._circuits = EndpointCircuits(
+            endpoints, self._reactor, self._probe,
+            failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self._leader_routing = leader_routing
+        self._leader_resolved = False
+
+        self._hedge_percentile = hedge_percentile
+        self._hedge_delay = hedge_delay
+        self._latencies = deque(maxlen=self.HEDGE_SAMPLES)
+        self._cancelling_hedges = False
 
     def request(self, *args, **kwargs):
-        d = self._request(None, list(self.endpoints), *args, **kwargs)
+        """
+        Make a request to each endpoint in turn until one succeeds.
+
+        :param hedged:
+            Whether to hedge the request if hedging is enabled. Should only be
+            used for idempotent requests.
+        """
+        hedged = kwargs.pop('hedged', False)
+        if self._leader_routing and not self._leader_resolved:
+            # Resolve the leader (again) before the first request, and after
+            # the preferred endpoint fails
+            self._leader_resolved = True
+            d = self.resolve_leader()
+            d.addCallback(
+                lambda _: self._dispatch(hedged, *args, **kwargs))
+        else:
+            d = self._dispatch(hedged, *args, **kwargs)
         d.addErrback(self._log_all_endpoints_failed)
         return d
 
+    def _dispatch(self, hedged, *args, **kwargs):
+        endpoints = self._circuits.ordered()
+        if hedged and self._hedge_percentile is not None:
+            return self._hedged_request(endpoints, *args, **kwargs)
+        return self._request(None, endpoints, *args, **kwargs)
+
     def _request(self, failure, endpoints, *args, **kwargs):
         """
         Recursively make requests to each endpoint in ``endpoints``.
@@ -82,13 +174,171 @@ class MarathonClient(HTTPClient):
             return failure
 
         endpoint = endpoints.pop(0)
-        d = super(MarathonClient, self).request(*args, url=endpoint, **kwargs)
+        d = self._endpoint_request(endpoint, *args, **kwargs)
 
         # If something goes wrong, call ourselves again with the remaining
         # endpoints
         d.addErrback(self._request, endpoints, *args, **kwargs)
         return d
 
+    def _endpoint_request(self, endpoint, *args, **kwargs):
+        """
+        Make a request to a single endpoint, keeping track of its health.
+        """
+        started = self._reactor.seconds()
+        d = super(MarathonClient, self).request(*args, url=endpoint, **kwargs)
+        d.addCallbacks(
+            self._endpoint_succeeded, self._endpoint_failed,
+            callbackArgs=[endpoint, started], errbackArgs=[endpoint])
+        return d
+
+    def _endpoint_succeeded(self, response, endpoint, started):
+        self._latencies.append(self._reactor.seconds() - started)
+        self._circuits.succeeded(endpoint)
+        return response
+
+    def _endpoint_failed(self, failure, endpoint):
+        if self._cancelling_hedges:
+            # Cancelling a slower request is no fault of the endpoint
+            return failure
+        if endpoint == self._circuits.preferred:
+            self._leader_resolved = False
+        self._circuits.failed(endpoint)
+        return failure
+
+    def _hedge_after(self):
+        """
+        Get the amount of time to wait for a response before hedging a
+        request.
+        """
+        if len(self._latencies) < self.HEDGE_MIN_SAMPLES:
+            return self._hedge_delay
+
+        latencies = sorted(self._latencies)
+        index = int(math.ceil(
+            self._hedge_percentile / 100.0 * len(latencies))) - 1
+        return max(latencies[max(index, 0)], self._hedge_delay)
+
+    def _hedged_request(self, endpoints, *args, **kwargs):
+        """
+        Make a request to each endpoint in ``endpoints`` in turn, but if no
+        response is received from an endpoint in time, also make the request
+        to the next endpoint. The first response received is used and any
+        other requests still in progress are cancelled.
+        """
+        in_flight = []
+        state = {'call': None, 'done': False}
+
+        def cancel(_):
+            state['done'] = True
+            cancel_call()
+            cancel_in_flight()
+
+        result = Deferred(cancel)
+
+        def cancel_call():
+            call = state['call']
+            if call is not None and call.active():
+                call.cancel()
+
+        def cancel_in_flight():
+            self._cancelling_hedges = True
+            try:
+                for d in list(in_flight):
+                    d.cancel()
+            finally:
+                self._cancelling_hedges = False
+
+        def hedge():
+            self.log.debug(
+                'No response from Marathon after {delay:.3f}s, hedging the '
+                'request', delay=delay)
+            attempt()
+
+        def attempt():
+            endpoint = endpoints.pop(0)
+            d = self._endpoint_request(endpoint, *args, **kwargs)
+            in_flight.append(d)
+            d.addBoth(finished, d)
+            # A request that failed straight away will already have fallen
+            # back to the next endpoint, which may have finished the request
+            if state['done']:
+                return
+
+            cancel_call()
+            if endpoints:
+                state['call'] = self._reactor.callLater(delay, hedge)
+
+        def finished(response, d):
+            in_flight.remove(d)
+            if state['done']:
+                # Lost the race: the request was cancelled, or the response
+                # arrived at the same time as the winner's
+                if not isinstance(response, Failure):
+                    response.deliverBody(_DiscardProtocol())
+                return None
+
+            if isinstance(response, Failure):
+                # Fall back as usual if nothing else is in flight, or fail if
+                # there's nothing to fall back to
+                if endpoints and not in_flight:
+                    attempt()
+                elif not in_flight:
+                    state['done'] = True
+                    cancel_call()
+                    result.errback(response)
+                return None
+
+            state['done'] = True
+            cancel_call()
+            cancel_in_flight()
+            result.callback(response)
+
+        delay = self._hedge_after()
+        attempt()
+        return result
+
+    def _probe(self, endpoint):
+        """
+        Check whether an endpoint works by pinging it.
+        """
+        d = super(MarathonClient, self).request(
+            'GET', url=endpoint, path='/ping')
+        return d.addCallback(raise_for_status)
+
+    def resolve_leader(self):
+        """
+        Ask Marathon which instance is the leader and prefer the endpoint for
+        it, if there is one. Never fails: if the leader can't be resolved,
+        the endpoints are just tried in the usual order.
+        """
+        d = self.get_json_field('leader', path='/v2/leader')
+        d.addCallback(self._prefer_leader)
+
+        def log_failure(failure):
+            self.log.warn('Unable to resolve the Marathon leader: {message}',
+                          message=failure.getErrorMessage())
+        return d.addErrback(log_failure)
+
+    def _prefer_leader(self, leader):
+        for endpoint in self.endpoints:
+            if _endpoint_address(endpoint) == leader:
+                self.log.info(
+                    'Preferring endpoint {endpoint} of the Marathon leader',
+                    endpoint=endpoint)
+                self._circuits.prefer(endpoint)
+                return
+
+        self.log.debug(
+            'The Marathon leader {leader} is not one of the endpoints',
+            leader=leader)
+
+    def _log_request_error(self, failure, url):
+        if self._cancelling_hedges:
+            self.log.debug('Cancelled hedged request to url "{url}"', url=url)
+            return failure
+        return super(MarathonClient, self)._log_request_error(failure, url)
+
     def _log_all_endpoints_failed(self, failure):
         # Just log an error so it is clear what has happened and return the
         # final failure. Individual failures should have been logged via
@@ -133,12 +383,93 @@ class MarathonClient(HTTPClient):
 
         return response_json[field_name]
 
-    def get_apps(self):
+    def stream_json_field(self, field, handler, **kwargs):
+        """
+        Perform a GET request and decode the JSON response as it is received,
+        passing each item in the array in a field of the response to a
+        handler. Unlike ``get_json_field``, the whole response is never held
+        in memory at once.
+
+        :return:
+            A Deferred that fires with the number of items once the whole
+            response has been received.
+        """
+        d = self.request(
+            'GET', headers={'Accept': 'application/json'}, unbuffered=True,
+            hedged=True, **kwargs)
+        d.addCallback(raise_for_status)
+        d.addCallback(raise_for_header, 'Content-Type', 'application/json')
+        d.addCallback(json_array_field_content, field, handler)
+        return d
+
+    def get_apps(self, labels=None):
         """
         Get the currently running Marathon apps, returning a list of app
         definitions.
+
+        :param labels:
+            A list of label names. If given, only the apps that have at least
+            one of the labels are fetched. See ``stream_apps``.
+        """
+        apps = []
+        app_ids = set()
+
+        def add_app(app):
+            # Apps with more than one of the labels are fetched more than once
+            if app['id'] not in app_ids:
+                app_ids.add(app['id'])
+                apps.append(app)
+
+        d = self.stream_apps(add_app, labels=labels)
+        return d.addCallback(lambda _: apps)
+
+    def stream_apps(self, handler, labels=None):
+        """
+        Get the currently running Marathon apps, passing each app definition
+        to a handler as soon as it has been received, so that the app
+        definitions don't all need to be held in memory at once.
+
+        :param handler:
+            A 1-arg callable that will be called back with each app
+            definition. It may be called more than once for an app.
+        :param labels:
+            A list of label names. If given, only the apps that have at least
+            one of the labels are fetched, using a label selector request for
+            each label. If Marathon rejects the label selectors, all the apps
+            are fetched instead, for this and any later requests.
+        :return:
+            A Deferred that fires once all the apps have been received.
         """
-        return self.get_json_field('apps', path='/v2/apps')
+        if not labels or not self._label_selectors_supported:
+            d = self.stream_json_field('apps', handler, path='/v2/apps')
+            return d.addCallback(lambda _: None)
+
+        d = gatherResults([
+            self.stream_json_field(
+                'apps', handler, path='/v2/apps', params={'label': label})
+            for label in labels
+        ], consumeErrors=True)
+        d.addCallbacks(
+            lambda _: None, self._label_selectors_failed,
+            errbackArgs=[handler])
+        return d
+
+    def _label_selectors_failed(self, failure, handler):
+        failure.trap(FirstError)
+        failure = failure.value.subFailure
+
+        # Marathon versions without label selectors reject them as bad
+        # requests. Anything else is a real failure.
+        response = getattr(failure.value, 'response', None)
+        if (not failure.check(HTTPError) or response is None or
+                not 400 <= response.code < 500):
+            return failure
+
+        self.log.warn(
+            'Marathon rejected the label selectors with a {code} response, '
+            'fetching all apps instead', code=response.code)
+        self._label_selectors_supported = False
+        return self.stream_apps(handler)
 
     def get_events(self, callbacks):
         """
@@ -148,7 +479,7 @@ class MarathonClient(HTTPClient):
             A dict mapping event types to functions that handle the event data
         """
         d = self.request(
-            'GET', path='/v2/events', unbuffered=True,
+            'GET', path='/v2/events', unbuffered=True, hedged=True,
             # The event_type parameter was added in Marathon 1.3.7. It can be
             # used to specify which event types we are interested in. On older
             # versions of Marathon it is ignored, and we ignore events we're
@@ -160,6 +491,7 @@ class MarathonClient(HTTPClient):
             })
 
         def handler(event, data):
+            EVENTS.labels(event).inc()
             callback = callbacks.get(event)
             # Deserialize JSON if a callback is present
             if callback is not None:
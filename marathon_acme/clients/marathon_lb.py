@@ -2,6 +2,7 @@ from twisted.internet.defer import DeferredList
 from twisted.logger import LogLevel
 
 from marathon_acme.clients._base import HTTPClient, raise_for_status
+from marathon_acme.metrics import MLB_SIGNALS
 
 
 class MarathonLbClient(HTTPClient):
@@ -10,6 +11,8 @@ class MarathonLbClient(HTTPClient):
     marathon-lb.
     """
 
+    metrics_client = 'marathon_lb'
+
     def __init__(self, endpoints, *args, **kwargs):
         """
         :param endpoints:
@@ -76,11 +79,31 @@ class MarathonLbClient(HTTPClient):
         Trigger a SIGHUP signal to be sent to marathon-lb. Causes a full reload
         of the config as though a relevant event was received from Marathon.
         """
-        return self.request('POST', path='/_mlb_signal/hup')
+        return self._signal('hup')
 
     def mlb_signal_usr1(self):
         """
         Trigger a SIGUSR1 signal to be sent to marathon-lb. Causes the existing
         config to be reloaded, whether it has changed or not.
         """
-        return self.request('POST', path='/_mlb_signal/usr1')
+        return self._signal('usr1')
+
+    def _signal(self, signal):
+        """
+        Trigger a signal to be sent to marathon-lb and count the results for
+        each marathon-lb instance.
+        """
+        d = self.request('POST', path='/_mlb_signal/' + signal)
+
+        def count_results(responses):
+            for endpoint, response in zip(self.endpoints, responses):
+                result = 'failure' if response is None else 'success'
+                MLB_SIGNALS.labels(signal, endpoint, result).inc()
+            return responses
+
+        def count_failure(failure):
+            for endpoint in self.endpoints:
+                MLB_SIGNALS.labels(signal, endpoint, 'failure').inc()
+            return failure
+
+        return d.addCallbacks(count_results, count_failure)
@@ -4,6 +4,8 @@ from testtools.matchers import Equals, Is, IsInstance, MatchesStructure
 from testtools.twistedsupport import failed, flush_logged_errors
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
 from twisted.web.http_headers import Headers
 
 from txfake.fake_connection import wait0
@@ -16,6 +18,52 @@ from marathon_acme.tests.helpers import failing_client
 from marathon_acme.tests.matchers import HasHeader, WithErrorTypeAndMessage
 
 
+class FakeRequest(object):
+    def __init__(self, absoluteURI):
+        self.absoluteURI = absoluteURI
+
+
+class FakeResponse(object):
+    """
+    A response with a body that records whether the body has been read.
+    """
+
+    def __init__(self, code, body):
+        self.code = code
+        self.length = len(body)
+        self.request = FakeRequest(b'http://localhost/hello')
+        self._body = body
+        self.body_read = False
+
+    def deliverBody(self, protocol):
+        self.body_read = True
+        protocol.dataReceived(self._body)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+class TestRaiseForStatus(object):
+    def test_success(self):
+        """
+        When the response succeeded, the response is returned and its body
+        isn't read.
+        """
+        response = FakeResponse(200, b'Hello')
+        assert_that(raise_for_status(response), Is(response))
+        assert_that(response.body_read, Equals(False))
+
+    def test_error_reads_body(self):
+        """
+        When the response did not succeed, its body is read so that the
+        connection can be reused before an HTTPError is raised.
+        """
+        response = FakeResponse(404, b'Not found\n')
+        assert_that(raise_for_status(response), failed(
+            WithErrorTypeAndMessage(
+                HTTPError,
+                '404 Client Error for url: http://localhost/hello')))
+        assert_that(response.body_read, Equals(True))
+
+
 class TestGetSingleHeader(object):
     def test_single_value(self):
         """
@@ -0,0 +1,132 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from marathon_acme.clients._circuit import EndpointCircuits
+
+ENDPOINTS = ['http://m1:8080', 'http://m2:8080', 'http://m3:8080']
+
+
+class TestEndpointCircuits(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.probes = []
+        self.circuits = EndpointCircuits(
+            ENDPOINTS, self.clock, self.probe, failure_threshold=2,
+            reset_timeout=10)
+
+    def probe(self, endpoint):
+        d = Deferred()
+        self.probes.append((endpoint, d))
+        return d
+
+    def test_priority_order(self):
+        """
+        When no requests have been made, the endpoints are in priority order.
+        """
+        assert_that(self.circuits.ordered(), Equals(ENDPOINTS))
+
+    def test_sticky(self):
+        """
+        When a request to an endpoint succeeds, that endpoint is tried first
+        until it fails.
+        """
+        self.circuits.succeeded('http://m2:8080')
+        assert_that(self.circuits.ordered(), Equals(
+            ['http://m2:8080', 'http://m1:8080', 'http://m3:8080']))
+
+        self.circuits.failed('http://m2:8080')
+        assert_that(self.circuits.ordered(), Equals(ENDPOINTS))
+
+    def test_opens_after_threshold(self):
+        """
+        When an endpoint fails as many times in a row as the threshold, it is
+        only tried as a last resort.
+        """
+        self.circuits.failed('http://m1:8080')
+        assert_that(self.circuits.ordered(), Equals(ENDPOINTS))
+        assert not self.circuits.is_open('http://m1:8080')
+
+        self.circuits.failed('http://m1:8080')
+        assert self.circuits.is_open('http://m1:8080')
+        assert_that(self.circuits.ordered(), Equals(
+            ['http://m2:8080', 'http://m3:8080', 'http://m1:8080']))
+
+    def test_success_resets_failures(self):
+        """
+        When an endpoint succeeds between failures, its circuit is not opened.
+        """
+        self.circuits.failed('http://m1:8080')
+        self.circuits.succeeded('http://m1:8080')
+        self.circuits.failed('http://m1:8080')
+
+        assert not self.circuits.is_open('http://m1:8080')
+
+    def test_probe_closes(self):
+        """
+        When the circuit for an endpoint is open, the endpoint is probed after
+        the reset timeout, and the circuit is closed if the probe succeeds.
+        """
+        self.circuits.failed('http://m1:8080')
+        self.circuits.failed('http://m1:8080')
+        assert self.probes == []
+
+        self.clock.advance(10)
+        [(endpoint, d)] = self.probes
+        assert endpoint == 'http://m1:8080'
+
+        d.callback(None)
+        assert not self.circuits.is_open('http://m1:8080')
+        assert_that(self.circuits.ordered(), Equals(ENDPOINTS))
+        assert self.clock.getDelayedCalls() == []
+
+    def test_probe_fails(self):
+        """
+        When the circuit for an endpoint is open and a probe of the endpoint
+        fails, the endpoint is probed again after the reset timeout.
+        """
+        self.circuits.failed('http://m1:8080')
+        self.circuits.failed('http://m1:8080')
+
+        self.clock.advance(10)
+        [(_, d)] = self.probes
+        d.errback(RuntimeError('still down'))
+        assert self.circuits.is_open('http://m1:8080')
+
+        self.clock.advance(10)
+        assert len(self.probes) == 2
+
+    def test_request_closes(self):
+        """
+        When the circuit for an endpoint is open and a request to the endpoint
+        succeeds, the circuit is closed and the probe cancelled.
+        """
+        self.circuits.failed('http://m1:8080')
+        self.circuits.failed('http://m1:8080')
+
+        self.circuits.succeeded('http://m1:8080')
+        assert not self.circuits.is_open('http://m1:8080')
+        assert self.clock.getDelayedCalls() == []
+
+    def test_no_threshold(self):
+        """
+        When there is no failure threshold, circuits are never opened.
+        """
+        circuits = EndpointCircuits(
+            ENDPOINTS, self.clock, self.probe, failure_threshold=None)
+        for _ in range(10):
+            circuits.failed('http://m1:8080')
+
+        assert not circuits.is_open('http://m1:8080')
+        assert_that(circuits.ordered(), Equals(ENDPOINTS))
+
+    def test_prefer(self):
+        """
+        When an endpoint is preferred, it is tried first unless its circuit
+        is open.
+        """
+        self.circuits.prefer('http://m3:8080')
+        assert_that(self.circuits.ordered(), Equals(
+            ['http://m3:8080', 'http://m1:8080', 'http://m2:8080']))
@@ -19,7 +19,8 @@ from twisted.web._newclient import ResponseNeverReceived
 from twisted.web.client import Agent, HTTPConnectionPool
 from twisted.web.server import Site
 
-from marathon_acme.clients._tx_util import ClientPolicyForHTTPS, default_client
+from marathon_acme.clients._tx_util import (
+    ClientPolicyForHTTPS, default_client, default_pool)
 from marathon_acme.clients.tests.helpers import QueueResource
 
 
@@ -47,9 +48,9 @@ class TestDefaultClientFunc(object):
         assert agent._reactor is reactor
         pool = agent._pool
 
-        # The agent has a connection pool that is not persistent
+        # The agent has a connection pool that is persistent
         assert isinstance(pool, HTTPConnectionPool)
-        assert not pool.persistent
+        assert pool.persistent
         # NOTE: Accessing Twisted HTTPConnectionPool internals :-(
         assert pool._reactor is reactor
 
@@ -101,7 +102,7 @@ class TestDefaultClientFunc(object):
         contextFactory = ClientPolicyForHTTPS()
 
         client, actual_reactor = default_client(
-            reactor, persistent=True, contextFactory=contextFactory)
+            reactor, persistent=False, contextFactory=contextFactory)
 
         # NOTE: Accessing treq HTTPClient internals :-(
         agent = client._agent
@@ -112,10 +113,55 @@ class TestDefaultClientFunc(object):
         pool = agent._pool
 
         assert isinstance(pool, HTTPConnectionPool)
+        assert not pool.persistent
+        # NOTE: Accessing Twisted HTTPConnectionPool internals :-(
+        assert pool._reactor is reactor
+
+    def test_pool_provided(self):
+        """
+        When default_client is passed a pool, it should create an agent that
+        uses that pool.
+        """
+        reactor = Clock()
+        pool = HTTPConnectionPool(reactor)
+
+        client, _ = default_client(reactor, pool=pool)
+
+        # NOTE: Accessing treq HTTPClient & Twisted _AgentBase internals :-(
+        assert client._agent._pool is pool
+
+
+class TestDefaultPoolFunc(object):
+    def test_defaults(self):
+        """
+        When only a reactor is passed to default_pool, a persistent pool is
+        created with Twisted's default limits.
+        """
+        reactor = Clock()
+
+        pool = default_pool(reactor)
+
         assert pool.persistent
+        assert pool.maxPersistentPerHost == (
+            HTTPConnectionPool.maxPersistentPerHost)
+        assert pool.cachedConnectionTimeout == (
+            HTTPConnectionPool.cachedConnectionTimeout)
         # NOTE: Accessing Twisted HTTPConnectionPool internals :-(
         assert pool._reactor is reactor
 
+    def test_limits(self):
+        """
+        When default_pool is passed limits, the pool is created with those
+        limits.
+        """
+        pool = default_pool(
+            Clock(), persistent=False, max_persistent_per_host=5,
+            idle_timeout=30)
+
+        assert not pool.persistent
+        assert pool.maxPersistentPerHost == 5
+        assert pool.cachedConnectionTimeout == 30
+
 
 FIXTURES = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'fixtures')
 CA_CERT = os.path.join(FIXTURES, 'ca.pem')
@@ -138,7 +184,9 @@ class TestClientPolicyForHTTPS(TestCase):
 
     def create_client(self, **policy_kwargs):
         policy = ClientPolicyForHTTPS.from_pem_files(**policy_kwargs)
-        client, _ = default_client(None, contextFactory=policy)
+        # Don't keep connections around after the tests
+        client, _ = default_client(
+            None, contextFactory=policy, persistent=False)
         return client
 
     def create_ssl_server_endpoint(
@@ -1,11 +1,12 @@
 import json
 
-from testtools.matchers import Equals
-from testtools.twistedsupport import failed, flush_logged_errors
+from testtools.matchers import Equals, Is
+from testtools.twistedsupport import failed, flush_logged_errors, succeeded
 
 from treq.client import HTTPClient as treq_HTTPClient
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import fail, inlineCallbacks, succeed
+from twisted.internet.task import Clock
 from twisted.web._newclient import ResponseDone
 
 from txfake.fake_connection import wait0
@@ -15,6 +16,7 @@ from marathon_acme.clients.marathon import MarathonClient
 from marathon_acme.clients.tests.helpers import (
     PerLocationAgent, TestHTTPClientBase)
 from marathon_acme.clients.tests.matchers import HasRequestProperties
+from marathon_acme.metrics import REGISTRY
 from marathon_acme.server import write_request_json
 from marathon_acme.tests.helpers import FailingAgent
 from marathon_acme.tests.matchers import HasHeader, WithErrorTypeAndMessage
@@ -112,6 +114,261 @@ class TestMarathonClient(TestHTTPClientBase):
 
         flush_logged_errors(RuntimeError)
 
+    @inlineCallbacks
+    def test_request_sticky(self):
+        """
+        When we make a request after an endpoint failed and the next endpoint
+        was used, the endpoint that worked is used first.
+        """
+        failing_agent = FailingAgent()
+        agent = PerLocationAgent()
+        agent.add_agent(b'localhost:8080', failing_agent)
+        agent.add_agent(b'localhost:9090', self.fake_server.get_agent())
+        client = MarathonClient(
+            ['http://localhost:8080', 'http://localhost:9090'],
+            client=treq_HTTPClient(agent))
+
+        d = self.cleanup_d(client.request('GET', path='/my-path'))
+        request = yield self.requests.get()
+        request.setResponseCode(200)
+        request.finish()
+        yield d
+
+        flush_logged_errors(RuntimeError)
+
+        # Make the first endpoint fail differently if it is tried again
+        failing_agent.error = ValueError('8080')
+        d = self.cleanup_d(client.request('GET', path='/my-path'))
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url='http://localhost:9090/my-path'))
+
+        request.setResponseCode(200)
+        request.finish()
+
+        yield d
+        self.assertThat(flush_logged_errors(ValueError), Equals([]))
+
+    @inlineCallbacks
+    def test_request_leader_routing(self):
+        """
+        When leader routing is enabled, the leader is resolved before the
+        first request and the request is made to the leader's endpoint.
+        """
+        agent = PerLocationAgent()
+        agent.add_agent(b'localhost:8080', self.fake_server.get_agent())
+        agent.add_agent(b'127.0.0.1:9090', self.fake_server.get_agent())
+        client = MarathonClient(
+            ['http://localhost:8080', 'http://127.0.0.1:9090'],
+            client=treq_HTTPClient(agent), leader_routing=True)
+
+        d = self.cleanup_d(client.request('GET', path='/my-path'))
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url='http://localhost:8080/v2/leader'))
+        json_response(request, {'leader': '127.0.0.1:9090'})
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url='http://127.0.0.1:9090/my-path'))
+
+        request.setResponseCode(200)
+        request.finish()
+
+        yield d
+
+    @inlineCallbacks
+    def test_request_leader_routing_failed(self):
+        """
+        When leader routing is enabled but the leader can't be resolved, the
+        endpoints are used in the usual order.
+        """
+        client = MarathonClient(
+            ['http://localhost:8080'], client=self.client._client,
+            leader_routing=True)
+
+        d = self.cleanup_d(client.request('GET', path='/my-path'))
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url='http://localhost:8080/v2/leader'))
+        request.setResponseCode(404)
+        request.finish()
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url='http://localhost:8080/my-path'))
+
+        request.setResponseCode(200)
+        request.finish()
+
+        yield d
+
+    def get_hedged_client(self, clock, agents):
+        agent = PerLocationAgent()
+        for location, location_agent in agents:
+            agent.add_agent(location, location_agent)
+        return MarathonClient(
+            ['http://localhost:8080', 'http://localhost:9090'],
+            client=treq_HTTPClient(agent), hedge_percentile=95, hedge_delay=1,
+            reactor=clock)
+
+    @inlineCallbacks
+    def test_request_hedged(self):
+        """
+        When we make a hedged request and no response is received from the
+        first endpoint within the hedge delay, the request is also made to the
+        next endpoint, and the first response received is used.
+        """
+        clock = Clock()
+        client = self.get_hedged_client(clock, [
+            (b'localhost:8080', self.fake_server.get_agent()),
+            (b'localhost:9090', self.fake_server.get_agent()),
+        ])
+
+        d = self.cleanup_d(
+            client.request('GET', path='/my-path', hedged=True))
+
+        slow_request = yield self.requests.get()
+        self.assertThat(slow_request, HasRequestProperties(
+            method='GET', url='http://localhost:8080/my-path'))
+
+        clock.advance(1)
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url='http://localhost:9090/my-path'))
+
+        request.setResponseCode(200)
+        request.finish()
+
+        response = yield d
+        self.assertThat(response.code, Equals(200))
+        self.assertThat(response.request.absoluteURI,
+                        Equals(b'http://localhost:9090/my-path'))
+        self.assertThat(clock.getDelayedCalls(), Equals([]))
+
+    @inlineCallbacks
+    def test_request_hedged_fast(self):
+        """
+        When we make a hedged request and a response is received from the
+        first endpoint within the hedge delay, the request is not made to the
+        next endpoint.
+        """
+        clock = Clock()
+        client = self.get_hedged_client(clock, [
+            (b'localhost:8080', self.fake_server.get_agent()),
+            (b'localhost:9090', self.fake_server.get_agent()),
+        ])
+
+        d = self.cleanup_d(
+            client.request('GET', path='/my-path', hedged=True))
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url='http://localhost:8080/my-path'))
+
+        request.setResponseCode(200)
+        request.finish()
+
+        yield d
+        clock.advance(1)
+        yield wait0()
+        self.assertThat(self.requests.pending, Equals([]))
+
+    @inlineCallbacks
+    def test_request_hedged_fallback(self):
+        """
+        When we make a hedged request and the first endpoint fails, the
+        request is made to the next endpoint without waiting for the hedge
+        delay.
+        """
+        clock = Clock()
+        client = self.get_hedged_client(clock, [
+            (b'localhost:8080', FailingAgent()),
+            (b'localhost:9090', self.fake_server.get_agent()),
+        ])
+
+        d = self.cleanup_d(
+            client.request('GET', path='/my-path', hedged=True))
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url='http://localhost:9090/my-path'))
+
+        request.setResponseCode(200)
+        request.finish()
+
+        yield d
+
+        flush_logged_errors(RuntimeError)
+
+    def test_hedge_delay_percentile(self):
+        """
+        Once enough requests have been made, requests are hedged after the
+        percentile of their latencies, but never sooner than the hedge delay.
+        """
+        client = self.get_hedged_client(Clock(), [])
+        self.assertThat(client._hedge_after(), Equals(1))
+
+        client._latencies.extend([0.5 * i for i in range(1, 21)])
+        self.assertThat(client._hedge_after(), Equals(9.5))
+
+        client._latencies.clear()
+        client._latencies.extend([0.1] * 20)
+        self.assertThat(client._hedge_after(), Equals(1))
+
+    @inlineCallbacks
+    def test_request_hedged_all_failed(self):
+        """
+        When we make a hedged request and all the endpoints fail, the last
+        failure is returned.
+        """
+        client = self.get_hedged_client(Clock(), [
+            (b'localhost:8080', FailingAgent(RuntimeError('8080'))),
+            (b'localhost:9090', FailingAgent(RuntimeError('9090'))),
+        ])
+
+        d = self.cleanup_d(
+            client.request('GET', path='/my-path', hedged=True))
+
+        yield wait0()
+        self.assertThat(d, failed(WithErrorTypeAndMessage(
+            RuntimeError, '9090')))
+
+        flush_logged_errors(RuntimeError)
+
+    def test_request_hedged_fallback_immediate(self):
+        """
+        When we make a hedged request and the first endpoint fails and the
+        next endpoint responds straight away, the request is not hedged to
+        any other endpoints.
+        """
+        clock = Clock()
+        client = MarathonClient(
+            ['http://m1:8080', 'http://m2:8080', 'http://m3:8080'],
+            client=treq_HTTPClient(PerLocationAgent()), hedge_percentile=95,
+            hedge_delay=1, reactor=clock)
+        response = object()
+        results = {
+            'http://m1:8080': lambda: fail(RuntimeError('m1')),
+            'http://m2:8080': lambda: succeed(response),
+        }
+        requested = []
+
+        def endpoint_request(endpoint, *args, **kwargs):
+            requested.append(endpoint)
+            return results[endpoint]()
+        client._endpoint_request = endpoint_request
+
+        d = client._hedged_request(
+            list(client.endpoints), 'GET', path='/my-path')
+        self.assertThat(d, succeeded(Is(response)))
+        self.assertThat(clock.getDelayedCalls(), Equals([]))
+        self.assertThat(
+            requested, Equals(['http://m1:8080', 'http://m2:8080']))
+
     @inlineCallbacks
     def test_get_json_field(self):
         """
@@ -281,6 +538,64 @@ class TestMarathonClient(TestHTTPClientBase):
         res = yield d
         self.assertThat(res, Equals(apps['apps']))
 
+    @inlineCallbacks
+    def test_get_apps_labels(self):
+        """
+        When we request the list of apps with some labels, a label selector
+        request is made for each label and the apps are merged so that each
+        app is only returned once.
+        """
+        d = self.cleanup_d(self.client.get_apps(labels=['FOO', 'BAR']))
+
+        app1 = {'id': '/app1', 'labels': {'FOO': 'a'}}
+        app2 = {'id': '/app2', 'labels': {'FOO': 'b', 'BAR': 'c'}}
+        app3 = {'id': '/app3', 'labels': {'BAR': 'd'}}
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/apps'), query={'label': ['FOO']}))
+        json_response(request, {'apps': [app1, app2]})
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/apps'), query={'label': ['BAR']}))
+        json_response(request, {'apps': [app2, app3]})
+
+        res = yield d
+        self.assertThat(sorted(res, key=lambda app: app['id']),
+                        Equals([app1, app2, app3]))
+
+    @inlineCallbacks
+    def test_get_apps_labels_unsupported(self):
+        """
+        When we request the list of apps with some labels, and Marathon
+        rejects the label selector, all the apps are requested instead, and
+        label selectors aren't used for later requests.
+        """
+        d = self.cleanup_d(self.client.get_apps(labels=['FOO']))
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/apps'), query={'label': ['FOO']}))
+        json_response(request, {'message': 'Invalid label selector'},
+                      response_code=400)
+
+        apps = {'apps': [{'id': '/app1', 'labels': {}}]}
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/apps'), query={}))
+        json_response(request, apps)
+
+        res = yield d
+        self.assertThat(res, Equals(apps['apps']))
+
+        d = self.cleanup_d(self.client.get_apps(labels=['FOO']))
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/apps'), query={}))
+        json_response(request, apps)
+        yield d
+
     @inlineCallbacks
     def test_get_events(self):
         """
@@ -315,6 +630,38 @@ class TestMarathonClient(TestHTTPClientBase):
         # Expect request.finish() to result in a logged failure
         flush_logged_errors(ResponseDone)
 
+    @inlineCallbacks
+    def test_get_events_metrics(self):
+        """
+        When events are received from Marathon's event stream, they are
+        counted by event type, whether or not there is a callback for them.
+        """
+        def count(event_type):
+            return REGISTRY.get_sample_value(
+                'marathon_acme_events_total',
+                {'event_type': event_type}) or 0
+        tests, not_tests = count('test'), count('not_test')
+
+        d = self.cleanup_d(self.client.get_events({'test': lambda _: None}))
+
+        request = yield self.requests.get()
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', 'text/event-stream')
+        for event_type in [b'test', b'not_test', b'test']:
+            request.write(b'event: ' + event_type + b'\n')
+            request.write(b'data: {}\n')
+            request.write(b'\n')
+
+        yield wait0()
+        self.assertThat(count('test'), Equals(tests + 2))
+        self.assertThat(count('not_test'), Equals(not_tests + 1))
+
+        request.finish()
+        yield d
+
+        # Expect request.finish() to result in a logged failure
+        flush_logged_errors(ResponseDone)
+
     @inlineCallbacks
     def test_get_events_no_callback(self):
         """
@@ -9,6 +9,7 @@ from marathon_acme.clients._base import HTTPError
 from marathon_acme.clients.marathon_lb import MarathonLbClient
 from marathon_acme.clients.tests.helpers import TestHTTPClientBase
 from marathon_acme.clients.tests.matchers import HasRequestProperties
+from marathon_acme.metrics import REGISTRY
 from marathon_acme.tests.matchers import HasHeader, WithErrorTypeAndMessage
 
 
@@ -165,3 +166,32 @@ class TestMarathonLbClient(TestHTTPClientBase):
             response_text = yield response.text()
             self.assertThat(response_text,
                             Equals('Sent SIGUSR1 signal to marathon-lb'))
+
+    @inlineCallbacks
+    def test_mlb_signal_metrics(self):
+        """
+        When a signal is sent to marathon-lb, the result for each marathon-lb
+        instance is counted.
+        """
+        def count(instance, result):
+            return REGISTRY.get_sample_value(
+                'marathon_acme_marathon_lb_signals_total',
+                {'signal': 'usr1', 'instance': instance,
+                 'result': result}) or 0
+        failures = count('http://lb1:9090', 'failure')
+        successes = count('http://lb2:9090', 'success')
+
+        d = self.cleanup_d(self.client.mlb_signal_usr1())
+
+        for code in [500, 200]:
+            request = yield self.requests.get()
+            request.setResponseCode(code)
+            request.finish()
+
+        yield d
+        self.assertThat(
+            count('http://lb1:9090', 'failure'), Equals(failures + 1))
+        self.assertThat(
+            count('http://lb2:9090', 'success'), Equals(successes + 1))
+
+        flush_logged_errors(HTTPError)
@@ -11,6 +11,7 @@ from treq.testing import StubTreq
 from marathon_acme.clients.tests.helpers import QueueResource
 from marathon_acme.clients.tests.matchers import HasRequestProperties
 from marathon_acme.clients.vault import CasError, VaultClient, VaultError
+from marathon_acme.metrics import REGISTRY
 from marathon_acme.server import write_request_json
 from marathon_acme.tests.helpers import read_request_json
 from marathon_acme.tests.matchers import HasHeader, WithErrorTypeAndMessage
@@ -76,6 +77,32 @@ class TestVaultClient(object):
         # Response should be returned
         assert_that(d, succeeded(Equals(dummy_response)))
 
+    def test_request_metrics(self):
+        """
+        When a request is made, the time taken is recorded against the
+        endpoint, which is the key/value path up to its first segment so that
+        every key doesn't get its own endpoint.
+        """
+        labels = {
+            'client': 'vault',
+            'method': 'GET',
+            'endpoint': '/v1/secret/data/certificates',
+            'result': '200',
+        }
+        count = REGISTRY.get_sample_value(
+            'marathon_acme_http_request_duration_seconds_count', labels) or 0
+
+        d = self.client.read_kv2('certificates/example.com')
+        request_d = self.requests.get()
+        assert_that(request_d, succeeded(HasRequestProperties(
+            method='GET', url='/v1/secret/data/certificates/example.com')))
+        self.json_response(request_d.result, {'data': {}})
+        assert_that(d, succeeded(Equals({'data': {}})))
+
+        assert_that(REGISTRY.get_sample_value(
+            'marathon_acme_http_request_duration_seconds_count', labels),
+            Equals(count + 1))
+
     def test_write(self):
         """
         When data is written, a PUT request is made with the data encoded as
@@ -335,6 +362,29 @@ class TestVaultClient(object):
             'check-and-set parameter did not match the current version'
         )))
 
+    def test_delete_kv2_metadata(self):
+        """
+        When the metadata for some data in the key/value version 2 API is
+        deleted, a DELETE request is made to the metadata path and nothing is
+        returned.
+        """
+        d = self.client.delete_kv2_metadata('hello')
+
+        request_d = self.requests.get()
+        assert_that(request_d, succeeded(MatchesAll(
+            HasRequestProperties(method='DELETE',
+                                 url='/v1/secret/metadata/hello'),
+            MatchesStructure(
+                requestHeaders=HasHeader('X-Vault-Token', [self.token]))
+        )))
+
+        request = request_d.result
+        request.setResponseCode(204)
+        request.finish()
+        self.stub_client.flush()
+
+        assert_that(d, succeeded(Is(None)))
+
     def test_from_env(self):
         """
         When the VaultClient is created from the environment, the Vault address
@@ -3,7 +3,7 @@ import os
 
 from requests.exceptions import RequestException
 
-from twisted.web.http import BAD_REQUEST, NOT_FOUND
+from twisted.web.http import BAD_REQUEST, NOT_FOUND, NO_CONTENT
 
 from marathon_acme.clients._base import HTTPClient, get_single_header
 from marathon_acme.clients._tx_util import ClientPolicyForHTTPS, default_client
@@ -33,6 +33,8 @@ class VaultClient(HTTPClient):
     A very simple Vault client that can read and write to paths.
     """
 
+    metrics_client = 'vault'
+
     def __init__(self, url, token, *args, **kwargs):
         """
         :param url: the URL for Vault
@@ -42,7 +44,7 @@ class VaultClient(HTTPClient):
         self._token = token
 
     @classmethod
-    def from_env(cls, reactor=None, env=os.environ):
+    def from_env(cls, reactor=None, env=os.environ, pool=None):
         """
         Create a Vault client with configuration from the environment. Supports
         a limited number of the available config options:
@@ -78,7 +80,8 @@ class VaultClient(HTTPClient):
             caKey=ca_cert, privateKey=client_key, certKey=client_cert,
             tls_server_name=tls_server_name
         )
-        client, reactor = default_client(reactor, contextFactory=cf)
+        client, reactor = default_client(
+            reactor, contextFactory=cf, pool=pool)
 
         return cls(address, token, client=client, reactor=reactor)
 
@@ -88,10 +91,23 @@ class VaultClient(HTTPClient):
         return super(VaultClient, self).request(
             method, *args, path=path, headers=headers, **kwargs)
 
+    def _metrics_endpoint(self, path):
+        # Drop everything after the first path segment of key/value version 2
+        # secret paths so that, e.g., each certificate doesn't get its own
+        # label value
+        parts = path.split('/')
+        if len(parts) > 5 and parts[3] in ['data', 'metadata']:
+            return '/'.join(parts[:5])
+        return path
+
     def _handle_response(self, response, check_cas=False):
         if 400 <= response.code < 600:
             return self._handle_error(response, check_cas)
 
+        # Some requests, like deletes, don't return a body
+        if response.code == NO_CONTENT:
+            return None
+
         return response.json()
 
     def _handle_error(self, response, check_cas):
@@ -142,6 +158,13 @@ class VaultClient(HTTPClient):
         d = self.request('PUT', '/v1/' + path, json=data)
         return d.addCallback(self._handle_response, check_cas=True)
 
+    def delete(self, path):
+        """
+        Delete data from Vault. Returns the JSON-decoded response, if any.
+        """
+        d = self.request('DELETE', '/v1/' + path)
+        return d.addCallback(self._handle_response)
+
     def read_kv2(self, path, version=None, mount_path='secret'):
         """
         Read some data from a key/value version 2 secret engine.
@@ -170,3 +193,11 @@ class VaultClient(HTTPClient):
 
         write_path = '{}/data/{}'.format(mount_path, path)
         return self.write(write_path, **params)
+
+    def delete_kv2_metadata(self, path, mount_path='secret'):
+        """
+        Delete the metadata and all versions of some data in a key/value
+        version 2 secret engine.
+        """
+        delete_path = '{}/metadata/{}'.format(mount_path, path)
+        return self.delete(delete_path)
@@ -0,0 +1,123 @@
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.logger import Logger
+
+
+class Coalescer(object):
+    """
+    Coalesce bursts of triggers into as few calls of a function as possible.
+
+    Each trigger waits for a quiet period in which no further triggers arrive
+    before the function is called, but never waits longer than the maximum
+    delay after the first trigger of a burst. At most one call runs at a time
+    and any triggers that arrive while a call is running are absorbed into a
+    single follow-up call.
+    """
+
+    log = Logger()
+
+    def __init__(self, func, clock, quiet_period=0, max_delay=None):
+        """
+        :param func:
+            The function to call. It is called with the number of triggers
+            that the call absorbed and may return a Deferred.
+        :param clock: The ``IReactorTime`` provider to use for delays.
+        :param quiet_period:
+            Amount of time in seconds to wait for triggers to stop arriving
+            before calling the function. If 0, the function is called as soon
+            as no other call is running.
+        :param max_delay:
+            Maximum amount of time in seconds to wait after the first trigger
+            of a burst before calling the function. If None, there is no
+            maximum.
+        """
+        self._func = func
+        self._clock = clock
+        self._quiet_period = quiet_period
+        self._max_delay = max_delay
+
+        self._waiting = []
+        self._first_trigger_time = None
+        self._delayed_call = None
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def pending(self):
+        """ The number of triggers waiting for a call to cover them. """
+        return len(self._waiting)
+
+    def trigger(self, immediate=False):
+        """
+        Request that the function be called.
+
+        :param immediate:
+            If True, skip the quiet period and call the function as soon as no
+            other call is running.
+        :return:
+            A Deferred that fires with the result of the call that covers this
+            trigger.
+        """
+        d = Deferred()
+        if not self._waiting:
+            self._first_trigger_time = self._clock.seconds()
+        self._waiting.append(d)
+
+        if not self._running:
+            self._schedule(immediate)
+
+        return d
+
+    def _schedule(self, immediate=False):
+        delay = 0 if immediate else self._next_delay()
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+
+        if delay <= 0:
+            self._call()
+        else:
+            self._delayed_call = self._clock.callLater(delay, self._call)
+
+    def _next_delay(self):
+        delay = self._quiet_period
+        if self._max_delay is not None:
+            elapsed = self._clock.seconds() - self._first_trigger_time
+            delay = min(delay, self._max_delay - elapsed)
+        return delay
+
+    def _call(self):
+        self._delayed_call = None
+        waiting, self._waiting = self._waiting, []
+        self._first_trigger_time = None
+        self._running = True
+
+        self.log.debug('Calling coalesced function for {triggers} triggers',
+                       triggers=len(waiting))
+        d = maybeDeferred(self._func, len(waiting))
+
+        def finished(result):
+            self._running = False
+            for waiting_d in waiting:
+                waiting_d.callback(result)
+
+            # Triggers that arrived while we were running get the same quiet
+            # period, but the time they have spent waiting already counts
+            # towards the maximum delay.
+            if self._waiting and not self._running:
+                self._schedule()
+
+        d.addBoth(finished)
+
+    def stop(self):
+        """
+        Cancel any scheduled call. Triggers that have not been covered by a
+        call yet are never fired.
+        """
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+        self._waiting = []
+        self._first_trigger_time = None
@@ -0,0 +1,114 @@
+from marathon_acme.server import Health
+
+
+class HealthMonitor(object):
+    """
+    Track the health of the service: whether we're attached to Marathon's
+    event stream, when we last received an event, and when a sync last
+    succeeded. The health status is only recomputed when one of those changes
+    or when one of the thresholds passes, so health checks are cheap.
+    """
+
+    def __init__(self, clock, max_event_age=None, max_sync_age=None):
+        """
+        :param clock: The ``IReactorTime`` provider to use.
+        :param max_event_age:
+            Amount of time in seconds since the last event from Marathon after
+            which the service is unhealthy. If None, the time since the last
+            event doesn't affect health.
+        :param max_sync_age:
+            Amount of time in seconds since the last successful sync after
+            which the service is unhealthy. If None, the time since the last
+            sync doesn't affect health.
+        """
+        self._clock = clock
+        self._max_event_age = max_event_age
+        self._max_sync_age = max_sync_age
+
+        self._attached = False
+        self._last_event = None
+        self._last_sync = None
+
+        self._health = None
+        # The time after which the cached health may have changed
+        self._valid_until = None
+
+    def stream_attached(self):
+        """ Record that we're attached to Marathon's event stream. """
+        self._attached = True
+        self._last_event = self._clock.seconds()
+        self._invalidate()
+
+    def stream_detached(self):
+        """ Record that we're no longer attached to the event stream. """
+        self._attached = False
+        self._invalidate()
+
+    def event_received(self):
+        """ Record that an event was received from Marathon. """
+        self._last_event = self._clock.seconds()
+        self._invalidate()
+
+    def sync_succeeded(self):
+        """ Record that a sync completed successfully. """
+        self._last_sync = self._clock.seconds()
+        self._invalidate()
+
+    def health(self):
+        """
+        Get the current health of the service.
+
+        :rtype: Health
+        """
+        if self._health is None or (
+                self._valid_until is not None and
+                self._clock.seconds() >= self._valid_until):
+            self._health, self._valid_until = self._compute_health()
+        return self._health
+
+    def _invalidate(self):
+        self._health = None
+
+    def _compute_health(self):
+        now = self._clock.seconds()
+        problems = []
+        deadlines = []
+
+        if not self._attached:
+            problems.append('Not attached to the Marathon event stream')
+
+        if self._max_event_age is not None:
+            if self._last_event is None:
+                problems.append('No events received from Marathon')
+            else:
+                deadline = self._last_event + self._max_event_age
+                if now >= deadline:
+                    problems.append(
+                        'No events received from Marathon in %ss' % (
+                            self._max_event_age,))
+                else:
+                    deadlines.append(deadline)
+
+        if self._max_sync_age is not None:
+            if self._last_sync is None:
+                problems.append('No successful syncs')
+            else:
+                deadline = self._last_sync + self._max_sync_age
+                if now >= deadline:
+                    problems.append('No successful syncs in %ss' % (
+                        self._max_sync_age,))
+                else:
+                    deadlines.append(deadline)
+
+        # Report times rather than ages so that the message stays correct
+        # for as long as it is cached
+        message = {
+            'attached': self._attached,
+            'last_event': self._last_event,
+            'last_sync': self._last_sync,
+        }
+        if problems:
+            message['errors'] = problems
+
+        valid_until = min(deadlines) if deadlines else None
+        return Health(not problems, message), valid_until
@@ -0,0 +1,144 @@
+import heapq
+import itertools
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.logger import Logger
+
+
+QUEUED = 'queued'
+ISSUING = 'issuing'
+
+
+class _DomainState(object):
+    def __init__(self, domain, priority, queued_at):
+        self.domain = domain
+        self.priority = priority
+        self.queued_at = queued_at
+        self.started_at = None
+        self.state = QUEUED
+        self.waiting = []
+
+
+class IssuanceScheduler(object):
+    """
+    Issue certificates for domains with a bounded number of issuances in
+    progress at once. Domains are queued in priority order, and in the order
+    they were scheduled for domains with the same priority. A domain is only
+    ever queued or being issued once at a time.
+    """
+
+    log = Logger()
+
+    def __init__(self, issue_func, clock, workers=4):
+        """
+        :param issue_func:
+            The function to call to issue a certificate. It is called with the
+            domain and may return a Deferred.
+        :param clock: The ``IReactorTime`` provider to use for wait times.
+        :param workers:
+            The maximum number of certificates to issue at once.
+        """
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+
+        self._issue_func = issue_func
+        self._clock = clock
+        self._workers = workers
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._domains = {}
+        self._issuing = 0
+        self.last_wait_time = None
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    @property
+    def issuing(self):
+        return self._issuing
+
+    def schedule(self, domain, priority=0):
+        """
+        Schedule a certificate to be issued for a domain.
+
+        :param domain: The domain to issue a certificate for.
+        :param priority:
+            The priority of the issuance. Domains with a lower priority value
+            are issued first.
+        :return:
+            A Deferred that fires with the result of the issuance. If the
+            domain is already queued or being issued, the Deferred fires with
+            the result of that issuance.
+        """
+        state = self._domains.get(domain)
+        if state is None:
+            state = _DomainState(domain, priority, self._clock.seconds())
+            self._domains[domain] = state
+            heapq.heappush(
+                self._queue, (priority, next(self._counter), domain))
+            self.log.debug(
+                "Queued certificate issuance for '{domain}' (queue depth: "
+                '{depth})', domain=domain, depth=self.queue_depth)
+        else:
+            self.log.debug(
+                "Certificate issuance for '{domain}' already {state}",
+                domain=domain, state=state.state)
+
+        d = Deferred()
+        state.waiting.append(d)
+
+        self._maybe_start()
+        return d
+
+    def _maybe_start(self):
+        while self._queue and self._issuing < self._workers:
+            _, _, domain = heapq.heappop(self._queue)
+            self._start(self._domains[domain])
+
+    def _start(self, state):
+        state.state = ISSUING
+        state.started_at = self._clock.seconds()
+        self.last_wait_time = state.started_at - state.queued_at
+        self._issuing += 1
+
+        self.log.debug(
+            "Issuing certificate for '{domain}' after waiting {wait:.3f}s",
+            domain=state.domain, wait=self.last_wait_time)
+
+        d = maybeDeferred(self._issue_func, state.domain)
+        d.addBoth(self._finished, state)
+
+    def _finished(self, result, state):
+        self._issuing -= 1
+        del self._domains[state.domain]
+
+        for d in state.waiting:
+            d.callback(result)
+
+        self._maybe_start()
+
+    def status(self):
+        """
+        Get the status of the scheduler as a JSON-serializable object for
+        operators to inspect.
+        """
+        now = self._clock.seconds()
+        domains = {}
+        for domain, state in self._domains.items():
+            domain_status = {'state': state.state, 'priority': state.priority}
+            if state.started_at is not None:
+                domain_status['waited'] = state.started_at - state.queued_at
+                domain_status['issuing_for'] = now - state.started_at
+            else:
+                domain_status['waited'] = now - state.queued_at
+            domains[domain] = domain_status
+
+        return {
+            'workers': self._workers,
+            'queue_depth': self.queue_depth,
+            'issuing': self.issuing,
+            'last_wait_time': self.last_wait_time,
+            'domains': domains,
+        }
@@ -0,0 +1,265 @@
+import codecs
+import json
+
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Protocol, connectionDone
+from twisted.logger import Logger
+from twisted.web._newclient import ResponseDone
+from twisted.web.client import PotentialDataLoss
+
+_WHITESPACE = ' \t\n\r'
+
+
+class JsonArrayFieldProtocol(Protocol):
+    """
+    A protocol that incrementally decodes a JSON object as it is received and
+    hands each item in the array in one of its fields to a handler as soon as
+    the item has been received, e.g. each app in a Marathon ``/v2/apps``
+    response. Only one item needs to be kept in memory at a time. The values
+    of the object's other fields are decoded and thrown away.
+    """
+
+    MAX_LENGTH = 64 * 1024 * 1024  # 64MiB
+    log = Logger()
+
+    def __init__(self, field, handler, max_length=MAX_LENGTH):
+        """
+        :param field: The name of the field with the array.
+        :param handler:
+            A 1-arg callable that will be called back with each item in the
+            array.
+        :param int max_length:
+            The maximum length in characters of a single value in the object
+            or item in the array that will be accepted.
+        """
+        self._field = field
+        self._handler = handler
+        self._max_length = max_length
+
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = u''
+        self._state = self._object_start
+        self._key = None
+        self._found_field = False
+        self._count = 0
+        self._error = None
+
+        self._waiting = []
+
+    def when_finished(self):
+        """
+        Get a deferred that will be fired with the number of items in the
+        array once the whole object has been received, or errback if the
+        object couldn't be decoded or didn't have the field.
+        """
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def dataReceived(self, data):
+        if self._error is not None:
+            return
+
+        self._buffer += self._decoder.decode(data)
+        try:
+            pos = 0
+            while True:
+                new_pos = self._state(pos)
+                if new_pos is None:
+                    break
+                pos = new_pos
+            self._buffer = self._buffer[pos:]
+
+            if len(self._buffer) > self._max_length:
+                raise ValueError(
+                    'JSON value exceeds maximum length: {} > {}'.format(
+                        len(self._buffer), self._max_length))
+        except Exception as e:
+            self._error = e
+            self._buffer = u''
+            self.transport.stopProducing()
+
+    def _skip_whitespace(self, pos):
+        """
+        Get the position of the next character that isn't whitespace, or None
+        if there isn't one yet.
+        """
+        while pos < len(self._buffer):
+            if self._buffer[pos] not in _WHITESPACE:
+                return pos
+            pos += 1
+        return None
+
+    def _expect(self, pos, chars):
+        """
+        Get the next character that isn't whitespace, and its position, if it
+        is one of the expected characters.
+        """
+        pos = self._skip_whitespace(pos)
+        if pos is None:
+            return None, None
+
+        char = self._buffer[pos]
+        if char not in chars:
+            raise ValueError(
+                'Unexpected character in JSON at position {}: {!r}'.format(
+                    pos, char))
+        return char, pos
+
+    def _decode_value(self, pos):
+        """
+        Decode the next JSON value, if all of it has been received.
+
+        :return: The value and the position after it, or None.
+        """
+        pos = self._skip_whitespace(pos)
+        if pos is None:
+            return None
+
+        try:
+            value, end = self._json_decoder.raw_decode(self._buffer, pos)
+        except ValueError:
+            # Wait for the rest of the value
+            return None
+
+        # Values in the object are always followed by some other character,
+        # and numbers may not have been fully received without it
+        if end >= len(self._buffer):
+            return None
+        return value, end
+
+    def _object_start(self, pos):
+        char, pos = self._expect(pos, '{')
+        if char is None:
+            return None
+        self._state = self._key_or_end
+        return pos + 1
+
+    def _key_or_end(self, pos):
+        char, pos = self._expect(pos, '"}')
+        if char is None:
+            return None
+        if char == '}':
+            self._state = self._done
+            return pos + 1
+        return self._key_value(pos)
+
+    def _key_value(self, pos):
+        result = self._decode_value(pos)
+        if result is None:
+            return None
+        self._key, pos = result
+        self._state = self._colon
+        return pos
+
+    def _colon(self, pos):
+        char, pos = self._expect(pos, ':')
+        if char is None:
+            return None
+        if self._key == self._field:
+            self._found_field = True
+            self._state = self._array_start
+        else:
+            self._state = self._value
+        return pos + 1
+
+    def _value(self, pos):
+        result = self._decode_value(pos)
+        if result is None:
+            return None
+        # Throw away the values of any other fields
+        _, pos = result
+        self._state = self._after_value
+        return pos
+
+    def _after_value(self, pos):
+        char, pos = self._expect(pos, ',}')
+        if char is None:
+            return None
+        self._state = self._next_key if char == ',' else self._done
+        return pos + 1
+
+    def _next_key(self, pos):
+        char, pos = self._expect(pos, '"')
+        if char is None:
+            return None
+        return self._key_value(pos)
+
+    def _array_start(self, pos):
+        char, pos = self._expect(pos, '[')
+        if char is None:
+            return None
+        self._state = self._item_or_end
+        return pos + 1
+
+    def _item_or_end(self, pos):
+        pos = self._skip_whitespace(pos)
+        if pos is None:
+            return None
+        if self._buffer[pos] == ']':
+            self._state = self._after_value
+            return pos + 1
+        return self._item(pos)
+
+    def _item(self, pos):
+        result = self._decode_value(pos)
+        if result is None:
+            return None
+        item, pos = result
+        self._count += 1
+        self._handler(item)
+        self._state = self._after_item
+        return pos
+
+    def _after_item(self, pos):
+        char, pos = self._expect(pos, ',]')
+        if char is None:
+            return None
+        self._state = self._item if char == ',' else self._after_value
+        return pos + 1
+
+    def _done(self, pos):
+        pos = self._skip_whitespace(pos)
+        if pos is None:
+            return None
+        raise ValueError(
+            'Unexpected data after JSON object at position {}'.format(pos))
+
+    def connectionLost(self, reason=connectionDone):
+        if self._error is None and not reason.check(
+                ResponseDone, PotentialDataLoss):
+            self._error = reason.value
+        if self._error is None and self._state != self._done:
+            self._error = ValueError('Incomplete JSON object received')
+        if self._error is None and not self._found_field:
+            self._error = KeyError(
+                'Unable to get value for "%s" from response' % (
+                    self._field,))
+
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            if self._error is not None:
+                d.errback(self._error)
+            else:
+                d.callback(self._count)
+
+
+def json_array_field_content(response, field, handler):
+    """
+    Callback to incrementally decode a JSON object in a response, passing
+    each item in the array in one of its fields to a handler.
+
+    :param response: The response, which should have been made unbuffered.
+    :param field: The name of the field with the array.
+    :param handler: The handler for each item in the array.
+    :return:
+        A Deferred that fires with the number of items once the whole
+        response has been received.
+    """
+    protocol = JsonArrayFieldProtocol(field, handler)
+    finished = protocol.when_finished()
+
+    response.deliverBody(protocol)
+
+    return finished
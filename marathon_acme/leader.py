@@ -0,0 +1,173 @@
+from twisted.internet.defer import succeed
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from marathon_acme.clients.vault import CasError
+
+
+class VaultLeaderLease(object):
+    """
+    Elect a single leader among marathon-acme replicas by holding a lease in
+    a Vault key/value version 2 secret engine.
+
+    The leader renews the lease by rewriting it, using check-and-set so that
+    only one replica can win each write. The other replicas watch the lease's
+    version and take it over if the version doesn't change for the lease
+    duration. Durations are only ever measured on each replica's own clock,
+    so the replicas' clocks don't need to agree.
+    """
+
+    log = Logger()
+
+    def __init__(self, client, mount_path, holder, clock, path='leader',
+                 lease_duration=30, renew_interval=10):
+        """
+        :param client: The Vault API client.
+        :param mount_path: The Vault key/value mount path.
+        :param holder: A name for this replica that is unique among replicas.
+        :param clock: The ``IReactorTime`` provider to use.
+        :param path: The path of the lease in the key/value engine.
+        :param lease_duration:
+            Amount of time in seconds that the lease can go without being
+            renewed before another replica takes it over.
+        :param renew_interval:
+            Amount of time in seconds between renewing (or checking) the
+            lease. Must be less than the lease duration.
+        """
+        if renew_interval >= lease_duration:
+            raise ValueError(
+                'renew_interval must be less than lease_duration')
+
+        self._client = client
+        self._mount_path = mount_path
+        self.holder = holder
+        self._clock = clock
+        self._path = path
+        self._lease_duration = lease_duration
+        self._renew_interval = renew_interval
+
+        self.is_leader = False
+        self._on_elected = None
+        self._on_demoted = None
+        self._loop = None
+        self._version = None
+        # The time we last renewed the lease, as leader
+        self._renewed_at = None
+        # The version of another replica's lease and when we first saw it
+        self._seen_version = None
+        self._seen_at = None
+
+    def start(self, on_elected, on_demoted):
+        """
+        Start contending for the lease.
+
+        :param on_elected:
+            Function to call with no arguments when this replica becomes the
+            leader.
+        :param on_demoted:
+            Function to call with no arguments when this replica stops being
+            the leader.
+        """
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+
+        self._loop = LoopingCall(self._tick)
+        self._loop.clock = self._clock
+        self._loop.start(self._renew_interval, now=True)
+
+    def stop(self):
+        """
+        Stop contending for the lease, releasing it if we hold it so that
+        another replica can take over straight away.
+
+        :return: A Deferred that fires when the lease has been released.
+        """
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+        if not self.is_leader:
+            return succeed(None)
+
+        self._demote()
+        d = self._client.create_or_update_kv2(
+            self._path, {'holder': None}, cas=self._version,
+            mount_path=self._mount_path)
+        d.addErrback(lambda f: self.log.failure(
+            'Failed to release the leader lease', f))
+        return d.addCallback(lambda _: None)
+
+    def _tick(self):
+        now = self._clock.seconds()
+        d = self._client.read_kv2(self._path, mount_path=self._mount_path)
+        d.addCallback(self._check_lease, now)
+        d.addErrback(self._lease_error, now)
+        return d
+
+    def _check_lease(self, response, now):
+        if response is None:
+            # cas = 0 means the lease must not exist yet
+            version, holder = 0, None
+        else:
+            version = response['data']['metadata']['version']
+            holder = response['data']['data'].get('holder')
+
+        if holder is None or holder == self.holder:
+            return self._write_lease(version, now)
+
+        # Another replica holds the lease
+        if self.is_leader:
+            self.log.warn('Leader lease taken over by {holder}',
+                          holder=holder)
+            self._demote()
+
+        if version != self._seen_version:
+            self._seen_version, self._seen_at = version, now
+            return
+
+        if now - self._seen_at >= self._lease_duration:
+            self.log.warn(
+                'Leader lease held by {holder} not renewed in {duration}s, '
+                'taking over...', holder=holder,
+                duration=self._lease_duration)
+            return self._write_lease(version, now)
+
+    def _write_lease(self, version, now):
+        d = self._client.create_or_update_kv2(
+            self._path, {'holder': self.holder}, cas=version,
+            mount_path=self._mount_path)
+
+        def written(response):
+            self._version = response['data']['version']
+            # The lease was renewed no earlier than when we started checking
+            # it, which is what the other replicas see too
+            self._renewed_at = now
+            if not self.is_leader:
+                self.log.info('Elected leader as {holder}',
+                              holder=self.holder)
+                self.is_leader = True
+                self._on_elected()
+
+        def cas_mismatch(failure):
+            failure.trap(CasError)
+            # Another replica got there first
+            self._seen_version, self._seen_at = None, None
+            if self.is_leader:
+                self.log.warn('Lost the leader lease to another replica')
+                self._demote()
+
+        return d.addCallbacks(written, cas_mismatch)
+
+    def _lease_error(self, failure, now):
+        self.log.failure('Error checking the leader lease', failure)
+
+        # If we can't renew the lease, we must stop acting as leader before
+        # another replica could take over, allowing for a late check
+        if self.is_leader and (now - self._renewed_at >=
+                               self._lease_duration - self._renew_interval):
+            self.log.warn('Unable to renew the leader lease, stepping down')
+            self._demote()
+
+    def _demote(self):
+        self.is_leader = False
+        self._on_demoted()
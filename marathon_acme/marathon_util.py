@@ -100,3 +100,42 @@ def _is_legacy_ip_per_task(app):
     :return: True if using IP per task, False otherwise.
     """
     return app.get('ipAddress') is not None
+
+
+def get_deployment_apps(plan):
+    """
+    Get the apps affected by a deployment from the deployment plan in a
+    Marathon deployment event.
+
+    :param plan: The deployment plan JSON from a Marathon deployment event.
+    :return:
+        A dict mapping the ID of each affected app to the app's definition
+        after the deployment, or to None if the app was removed.
+    """
+    target_apps = dict((app['id'], app) for app in _get_group_apps(
+        plan.get('target', {})))
+
+    affected_apps = {}
+    for step in plan.get('steps', []):
+        # Marathon 1.x: steps are objects with a list of actions
+        # Older Marathon: steps are lists of actions
+        actions = step.get('actions', []) if isinstance(step, dict) else step
+        for action in actions:
+            # Actions for pods have a 'pod' rather than an 'app'
+            app_id = action.get('app')
+            if app_id is None:
+                continue
+            affected_apps[app_id] = target_apps.get(app_id)
+
+    return affected_apps
+
+
+def _get_group_apps(group):
+    """
+    Get all the app definitions in a Marathon group, including those in any
+    nested groups.
+    """
+    apps = list(group.get('apps', []))
+    for subgroup in group.get('groups', []):
+        apps.extend(_get_group_apps(subgroup))
+    return apps
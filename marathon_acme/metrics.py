@@ -0,0 +1,75 @@
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, generate_latest)
+from prometheus_client.exposition import CONTENT_TYPE_LATEST
+
+# A registry of our own rather than the global default one, so that only
+# marathon-acme's metrics are exposed
+REGISTRY = CollectorRegistry()
+
+# Longer buckets than the default for operations that can take minutes
+_LONG_BUCKETS = (.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf'))
+
+SYNCS = Counter(
+    'marathon_acme_syncs_total', 'Syncs run, by result.', ['result'],
+    registry=REGISTRY)
+SYNC_DURATION = Histogram(
+    'marathon_acme_sync_duration_seconds', 'Time taken to run syncs.',
+    buckets=_LONG_BUCKETS, registry=REGISTRY)
+SYNC_EVENTS = Histogram(
+    'marathon_acme_sync_events', 'Events coalesced into each sync.',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')),
+    registry=REGISTRY)
+APPS = Gauge(
+    'marathon_acme_apps', 'Apps seen in Marathon by the last full sync.',
+    registry=REGISTRY)
+DOMAINS = Gauge(
+    'marathon_acme_domains', 'Domains that require certificates, as of the '
+    'last sync.', registry=REGISTRY)
+
+ISSUANCE_QUEUE_DEPTH = Gauge(
+    'marathon_acme_issuance_queue_depth',
+    'Domains waiting to have certificates issued.', registry=REGISTRY)
+ISSUANCE_IN_PROGRESS = Gauge(
+    'marathon_acme_issuance_in_progress',
+    'Domains that certificates are being issued for.', registry=REGISTRY)
+
+ACME_ORDER_DURATION = Histogram(
+    'marathon_acme_acme_order_duration_seconds',
+    'Time taken to order certificates from the ACME server, by result.',
+    ['result'], buckets=_LONG_BUCKETS, registry=REGISTRY)
+ACME_ORDER_FAILURES = Counter(
+    'marathon_acme_acme_order_failures_total',
+    'Failed certificate orders, by ACME error code.', ['code'],
+    registry=REGISTRY)
+
+HTTP_REQUEST_DURATION = Histogram(
+    'marathon_acme_http_request_duration_seconds',
+    'Time taken to receive response headers for requests to Marathon, '
+    'marathon-lb and Vault.', ['client', 'method', 'endpoint', 'result'],
+    registry=REGISTRY)
+
+MLB_SIGNALS = Counter(
+    'marathon_acme_marathon_lb_signals_total',
+    'Signals sent to marathon-lb instances, by signal, instance and result.',
+    ['signal', 'instance', 'result'], registry=REGISTRY)
+
+SSE_RECONNECTS = Counter(
+    'marathon_acme_sse_reconnects_total',
+    'Reconnections to the Marathon event stream.', registry=REGISTRY)
+EVENTS = Counter(
+    'marathon_acme_events_total', 'Events received from Marathon, by type.',
+    ['event_type'], registry=REGISTRY)
+
+CERT_EXPIRY = Gauge(
+    'marathon_acme_certificate_expiry_timestamp_seconds',
+    'Time at which certificates expire, in seconds since the epoch.',
+    ['domain'], registry=REGISTRY)
+
+
+def render_metrics():
+    """
+    Render the metrics in the Prometheus text format.
+
+    :return: A tuple of the content type and the body bytes.
+    """
+    return CONTENT_TYPE_LATEST, generate_latest(REGISTRY)
@@ -0,0 +1,220 @@
+from publicsuffix2 import get_sld
+
+from twisted.web.http import stringToDatetime
+
+from marathon_acme.clients import get_single_header
+
+
+# Let's Encrypt's rate limits:
+# https://letsencrypt.org/docs/rate-limits/
+NEW_ORDERS_PERIOD = 3 * 60 * 60
+CERTS_PER_DOMAIN_PERIOD = 7 * 24 * 60 * 60
+
+
+def registered_domain(domain):
+    """
+    Get the registered domain for a domain name, i.e. the domain that was
+    bought from a registrar, using the public suffix list bundled with
+    ``publicsuffix2``. This is what ACME CAs group certificates by for their
+    rate limits.
+    """
+    return get_sld(domain.lower().rstrip('.'))
+
+
+def get_retry_after(response, now):
+    """
+    Get the number of seconds that a response's ``Retry-After`` header asks us
+    to wait for. The header may be a number of seconds or an HTTP date.
+
+    :param response: The response, or None if there is no response.
+    :param now: The current time in seconds since the epoch.
+    :return: The number of seconds to wait, or None if not specified.
+    """
+    if response is None:
+        return None
+
+    retry_after = get_single_header(response.headers, 'Retry-After')
+    if retry_after is None:
+        return None
+
+    try:
+        return max(0, int(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, stringToDatetime(retry_after.encode('ascii')) - now)
+    except (ValueError, IndexError, KeyError):
+        return None
+
+
+class TokenBucket(object):
+    """
+    A token bucket that holds up to ``capacity`` tokens and is refilled at a
+    rate of ``capacity`` tokens per ``period`` seconds.
+    """
+
+    def __init__(self, capacity, period, clock):
+        self.capacity = capacity
+        self._rate = float(capacity) / period
+        self._clock = clock
+
+        self._tokens = float(capacity)
+        self._updated = clock.seconds()
+        self._blocked_until = None
+
+    def _refill(self):
+        now = self._clock.seconds()
+        if self._blocked_until is not None:
+            if now < self._blocked_until:
+                return
+            # Start refilling from when the block was lifted
+            self._updated = self._blocked_until
+            self._blocked_until = None
+
+        elapsed = max(0, now - self._updated)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self._rate)
+        self._updated = now
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    def take(self):
+        """
+        Take a token if one is available.
+
+        :return: True if a token was taken, else False.
+        """
+        self._refill()
+        if self._blocked_until is None and self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """
+        Get the amount of time in seconds until a token will be available.
+        """
+        self._refill()
+        now = self._clock.seconds()
+        if self._blocked_until is not None:
+            # A single token is available once the block is lifted
+            return self._blocked_until - now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def drain(self, retry_after=None):
+        """
+        Empty the bucket, for example because the server told us that we've
+        run out of tokens.
+
+        :param retry_after:
+            If given, the number of seconds until the server says tokens will
+            be available again. No tokens are added until then.
+        """
+        self._refill()
+        self._tokens = 0
+        if retry_after is not None and retry_after > 0:
+            self._blocked_until = self._clock.seconds() + retry_after
+            self._tokens = 1
+
+
+class AcmeRateLimiter(object):
+    """
+    Admission control for ACME certificate orders that models the CA's rate
+    limits as token buckets: one for new orders per account and one per
+    registered domain for certificates per registered domain. Orders that
+    would exceed a limit are not admitted so that they can be deferred.
+    """
+
+    def __init__(self, clock, orders_per_account=None,
+                 certs_per_domain=None,
+                 orders_period=NEW_ORDERS_PERIOD,
+                 certs_period=CERTS_PER_DOMAIN_PERIOD):
+        """
+        :param clock: The ``IReactorTime`` provider to use.
+        :param orders_per_account:
+            The number of new orders allowed per account every
+            ``orders_period`` seconds. If None, orders per account are not
+            limited.
+        :param certs_per_domain:
+            The number of certificates allowed per registered domain every
+            ``certs_period`` seconds. If None, certificates per registered
+            domain are not limited.
+        """
+        self._clock = clock
+        self._account_bucket = None
+        if orders_per_account:
+            self._account_bucket = TokenBucket(
+                orders_per_account, orders_period, clock)
+
+        self._certs_per_domain = certs_per_domain
+        self._certs_period = certs_period
+        self._domain_buckets = {}
+
+    def _domain_bucket(self, domain):
+        if not self._certs_per_domain:
+            return None
+
+        reg_domain = registered_domain(domain)
+        bucket = self._domain_buckets.get(reg_domain)
+        if bucket is None:
+            bucket = TokenBucket(
+                self._certs_per_domain, self._certs_period, self._clock)
+            self._domain_buckets[reg_domain] = bucket
+        return bucket
+
+    def admit(self, domain, renewal=False):
+        """
+        Try to admit an order for a certificate for the given domain. A token
+        is taken from each relevant bucket only if every bucket has one.
+
+        :param renewal:
+            Whether the order renews an existing certificate for the same
+            names. Renewals are exempt from the certificates per registered
+            domain limit, so only count against the new orders limit.
+        :return:
+            0 if the order was admitted, else the number of seconds until the
+            order could be admitted.
+        """
+        domain_bucket = None if renewal else self._domain_bucket(domain)
+        buckets = [b for b in [self._account_bucket, domain_bucket]
+                   if b is not None]
+
+        delay = max([b.delay() for b in buckets] or [0])
+        if delay > 0:
+            return delay
+
+        for bucket in buckets:
+            bucket.take()
+        return 0
+
+    def rate_limited(self, domain, detail='', retry_after=None):
+        """
+        Record that the CA rejected an order for the given domain because of a
+        rate limit, so that we stop sending orders that will be rejected.
+
+        :param detail: The detail of the ACME error.
+        :param retry_after:
+            The number of seconds the CA asked us to wait, if it told us.
+        """
+        if 'new orders' in (detail or '').lower():
+            bucket = self._account_bucket
+        else:
+            bucket = self._domain_bucket(domain)
+
+        if bucket is not None:
+            bucket.drain(retry_after)
+
+    def status(self):
+        """
+        Get the remaining tokens in each bucket as a JSON-serializable object.
+        """
+        status = {'registered_domains': dict(
+            (d, b.tokens) for d, b in self._domain_buckets.items())}
+        if self._account_bucket is not None:
+            status['account'] = self._account_bucket.tokens
+        return status
@@ -0,0 +1,181 @@
+import hashlib
+import heapq
+import itertools
+
+from twisted.internet.defer import maybeDeferred
+from twisted.logger import Logger
+
+
+class RenewalScheduler(object):
+    """
+    Renew certificates when they enter their renewal window, using a min-heap
+    of renewal times and a single timer for the earliest one, rather than
+    periodically checking every certificate.
+    """
+
+    log = Logger()
+
+    def __init__(self, renew_func, clock, renew_before=30 * 24 * 60 * 60,
+                 renew_spread=0, retry_interval=60 * 60):
+        """
+        :param renew_func:
+            The function to call to renew a certificate. It is called with
+            the server name and may return a Deferred. It is expected to call
+            ``update()`` with the new expiry time if the renewal succeeds.
+        :param clock: The ``IReactorTime`` provider to use.
+        :param renew_before:
+            Amount of time in seconds before a certificate expires to renew
+            it.
+        :param renew_spread:
+            Amount of time in seconds to spread renewals over. Each server
+            name is renewed up to this much earlier than ``renew_before``, by
+            an offset that is derived from the name so that it is the same
+            every time, and certificates that were issued together aren't
+            all renewed together.
+        :param retry_interval:
+            Amount of time in seconds to wait before trying to renew a
+            certificate again if a renewal fails or doesn't produce a
+            certificate outside the renewal window.
+        """
+        self._renew_func = renew_func
+        self._clock = clock
+        self._renew_before = renew_before
+        self._renew_spread = renew_spread
+        self._retry_interval = retry_interval
+
+        self._heap = []
+        self._counter = itertools.count()
+        # The current renewal time for each server name. Heap entries that
+        # don't match are stale and skipped.
+        self._renew_at = {}
+        self._renewing = set()
+        self._delayed_call = None
+
+    def __len__(self):
+        return len(self._renew_at)
+
+    @property
+    def next_renewal(self):
+        """
+        The time at which the next renewal is due, or None if there are no
+        certificates.
+        """
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def update(self, server_name, not_after):
+        """
+        Set the expiry time of a server name's certificate.
+
+        :param not_after:
+            The time, in seconds since the epoch, after which the certificate
+            is no longer valid.
+        """
+        self._set_renew_at(
+            server_name,
+            not_after - self._renew_before - self.renew_offset(server_name))
+
+    def renew_offset(self, server_name):
+        """
+        Get the amount of time in seconds to renew a server name's
+        certificate before the start of its renewal window. The offset is
+        evenly distributed over the renewal spread.
+        """
+        if not self._renew_spread:
+            return 0
+
+        digest = hashlib.sha256(server_name.encode('utf-8')).hexdigest()
+        fraction = int(digest[:16], 16) / float(2 ** 64)
+        return fraction * self._renew_spread
+
+    def remove(self, server_name):
+        """
+        Stop renewing the certificate for a server name.
+        """
+        if self._renew_at.pop(server_name, None) is not None:
+            self._reschedule()
+
+    def stop(self):
+        """
+        Cancel the timer for the next renewal.
+        """
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+
+    def _set_renew_at(self, server_name, renew_at):
+        self._renew_at[server_name] = renew_at
+        heapq.heappush(
+            self._heap, (renew_at, next(self._counter), server_name))
+        self._reschedule()
+
+    def _discard_stale(self):
+        while self._heap:
+            renew_at, _, server_name = self._heap[0]
+            if self._renew_at.get(server_name) == renew_at:
+                return
+            heapq.heappop(self._heap)
+
+    def _reschedule(self):
+        next_renewal = self.next_renewal
+        call = self._delayed_call
+        if call is not None and call.active():
+            if next_renewal is not None and call.getTime() == next_renewal:
+                return
+            call.cancel()
+        self._delayed_call = None
+
+        if next_renewal is not None:
+            delay = max(0, next_renewal - self._clock.seconds())
+            self._delayed_call = self._clock.callLater(delay, self._renew_due)
+
+    def _renew_due(self):
+        self._delayed_call = None
+        now = self._clock.seconds()
+
+        due = []
+        self._discard_stale()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, server_name = heapq.heappop(self._heap)
+            if self._renew_at.get(server_name) is None:
+                continue
+            del self._renew_at[server_name]
+            if server_name not in self._renewing:
+                due.append(server_name)
+            self._discard_stale()
+
+        if due:
+            self.log.info(
+                'Renewing {count} certificates: {server_names}',
+                count=len(due), server_names=due)
+        for server_name in due:
+            self._renew(server_name)
+
+        self._reschedule()
+
+    def _renew(self, server_name):
+        self._renewing.add(server_name)
+        d = maybeDeferred(self._renew_func, server_name)
+
+        def renewal_failed(failure):
+            self.log.failure(
+                "Error renewing certificate for '{server_name}'", failure,
+                server_name=server_name)
+
+        def renewal_done(_):
+            self._renewing.discard(server_name)
+
+            # If the renewal didn't give us a certificate outside of the
+            # renewal window, try again later
+            renew_at = self._renew_at.get(server_name)
+            if renew_at is None or renew_at <= self._clock.seconds():
+                self.log.warn(
+                    "Certificate for '{server_name}' not renewed. Retrying in "
+                    '{delay}s', server_name=server_name,
+                    delay=self._retry_interval)
+                self._set_renew_at(
+                    server_name, self._clock.seconds() + self._retry_interval)
+
+        d.addErrback(renewal_failed)
+        d.addCallback(renewal_done)
+        return d
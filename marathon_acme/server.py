@@ -7,6 +7,8 @@ from twisted.logger import Logger
 from twisted.web.http import NOT_IMPLEMENTED, OK, SERVICE_UNAVAILABLE
 from twisted.web.server import Site
 
+from marathon_acme.metrics import render_metrics
+
 
 def write_request_json(request, json_obj):
     request.setHeader('Content-Type', 'application/json')
@@ -26,6 +28,9 @@ class MarathonAcmeServer(object):
         """
         self.responder_resource = responder_resource
         self.health_handler = None
+        self.issuance_handler = None
+        self.backoff_status_handler = None
+        self.backoff_reset_handler = None
 
     def listen(self, reactor, endpoint_description):
         """
@@ -77,7 +82,93 @@ class MarathonAcmeServer(object):
         health = self.health_handler()
         response_code = OK if health.healthy else SERVICE_UNAVAILABLE
         request.setResponseCode(response_code)
-        write_request_json(request, health.json_message)
+        request.setHeader('Content-Type', 'application/json')
+        request.write(health.json_bytes)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics(self, request):
+        """
+        Expose metrics in the Prometheus text format on ``/metrics``.
+        """
+        content_type, body = render_metrics()
+        request.setResponseCode(OK)
+        request.setHeader('Content-Type', content_type)
+        return body
+
+    def set_issuance_handler(self, issuance_handler):
+        """
+        Set the handler for the issuance status endpoint.
+
+        :param issuance_handler:
+            The handler for issuance status requests. This must be a callable
+            that returns an object that can be serialized as JSON.
+        """
+        self.issuance_handler = issuance_handler
+
+    @app.route('/issuance', methods=['GET'])
+    def issuance(self, request):
+        """
+        Report the status of certificate issuance, such as the issuance queue
+        depth and wait times, on ``/issuance``.
+        """
+        if self.issuance_handler is None:
+            request.setResponseCode(NOT_IMPLEMENTED)
+            write_request_json(request, {
+                'error': 'Cannot determine issuance status: no handler set'
+            })
+            return
+
+        request.setResponseCode(OK)
+        write_request_json(request, self.issuance_handler())
+
+    def set_backoff_handlers(self, status_handler, reset_handler):
+        """
+        Set the handlers for the issuance failure backoff endpoints.
+
+        :param status_handler:
+            The handler for backoff status requests. This must be a callable
+            that returns an object that can be serialized as JSON.
+        :param reset_handler:
+            The handler for backoff reset requests. This must be a callable
+            that takes an optional domain (resetting all domains if None) and
+            returns a Deferred that fires with the list of domains reset.
+        """
+        self.backoff_status_handler = status_handler
+        self.backoff_reset_handler = reset_handler
+
+    @app.route('/backoff', methods=['GET'])
+    def backoff_status(self, request):
+        """
+        Report the domains that certificate issuance is being backed off for
+        after failures on ``/backoff``.
+        """
+        if self.backoff_status_handler is None:
+            return self._no_backoff_handler(request)
+
+        request.setResponseCode(OK)
+        write_request_json(request, self.backoff_status_handler())
+
+    @app.route('/backoff', methods=['DELETE'])
+    @app.route('/backoff/<domain>', methods=['DELETE'])
+    def backoff_reset(self, request, domain=None):
+        """
+        Reset the issuance failure backoff for all domains on ``/backoff`` or
+        for a single domain on ``/backoff/<domain>``.
+        """
+        if self.backoff_reset_handler is None:
+            return self._no_backoff_handler(request)
+
+        def write_reset(reset):
+            request.setResponseCode(OK)
+            write_request_json(request, {'reset': reset})
+
+        return self.backoff_reset_handler(domain).addCallback(write_reset)
+
+    def _no_backoff_handler(self, request):
+        request.setResponseCode(NOT_IMPLEMENTED)
+        write_request_json(request, {
+            'error': 'Cannot manage issuance backoff: no handler set'
+        })
 
     def _no_health_handler(self, request):
         self.log.warn('Request to /health made but no handler is set')
@@ -100,3 +191,14 @@ class Health(object):
         """
         self.healthy = healthy
         self.json_message = json_message
+        self._json_bytes = None
+
+    @property
+    def json_bytes(self):
+        """
+        The JSON message serialized as bytes. This is cached so that a Health
+        object can be reused for many requests cheaply.
+        """
+        if self._json_bytes is None:
+            self._json_bytes = json.dumps(self.json_message).encode('utf-8')
+        return self._json_bytes
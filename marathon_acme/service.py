@@ -1,13 +1,33 @@
-from twisted.internet.defer import gatherResults
+from datetime import timedelta
+
+from twisted.internet.defer import gatherResults, succeed
 from twisted.logger import LogLevel, Logger
 
 from txacme.challenges import HTTP01Responder
 from txacme.client import ServerError as txacme_ServerError
 from txacme.service import AcmeIssuingService
 
-from marathon_acme.acme_util import MlbCertificateStore
-from marathon_acme.marathon_util import get_number_of_app_ports
+from marathon_acme.acme_util import (
+    GroupCertificateStore, MlbCertificateStore, cert_not_after, get_expiries,
+    get_server_names)
+from marathon_acme.backoff import FailureBackoff
+from marathon_acme.coalesce import Coalescer
+from marathon_acme.health import HealthMonitor
+from marathon_acme.issuance import IssuanceScheduler
+from marathon_acme.marathon_util import (
+    get_deployment_apps, get_number_of_app_ports)
+from marathon_acme.metrics import (
+    ACME_ORDER_DURATION, ACME_ORDER_FAILURES, APPS, CERT_EXPIRY, DOMAINS,
+    ISSUANCE_IN_PROGRESS, ISSUANCE_QUEUE_DEPTH, SSE_RECONNECTS, SYNCS,
+    SYNC_DURATION, SYNC_EVENTS)
+from marathon_acme.rate_limit import AcmeRateLimiter, get_retry_after
+from marathon_acme.renewal import RenewalScheduler
 from marathon_acme.server import MarathonAcmeServer
+from marathon_acme.sharding import HashRing
+
+# txacme's periodic check of every certificate is replaced by the renewal
+# scheduler, so it only needs to run when the service starts
+_TXACME_CHECK_INTERVAL = timedelta(days=365 * 100)
 
 
 def parse_domain_label(domain_label):
@@ -20,7 +40,17 @@ class MarathonAcme(object):
 
     def __init__(self, marathon_client, group, cert_store, mlb_client,
                  txacme_client_creator, reactor, email=None,
-                 allow_multiple_certs=False):
+                 allow_multiple_certs=False, sync_quiet_period=0,
+                 sync_max_delay=None, issue_workers=4,
+                 acme_order_limit=None, acme_domain_cert_limit=None,
+                 failure_store=None, failure_backoff_base=300,
+                 failure_backoff_max=24 * 60 * 60, mlb_reload_quiet_period=0,
+                 mlb_reload_max_delay=None, haproxy_client=None,
+                 haproxy_cert_dir=None, renew_before=30 * 24 * 60 * 60,
+                 renew_spread=0, health_max_event_age=None,
+                 health_max_sync_age=None, leader_lease=None,
+                 shard_membership=None, challenge_responder=None,
+                 extra_groups=None, app_label_ports=0):
         """
         Create the marathon-acme service.
 
@@ -33,21 +63,188 @@ class MarathonAcme(object):
         :param email: The ACME registration email.
         :param allow_multiple_certs:
             Whether to allow multiple certificates per app port.
+        :param sync_quiet_period:
+            Amount of time in seconds to wait for events to stop arriving
+            before running a sync triggered by events. If 0, a sync is run as
+            soon as no other sync is running.
+        :param sync_max_delay:
+            Maximum amount of time in seconds that a sync triggered by events
+            can be delayed by the quiet period. If None, there is no maximum.
+        :param issue_workers:
+            The maximum number of certificates to issue at once.
+        :param acme_order_limit:
+            The number of new ACME orders allowed every 3 hours. Orders beyond
+            this are deferred. If None, orders are not limited.
+        :param acme_domain_cert_limit:
+            The number of certificates allowed per registered domain every
+            week. Orders beyond this are deferred. If None, certificates per
+            registered domain are not limited.
+        :param failure_store:
+            The store to persist domain issuance failures in. If None,
+            failures are only kept in memory.
+        :param failure_backoff_base:
+            Amount of time in seconds to back off issuing a certificate for a
+            domain after its first failure. This doubles with each
+            consecutive failure.
+        :param failure_backoff_max:
+            Maximum amount of time in seconds to back off issuing a
+            certificate for a domain after failures.
+        :param mlb_reload_quiet_period:
+            Amount of time in seconds to wait for certificates to stop being
+            stored before reloading marathon-lb.
+        :param mlb_reload_max_delay:
+            Maximum amount of time in seconds to delay a marathon-lb reload
+            while waiting for certificates to stop being stored.
+        :param haproxy_client:
+            The ``HAProxyRuntimeClient`` to use to update existing
+            certificates in HAProxy without reloading marathon-lb.
+        :param haproxy_cert_dir:
+            The directory that HAProxy loads the certificates from.
+        :param renew_before:
+            Amount of time in seconds before a certificate expires to renew
+            it.
+        :param renew_spread:
+            Amount of time in seconds to spread renewals over, before
+            ``renew_before``, so that certificates issued together are not
+            all renewed together.
+        :param health_max_event_age:
+            Amount of time in seconds since the last event from Marathon
+            after which the service is reported as unhealthy. If None, this
+            isn't checked.
+        :param health_max_sync_age:
+            Amount of time in seconds since the last successful sync after
+            which the service is reported as unhealthy. If None, this isn't
+            checked.
+        :param leader_lease:
+            The lease to contend for with other replicas, e.g. a
+            ``VaultLeaderLease``. Only the leader issues and renews
+            certificates. The other replicas stand by, keeping their app
+            index and certificate cache warm. If None, this replica always
+            acts as the leader.
+        :param shard_membership:
+            The membership of the instances to share out the domains with,
+            e.g. a ``VaultShardMembership``. Each instance only issues and
+            renews certificates for the domains it owns. If None, this
+            instance owns all the domains.
+        :param challenge_responder:
+            The ``http-01`` challenge responder to use, e.g. a
+            ``VaultKvHttp01Responder`` that shares the challenges with other
+            instances. If None, the challenges are kept in memory.
+        :param extra_groups:
+            A dict of the names of other marathon-lb groups to issue
+            certificates for to the marathon-lb API client for each group.
+            The apps for all the groups are fetched together, and each
+            group's marathon-lb is only reloaded for its own certificates.
+            Can't be used with ``haproxy_client``.
+        :param app_label_ports:
+            If more than 0, only the apps with a ``MARATHON_ACME_{n}_DOMAIN``
+            label for one of this many of their first ports are fetched from
+            Marathon, using label selectors. Domains on later ports are only
+            found from events.
         """
+        if extra_groups and haproxy_client is not None:
+            raise ValueError(
+                'The HAProxy runtime API can only be used with a single '
+                'marathon-lb group')
+
         self.marathon_client = marathon_client
         self.group = group
         self.reactor = reactor
-
-        responder = HTTP01Responder()
+        self.leader_lease = leader_lease
+        self.shard_membership = shard_membership
+        self._shard_ring = None
+        self._txacme_started = False
+
+        responder = challenge_responder
+        if responder is None:
+            responder = HTTP01Responder()
         self.server = MarathonAcmeServer(responder.resource)
 
-        mlb_cert_store = MlbCertificateStore(cert_store, mlb_client)
+        # Each group's marathon-lb is reloaded separately
+        mlb_clients = {group: mlb_client}
+        if extra_groups:
+            mlb_clients.update(extra_groups)
+        self.mlb_cert_stores = {}
+        for name, client in mlb_clients.items():
+            self.mlb_cert_stores[name] = MlbCertificateStore(
+                cert_store, client, clock=reactor,
+                reload_quiet_period=mlb_reload_quiet_period,
+                reload_max_delay=mlb_reload_max_delay,
+                haproxy_client=haproxy_client,
+                haproxy_cert_dir=haproxy_cert_dir)
+        self.mlb_cert_store = self.mlb_cert_stores[group]
+        # The groups that serve each domain, from the last sync
+        self._domain_groups = {}
+        issuing_cert_store = self.mlb_cert_store
+        if extra_groups:
+            issuing_cert_store = GroupCertificateStore(
+                cert_store, self.mlb_cert_stores,
+                lambda domain: self._domain_groups.get(domain))
+        check_intervals = {'reissue_interval': timedelta(seconds=renew_before)}
+        if shard_membership is not None:
+            # Every instance runs txacme's startup check against all the
+            # certificates, so leave renewals to the owners' renewal
+            # schedulers and only reissue certificates that have expired
+            check_intervals = {'reissue_interval': timedelta(0),
+                               'panic_interval': timedelta(0)}
         self.txacme_service = AcmeIssuingService(
-            mlb_cert_store, txacme_client_creator, reactor, [responder], email)
+            issuing_cert_store, txacme_client_creator, reactor, [responder],
+            email, check_interval=_TXACME_CHECK_INTERVAL, **check_intervals)
 
         self._allow_multiple_certs = allow_multiple_certs
+        self._app_labels = [
+            'MARATHON_ACME_%d_DOMAIN' % (port_index,)
+            for port_index in range(app_label_ports)]
         self._server_listening = None
 
+        self.issuance_scheduler = IssuanceScheduler(
+            self._issue_cert, reactor, workers=issue_workers)
+        ISSUANCE_QUEUE_DEPTH.set_function(
+            lambda: self.issuance_scheduler.queue_depth)
+        ISSUANCE_IN_PROGRESS.set_function(
+            lambda: self.issuance_scheduler.issuing)
+        self.rate_limiter = AcmeRateLimiter(
+            reactor, orders_per_account=acme_order_limit,
+            certs_per_domain=acme_domain_cert_limit)
+        self._deferred_sync_call = None
+        # Domains queued for issuance to renew their certificates
+        self._renewals = set()
+        self.server.set_issuance_handler(self.issuance_status)
+
+        self.failure_backoff = FailureBackoff(
+            reactor, store=failure_store, base_delay=failure_backoff_base,
+            max_delay=failure_backoff_max)
+        self.server.set_backoff_handlers(
+            self.failure_backoff.status, self.reset_backoff)
+
+        self.health_monitor = HealthMonitor(
+            reactor, max_event_age=health_max_event_age,
+            max_sync_age=health_max_sync_age)
+        self.server.set_health_handler(self.health_monitor.health)
+
+        self.renewal_scheduler = RenewalScheduler(
+            self._renew_cert, reactor, renew_before=renew_before,
+            renew_spread=renew_spread)
+
+        # Bursts of events are coalesced into a single sync
+        self._sync_coalescer = Coalescer(
+            self._coalesced_sync, reactor, quiet_period=sync_quiet_period,
+            max_delay=sync_max_delay)
+        self.last_sync_events = None
+
+        # Index of app ID to the app's domains, kept up to date from events.
+        # None until it is seeded by a full sync.
+        self._app_domains = None
+        # Updates to the index received while a full sync is fetching apps
+        self._app_index_updates = None
+        # Bumped whenever the index is invalidated so that a full sync that
+        # started before then doesn't seed the index
+        self._app_index_generation = 0
+        # The domains from the last sync that found that all of them already
+        # had certificates. Until the domains change, syncs have nothing to
+        # do.
+        self._converged_domains = None
+
     def run(self, endpoint_description):
         self.log.info('Starting marathon-acme...')
 
@@ -57,11 +254,26 @@ class MarathonAcme(object):
         def on_server_listening(listening_port):
             self._server_listening = listening_port
 
-            # Start the txacme service and wait for the initial check
-            self.txacme_service.startService()
-            return self.txacme_service.when_certs_valid()
+            # Without leader election, we're always the leader
+            if self.leader_lease is None:
+                return self._start_issuing()
         d.addCallback(on_server_listening)
 
+        # Load the domains we're backing off issuing certificates for
+        d.addCallback(lambda _: self.failure_backoff.load())
+
+        # Contend for leadership, if there are other replicas
+        def start_leader_lease(_):
+            if self.leader_lease is not None:
+                self.leader_lease.start(self._on_elected, self._on_demoted)
+        d.addCallback(start_leader_lease)
+
+        # Find the other instances to share out the domains with, if any
+        def start_shard_membership(_):
+            if self.shard_membership is not None:
+                self.shard_membership.start(self._on_shards_changed)
+        d.addCallback(start_shard_membership)
+
         # Then listen for events...
         d.addCallback(lambda _: self.listen_events())
 
@@ -74,20 +286,136 @@ class MarathonAcme(object):
         self.log.failure('Unhandled error during operation', failure)
         self.log.warn('Stopping marathon-acme...')
 
+        self._sync_coalescer.stop()
+        for mlb_cert_store in self.mlb_cert_stores.values():
+            mlb_cert_store.stop()
+        self.renewal_scheduler.stop()
+        if (self._deferred_sync_call is not None and
+                self._deferred_sync_call.active()):
+            self._deferred_sync_call.cancel()
+
+        ds = []
+        if self.leader_lease is not None:
+            ds.append(self.leader_lease.stop())
+        if self.shard_membership is not None:
+            ds.append(self.shard_membership.stop())
+        if self._txacme_started:
+            ds.append(self.txacme_service.stopService())
         # If the server failed to start we have nothing to cancel yet
         if self._server_listening is not None:
-            return gatherResults([
-                self._server_listening.stopListening(),
-                self.txacme_service.stopService()
-            ], consumeErrors=True)
+            ds.append(self._server_listening.stopListening())
+        if ds:
+            return gatherResults(ds, consumeErrors=True)
+
+    @property
+    def is_leader(self):
+        """
+        Whether this replica is the leader, and so issues and renews
+        certificates.
+        """
+        return self.leader_lease is None or self.leader_lease.is_leader
+
+    def _start_issuing(self):
+        """
+        Start the txacme service, wait for its initial check, and schedule
+        renewals of the certificates we already have.
+        """
+        if not self._txacme_started:
+            self._txacme_started = True
+            self.txacme_service.startService()
+
+        d = self.txacme_service.when_certs_valid()
+        return d.addCallback(lambda _: self.load_expiries())
+
+    def _on_elected(self):
+        self.log.info('Elected leader, issuing certificates...')
+        self._converged_domains = None
+
+        def sync(_):
+            # Issue certificates for any domains that appeared while we were
+            # standing by. Sync failures are already logged.
+            self._sync_coalescer.trigger(immediate=True).addErrback(
+                lambda _failure: None)
+
+        # The previous leader may have backed off issuing for some domains
+        d = self._reload_failure_backoff()
+        d.addCallback(lambda _: self._start_issuing())
+        d.addCallback(sync)
+        d.addErrback(lambda f: self.log.failure(
+            'Error starting to issue certificates after being elected', f))
+
+    def _on_demoted(self):
+        self.log.warn('No longer the leader, standing by...')
+        self.renewal_scheduler.stop()
+
+    def owns_domain(self, domain):
+        """
+        Whether this instance owns a domain, and so issues and renews its
+        certificate.
+        """
+        if self.shard_membership is None:
+            return True
+        if self._shard_ring is None:
+            # We don't know who the members are yet
+            return False
+        return self._shard_ring.owner(domain) == self.shard_membership.member
+
+    def _on_shards_changed(self, members):
+        self.log.info(
+            'Sharing out domains between {count} members: {members}',
+            count=len(members), members=members)
+        self._shard_ring = HashRing(members)
+        self._converged_domains = None
+
+        def reschedule(_):
+            # Reschedule renewals for the domains we now own, and issue
+            # certificates for any new ones. Failures are already logged.
+            self.load_expiries().addErrback(lambda f: self.log.failure(
+                'Error loading certificate expiries after the shard members '
+                'changed', f))
+            self._sync_coalescer.trigger(immediate=True).addErrback(
+                lambda _failure: None)
+
+        # The previous owners of the domains we now own may have backed off
+        # issuing for some of them
+        self._reload_failure_backoff().addCallback(reschedule)
+
+    def _reload_failure_backoff(self):
+        """
+        Reload the issuance failure backoff from the store. Errors are logged
+        and the backoff we already have is kept.
+        """
+        return self.failure_backoff.load().addErrback(
+            lambda f: self.log.failure(
+                'Error reloading issuance failure backoff', f))
+
+    def load_expiries(self):
+        """
+        Load the expiry times of the stored certificates into the renewal
+        scheduler.
+        """
+        def update_scheduler(expiries):
+            for server_name, not_after in expiries.items():
+                if not_after is not None:
+                    self._update_expiry(server_name, not_after)
+            self.log.info(
+                'Scheduled renewals for {count} certificates, next at '
+                '{next_renewal}', count=len(self.renewal_scheduler),
+                next_renewal=self.renewal_scheduler.next_renewal)
+
+        d = get_expiries(self.txacme_service.cert_store)
+        return d.addCallback(update_scheduler)
 
     def listen_events(self, reconnects=0):
         """
         Start listening for events from Marathon, running a sync when we first
         successfully subscribe and triggering a sync on API request events.
+        App and deployment events keep the app index up to date so that those
+        syncs don't need to fetch all the apps from Marathon.
         """
         self.log.info('Listening for events from Marathon...')
         self._attached = False
+        self.health_monitor.stream_detached()
 
         def on_finished(result, reconnects):
             # If the callback fires then the HTTP request to the event stream
@@ -98,16 +426,31 @@ class MarathonAcme(object):
                           'reconnecting... ({reconnects} so far)',
                           reconnects=reconnects)
             reconnects += 1
+            SSE_RECONNECTS.inc()
             return self.listen_events(reconnects)
 
         def log_failure(failure):
             self.log.failure('Failed to listen for events', failure)
             return failure
 
-        return self.marathon_client.get_events({
+        callbacks = {
             'event_stream_attached': self._sync_on_event_stream_attached,
-            'api_post_event': self._sync_on_api_post_event
-        }).addCallbacks(on_finished, log_failure, callbackArgs=[reconnects])
+            'api_post_event': self._sync_on_api_post_event,
+            'app_terminated_event': self._index_on_app_terminated_event,
+            'deployment_success': self._sync_on_deployment_success,
+        }
+        callbacks = dict(
+            (event_type, self._record_event(callback))
+            for event_type, callback in callbacks.items())
+
+        return self.marathon_client.get_events(callbacks).addCallbacks(
+            on_finished, log_failure, callbackArgs=[reconnects])
+
+    def _record_event(self, callback):
+        def record_and_handle(event):
+            self.health_monitor.event_received()
+            return callback(event)
+        return record_and_handle
 
     def _sync_on_event_stream_attached(self, event):
         if self._attached:
@@ -119,18 +462,102 @@ class MarathonAcme(object):
             return
 
         self._attached = True
+        self.health_monitor.stream_attached()
         self.log.info(
             'event_stream_attached event received (timestamp: "{timestamp}", '
             'remoteAddress: "{remoteAddress}"), running initial sync...',
             timestamp=event['timestamp'], remoteAddress=event['remoteAddress'])
-        return self.sync()
+        # We may have missed events while we weren't attached, so the app
+        # index must be seeded again by a full sync.
+        self._invalidate_app_index()
+        return self._sync_coalescer.trigger(immediate=True)
 
     def _sync_on_api_post_event(self, event):
         self.log.info(
             'api_post_event event received (timestamp: "{timestamp}", uri: '
             '"{uri}"), triggering a sync...', timestamp=event['timestamp'],
             uri=event['uri'])
-        return self.sync()
+        app = event.get('appDefinition')
+        if app is not None:
+            self._update_app_index({app['id']: app})
+        else:
+            self._invalidate_app_index()
+        return self._sync_coalescer.trigger()
+
+    def _index_on_app_terminated_event(self, event):
+        # Certificates are never removed, so there is nothing to sync
+        self.log.debug(
+            'app_terminated_event event received (timestamp: "{timestamp}", '
+            'appId: "{appId}"), removing app from index...',
+            timestamp=event['timestamp'], appId=event['appId'])
+        self._update_app_index({event['appId']: None})
+
+    def _sync_on_deployment_success(self, event):
+        self.log.info(
+            'deployment_success event received (timestamp: "{timestamp}", '
+            'id: "{id}"), triggering a sync...', timestamp=event['timestamp'],
+            id=event['id'])
+        plan = event.get('plan')
+        if plan is not None:
+            self._update_app_index(get_deployment_apps(plan))
+        else:
+            self._invalidate_app_index()
+        return self._sync_coalescer.trigger()
+
+    def _coalesced_sync(self, events):
+        """
+        Run a sync on behalf of a number of events that were coalesced into a
+        single sync. A full sync is run if the app index needs to be seeded,
+        else the domains are taken from the app index.
+        """
+        self.last_sync_events = events
+        SYNC_EVENTS.observe(events)
+        if self._app_domains is None:
+            self.log.info('Running a full sync for {events} coalesced '
+                          'events...', events=events)
+            return self.sync()
+
+        self.log.info('Running a sync from the app index for {events} '
+                      'coalesced events...', events=events)
+        return self.sync_app_index()
+
+    def _update_app_index(self, apps):
+        """
+        Update the app index with the given apps.
+
+        :param apps:
+            A dict mapping app IDs to app definitions, or to None if the app
+            has been removed.
+        """
+        if self._app_index_updates is not None:
+            # A full sync is fetching apps and the apps it gets may predate
+            # these updates, so it needs to apply them again afterwards.
+            self._app_index_updates.update(apps)
+
+        if self._app_domains is None:
+            return
+
+        for app_id, app in apps.items():
+            if app is None:
+                self._app_domains.pop(app_id, None)
+                continue
+
+            try:
+                self._app_domains[app_id] = self._app_acme_domains(app)
+            except Exception:
+                # Leave it to a full sync to fail loudly
+                self.log.failure(
+                    'Unable to find domains for app {app}, app index '
+                    'invalidated', app=app_id)
+                self._invalidate_app_index()
+                return
+
+    def _invalidate_app_index(self):
+        self._app_domains = None
+        self._app_index_generation += 1
+        # Check the certificate store again on the next sync, in case we
+        # missed something
+        self._converged_domains = None
 
     def sync(self):
         """
@@ -139,32 +566,124 @@ class MarathonAcme(object):
         have a certificate.
         """
         self.log.info('Starting a sync...')
+        started = self.reactor.seconds()
+        self._app_index_updates = {}
+
+        def clear_index_updates(result):
+            self._app_index_updates = None
+            return result
+
+        # Only the domains are kept for each app as the apps are received
+        app_domains = {}
+
+        def handle_app(app):
+            app_domains[app['id']] = self._app_acme_domains(app)
+
+        d = self.marathon_client.stream_apps(
+            handle_app, labels=self._app_labels)
+        d.addCallback(lambda _: app_domains)
+        d.addCallback(self._apps_acme_domains, self._app_index_generation)
+        d.addBoth(clear_index_updates)
+        return self._sync_domains(d, started)
+
+    def sync_app_index(self):
+        """
+        Find the domains that require certificates from the app index, and
+        issue certificates for any domains that don't already have a
+        certificate. The app index must have been seeded by a full sync.
+        """
+        self.log.info('Starting a sync from the app index...')
+        started = self.reactor.seconds()
+        domains = self._indexed_domains()
+        self.log.debug('Found {len_domains} domains in app index: {domains}',
+                       len_domains=len(domains), domains=domains)
+        return self._sync_domains(succeed(domains), started)
+
+    def _sync_domains(self, d, started):
+        def count_domains(domains):
+            DOMAINS.set(len(set(domains)))
+            return domains
 
         def log_success(result):
             self.log.info('Sync completed successfully')
+            self.health_monitor.sync_succeeded()
+            SYNCS.labels('success').inc()
+            SYNC_DURATION.observe(self.reactor.seconds() - started)
             return result
 
         def log_failure(failure):
             self.log.failure('Sync failed', failure, LogLevel.error)
+            SYNCS.labels('failure').inc()
+            SYNC_DURATION.observe(self.reactor.seconds() - started)
             return failure
 
-        return (self.marathon_client.get_apps()
-                .addCallback(self._apps_acme_domains)
-                .addCallback(self._filter_new_domains)
-                .addCallback(self._issue_certs)
+        return (d.addCallback(count_domains)
+                .addCallback(self._sync_changed_domains)
                 .addCallbacks(log_success, log_failure))
 
-    def _apps_acme_domains(self, apps):
-        domains = []
-        for app in apps:
-            domains.extend(self._app_acme_domains(app))
+    def _sync_changed_domains(self, domains):
+        """
+        Issue certificates for any new domains, unless the domains are the
+        same as in the last sync that found that they all had certificates, in
+        which case the certificate store doesn't need to be checked.
+        """
+        if frozenset(domains) == self._converged_domains:
+            self.log.debug('Domains unchanged since the last sync, no new '
+                           'domains to issue certificates for')
+            return []
+
+        d = self._filter_new_domains(domains)
+        return d.addCallback(self._issue_certs)
+
+    def _apps_acme_domains(self, app_domains, generation):
+        APPS.set(len(app_domains))
+
+        # Apply any updates that were received while we fetched the apps
+        updates, self._app_index_updates = self._app_index_updates or {}, None
+        for app_id, app in updates.items():
+            if app is None:
+                app_domains.pop(app_id, None)
+            else:
+                app_domains[app_id] = self._app_acme_domains(app)
+
+        if generation == self._app_index_generation:
+            self._app_domains = app_domains
 
+        domains = self._group_domains(app_domains)
         self.log.debug('Found {len_domains} domains for apps: {domains}',
                        len_domains=len(domains), domains=domains)
 
         return domains
 
+    def _indexed_domains(self):
+        return self._group_domains(self._app_domains)
+
+    def _group_domains(self, app_domains):
+        """
+        Collect the domains for all the apps, and remember which groups serve
+        each domain so that only their marathon-lb is reloaded when its
+        certificate is stored.
+
+        :param app_domains:
+            A dict of app IDs to the (group, domain) pairs for each app.
+        :return: The list of domains.
+        """
+        domains = []
+        domain_groups = {}
+        for group_domains in app_domains.values():
+            for group, domain in group_domains:
+                domains.append(domain)
+                domain_groups.setdefault(domain, set()).add(group)
+        self._domain_groups = domain_groups
+        return domains
+
     def _app_acme_domains(self, app):
+        """
+        Find the domains for an app in a single pass over its ports, for
+        all the groups that we issue certificates for.
+
+        :return: A list of (group, domain) pairs.
+        """
         app_domains = []
         labels = app['labels']
         app_group = labels.get('HAPROXY_GROUP')
@@ -175,14 +694,15 @@ class MarathonAcme(object):
             port_group = labels.get(
                 'HAPROXY_%d_GROUP' % (port_index,), app_group)
 
-            if port_group == self.group:
+            if port_group in self.mlb_cert_stores:
                 domain_label = labels.get(
                     'MARATHON_ACME_%d_DOMAIN' % (port_index,), '')
                 port_domains = parse_domain_label(domain_label)
 
                 # TODO: Support multiple domains per certificate (SAN).
                 if self._allow_multiple_certs:
-                    app_domains.extend(port_domains)
+                    app_domains.extend(
+                        (port_group, domain) for domain in port_domains)
                 elif port_domains:
                     if len(port_domains) > 1:
                         self.log.warn(
@@ -190,35 +710,111 @@ class MarathonAcme(object):
                             '{app}, only the first will be used',
                             port=port_index, app=app['id'])
 
-                    app_domains.append(port_domains[0])
+                    app_domains.append((port_group, port_domains[0]))
 
         self.log.debug(
             'Found {len_domains} domains for app {app}: {domains}',
-            len_domains=len(app_domains), app=app['id'], domains=app_domains)
+            len_domains=len(app_domains), app=app['id'],
+            domains=[domain for _, domain in app_domains])
 
         return app_domains
 
     def _filter_new_domains(self, marathon_domains):
         def filter_domains(stored_domains):
-            return set(marathon_domains) - set(stored_domains.keys())
+            new_domains = self._filter_owned_domains(
+                set(marathon_domains) - set(stored_domains))
+            if not new_domains:
+                self._converged_domains = frozenset(marathon_domains)
+            return self._filter_backoff_domains(new_domains)
 
-        d = self.txacme_service.cert_store.as_dict()
+        d = get_server_names(self.txacme_service.cert_store)
         d.addCallback(filter_domains)
         return d
 
+    def _filter_owned_domains(self, domains):
+        """
+        Remove the domains that other instances own.
+        """
+        if self.shard_membership is None:
+            return domains
+
+        owned = set(d for d in domains if self.owns_domain(d))
+        if len(owned) < len(domains):
+            self.log.debug(
+                'Leaving {count} domains to other instances',
+                count=len(domains) - len(owned))
+        return owned
+
+    def _filter_backoff_domains(self, domains):
+        """
+        Remove the domains that we're backing off issuing certificates for
+        after failures, and make sure a sync runs when the first backoff ends.
+        """
+        delays = dict((domain, self.failure_backoff.retry_delay(domain))
+                      for domain in domains)
+        backoff_domains = sorted(d for d, delay in delays.items() if delay > 0)
+        if not backoff_domains:
+            return domains
+
+        self.log.info(
+            'Backing off issuing certificates for {len_domains} domains after '
+            'failures: {domains}', len_domains=len(backoff_domains),
+            domains=backoff_domains)
+        self._sync_later(min(delays[d] for d in backoff_domains))
+        return set(domains) - set(backoff_domains)
+
     def _issue_certs(self, domains):
+        if not self.is_leader:
+            self.log.debug(
+                'Standing by, not issuing certificates for {len_domains} '
+                'domains', len_domains=len(domains))
+            return self._warm_cert_cache()
+
         if domains:
             self.log.info(
                 'Issuing certificates for {len_domains} domains: {domains}',
                 len_domains=len(domains), domains=domains)
         else:
             self.log.debug('No new domains to issue certificates for')
-        return gatherResults([self._issue_cert(domain) for domain in domains])
+        return gatherResults(
+            [self.issuance_scheduler.schedule(domain) for domain in domains])
+
+    def _warm_cert_cache(self):
+        """
+        Read the stored certificates so that they're cached if the store
+        caches them, ready for if we become the leader.
+        """
+        d = self.txacme_service.cert_store.as_dict()
+        d.addErrback(lambda f: self.log.failure(
+            'Error reading certificates while standing by', f))
+        return d.addCallback(lambda _: [])
 
     def _issue_cert(self, domain):
         """
-        Issue a certificate for the given domain.
+        Issue a certificate for the given domain, unless the order would
+        exceed the ACME rate limits, in which case it is deferred.
         """
+        # Renewals are exempt from the certificates per registered domain
+        # limit
+        renewal = domain in self._renewals
+        self._renewals.discard(domain)
+
+        # We may have been demoted, or the domain may have been given to
+        # another instance, while the order was queued
+        if not self.is_leader or not self.owns_domain(domain):
+            self.log.info(
+                'Dropping queued certificate order for "{domain}" as it is '
+                'now issued by another instance', domain=domain)
+            return succeed(None)
+
+        delay = self.rate_limiter.admit(domain, renewal=renewal)
+        if delay > 0:
+            self.log.warn(
+                'Deferring certificate order for "{domain}" by {delay:.0f}s '
+                'to stay within ACME rate limits', domain=domain, delay=delay)
+            self._sync_later(delay)
+            return succeed(None)
+
         def errback(failure):
             # Don't fail on some of the errors we could get from the ACME
             # server, rather just log an error so that we can continue with
@@ -233,10 +829,118 @@ class MarathonAcme(object):
                     'Error ({code}) issuing certificate for "{domain}": '
                     '{detail}', code=acme_error.code, domain=domain,
                     detail=acme_error.detail)
+
+                if acme_error.code == 'rateLimited':
+                    retry_after = get_retry_after(
+                        failure.value.response, self.reactor.seconds())
+                    self.rate_limiter.rate_limited(
+                        domain, acme_error.detail, retry_after)
+
+                # Don't retry the domain on every sync
+                return self.failure_backoff.record_failure(
+                    domain, acme_error.code)
             else:
                 # There are more error codes but if they happen then something
                 # serious has gone wrong-- carry on error-ing.
                 return failure
 
+        def record_success(result):
+            d = self.failure_backoff.record_success(domain)
+            d.addCallback(lambda _: self._track_expiry(domain))
+            return d.addCallback(lambda _: result)
+
+        started = self.reactor.seconds()
+
+        def observe_success(result):
+            ACME_ORDER_DURATION.labels('success').observe(
+                self.reactor.seconds() - started)
+            return result
+
+        def observe_failure(failure):
+            ACME_ORDER_DURATION.labels('failure').observe(
+                self.reactor.seconds() - started)
+            code = 'other'
+            if failure.check(txacme_ServerError):
+                code = failure.value.message.code
+            ACME_ORDER_FAILURES.labels(code).inc()
+            return failure
+
         d = self.txacme_service.issue_cert(domain)
-        return d.addErrback(errback)
+        d.addCallbacks(observe_success, observe_failure)
+        return d.addCallbacks(record_success, errback)
+
+    def _track_expiry(self, domain):
+        """
+        Schedule the renewal of a newly issued certificate.
+        """
+        def update_scheduler(pem_objects):
+            not_after = cert_not_after(pem_objects)
+            if not_after is not None:
+                self._update_expiry(domain, not_after)
+
+        d = self.txacme_service.cert_store.get(domain)
+        return d.addCallback(update_scheduler)
+
+    def _update_expiry(self, domain, not_after):
+        CERT_EXPIRY.labels(domain).set(not_after)
+        if self.owns_domain(domain):
+            self.renewal_scheduler.update(domain, not_after)
+        else:
+            self.renewal_scheduler.remove(domain)
+
+    def _renew_cert(self, domain):
+        """
+        Renew the certificate for a domain once it enters its renewal window.
+        Renewals go through the issuance scheduler, behind any new domains.
+        """
+        if not self.is_leader or not self.owns_domain(domain):
+            return succeed(None)
+        self._renewals.add(domain)
+        return self.issuance_scheduler.schedule(domain, priority=1)
+
+    def _sync_later(self, delay):
+        """
+        Make sure a sync runs after the given delay so that deferred orders
+        are retried once the rate limits allow them.
+        """
+        call = self._deferred_sync_call
+        if call is not None and call.active():
+            if call.getTime() <= self.reactor.seconds() + delay:
+                return
+            call.cancel()
+
+        def sync():
+            # Sync failures are already logged
+            self._sync_coalescer.trigger().addErrback(lambda _failure: None)
+        self._deferred_sync_call = self.reactor.callLater(delay, sync)
+
+    def reset_backoff(self, domain=None):
+        """
+        Reset the failure backoff for a domain, or all domains, and run a sync
+        so that certificates are issued for them straight away.
+
+        :return:
+            A Deferred that fires with the list of domains that were reset.
+        """
+        def sync(reset):
+            if reset:
+                # Sync failures are already logged
+                self._sync_coalescer.trigger().addErrback(
+                    lambda _failure: None)
+            return reset
+
+        return self.failure_backoff.reset(domain).addCallback(sync)
+
+    def issuance_status(self):
+        """
+        Get the status of certificate issuance for operators to inspect.
+        """
+        status = self.issuance_scheduler.status()
+        status['rate_limits'] = self.rate_limiter.status()
+        status['leader'] = self.is_leader
+        if self.shard_membership is not None:
+            status['shard'] = {
+                'member': self.shard_membership.member,
+                'members': self.shard_membership.members,
+            }
+        return status
@@ -0,0 +1,199 @@
+import bisect
+import hashlib
+
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from marathon_acme.clients.vault import CasError
+
+
+def _hash(value):
+    digest = hashlib.sha256(value.encode('utf-8')).hexdigest()
+    return int(digest[:16], 16)
+
+
+class HashRing(object):
+    """
+    Assign server names to members by consistent hashing, so that when a
+    member joins or leaves only the server names that it owns (or will own)
+    move to another member.
+    """
+
+    def __init__(self, members, points_per_member=100):
+        """
+        :param members: The names of the members.
+        :param points_per_member:
+            The number of points on the ring for each member. More points
+            spread the server names more evenly between members.
+        """
+        self.members = sorted(members)
+
+        points = sorted(
+            (_hash('{}-{}'.format(member, i)), member)
+            for member in self.members for i in range(points_per_member))
+        self._hashes = [h for h, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, server_name):
+        """
+        Get the member that owns a server name, or None if there are no
+        members.
+        """
+        if not self._hashes:
+            return None
+
+        index = bisect.bisect(self._hashes, _hash(server_name))
+        return self._owners[index % len(self._owners)]
+
+
+class VaultShardMembership(object):
+    """
+    Track the marathon-acme instances that share out the domains, using
+    heartbeats stored in a Vault key/value version 2 secret engine.
+
+    Each member increments its own heartbeat counter in a single key, using
+    check-and-set so that concurrent heartbeats don't overwrite each other.
+    Members whose counter doesn't change for the member timeout are dropped.
+    As with ``VaultLeaderLease``, durations are only ever measured on each
+    instance's own clock.
+    """
+
+    log = Logger()
+
+    def __init__(self, client, mount_path, member, clock, path='members',
+                 member_timeout=30, heartbeat_interval=10, cas_retries=3):
+        """
+        :param client: The Vault API client.
+        :param mount_path: The Vault key/value mount path.
+        :param member: A name for this instance that is unique among members.
+        :param clock: The ``IReactorTime`` provider to use.
+        :param path: The path of the members in the key/value engine.
+        :param member_timeout:
+            Amount of time in seconds that a member can go without a
+            heartbeat before it is dropped.
+        :param heartbeat_interval:
+            Amount of time in seconds between heartbeats. Must be less than
+            the member timeout.
+        :param cas_retries:
+            The number of times to retry a heartbeat straight away when
+            another member updated the key concurrently.
+        """
+        if heartbeat_interval >= member_timeout:
+            raise ValueError(
+                'heartbeat_interval must be less than member_timeout')
+
+        self._client = client
+        self._mount_path = mount_path
+        self.member = member
+        self._clock = clock
+        self._path = path
+        self._member_timeout = member_timeout
+        self._heartbeat_interval = heartbeat_interval
+        self._cas_retries = cas_retries
+
+        self.members = []
+        self._on_change = None
+        self._loop = None
+        # The last heartbeat seen from each other member and when it was
+        # first seen
+        self._seen = {}
+
+    def start(self, on_change):
+        """
+        Start sending heartbeats and tracking the other members.
+
+        :param on_change:
+            Function to call with the sorted list of member names whenever
+            the members change, including when they are first found.
+        """
+        self._on_change = on_change
+
+        self._loop = LoopingCall(self._heartbeat)
+        self._loop.clock = self._clock
+        self._loop.start(self._heartbeat_interval, now=True)
+
+    def stop(self):
+        """
+        Stop sending heartbeats and leave, so that the other members take
+        over our domains without waiting for the member timeout.
+
+        :return: A Deferred that fires when we have left.
+        """
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+        d = self._update(leaving=True, retries=self._cas_retries)
+        d.addErrback(lambda f: self.log.failure(
+            'Failed to leave the shard members', f))
+        return d
+
+    def _heartbeat(self):
+        d = self._update(leaving=False, retries=self._cas_retries)
+        d.addErrback(lambda f: self.log.failure(
+            'Error sending a shard membership heartbeat', f))
+        return d
+
+    def _update(self, leaving, retries):
+        now = self._clock.seconds()
+        d = self._client.read_kv2(self._path, mount_path=self._mount_path)
+
+        def write_heartbeat(response):
+            if response is None:
+                # cas = 0 means the members must not exist yet
+                version, heartbeats = 0, {}
+            else:
+                version = response['data']['metadata']['version']
+                heartbeats = response['data']['data']
+
+            members = self._live_members(heartbeats, now)
+            if not leaving:
+                self._set_members(members)
+
+            # Drop the members that have timed out while we're at it
+            data = dict((member, heartbeats[member])
+                        for member in members if member in heartbeats)
+            if leaving:
+                data.pop(self.member, None)
+            else:
+                data[self.member] = heartbeats.get(self.member, 0) + 1
+
+            return self._client.create_or_update_kv2(
+                self._path, data, cas=version, mount_path=self._mount_path)
+
+        def cas_mismatch(failure):
+            failure.trap(CasError)
+            if retries <= 0:
+                return failure
+            # Another member updated the key at the same time, try again
+            return self._update(leaving, retries - 1)
+
+        d.addCallback(write_heartbeat)
+        d.addErrback(cas_mismatch)
+        return d.addCallback(lambda _: None)
+
+    def _live_members(self, heartbeats, now):
+        for member, heartbeat in heartbeats.items():
+            if member == self.member:
+                continue
+            seen = self._seen.get(member)
+            if seen is None or seen[0] != heartbeat:
+                self._seen[member] = (heartbeat, now)
+
+        for member in list(self._seen.keys()):
+            if member not in heartbeats:
+                del self._seen[member]
+
+        members = set(
+            member for member, (_, seen_at) in self._seen.items()
+            if now - seen_at < self._member_timeout)
+        members.add(self.member)
+        return sorted(members)
+
+    def _set_members(self, members):
+        if members == self.members:
+            return
+
+        self.log.info('Shard members changed to {members}', members=members)
+        self.members = members
+        self._on_change(members)
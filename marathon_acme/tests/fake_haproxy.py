@@ -0,0 +1,160 @@
+from twisted.internet.defer import succeed
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import IStreamClientEndpoint
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+
+from zope.interface import implementer
+
+
+class FakeHAProxyRuntime(object):
+    """
+    A fake of the parts of the HAProxy runtime API (the stats socket) that
+    are used to update certificates.
+    """
+
+    def __init__(self, certs=None):
+        """
+        :param certs:
+            A dict of certificate paths that are referenced by the HAProxy
+            configuration to their PEM data.
+        """
+        self.certs = {} if certs is None else certs
+        self.transactions = {}
+        self.commands = []
+
+    def handle_command(self, command, payload=None):
+        """
+        Handle a command and return the response text.
+        """
+        self.commands.append(command)
+
+        if command.startswith('set ssl cert '):
+            path = command[len('set ssl cert '):]
+            if path not in self.certs:
+                return ("Can't replace a certificate which is not referenced "
+                        'by the configuration!\n')
+            if payload is None:
+                return "'set ssl cert' expects a payload\n"
+
+            if self.transactions:
+                if path not in self.transactions:
+                    return ('The ongoing transaction is about {}, you need '
+                            'to commit or abort it first\n'.format(
+                                list(self.transactions.keys())[0]))
+                self.transactions[path] = payload
+                return 'Transaction updated for certificate {}!\n'.format(
+                    path)
+            self.transactions[path] = payload
+            return 'Transaction created for certificate {}!\n'.format(path)
+
+        if command.startswith('commit ssl cert '):
+            path = command[len('commit ssl cert '):]
+            if path not in self.transactions:
+                return 'No ongoing transaction!\n'
+            self.certs[path] = self.transactions.pop(path)
+            return 'Committing {}\nSuccess!\n'.format(path)
+
+        if command.startswith('abort ssl cert '):
+            path = command[len('abort ssl cert '):]
+            if path not in self.transactions:
+                return 'No ongoing transaction!\n'
+            del self.transactions[path]
+            return 'Transaction aborted for certificate {}!\n'.format(path)
+
+        return 'Unknown command.\n'
+
+    def protocol(self):
+        return FakeHAProxyRuntimeProtocol(self)
+
+    def endpoint(self):
+        """
+        Get an endpoint that connects to this fake in memory.
+        """
+        return FakeRuntimeEndpoint(self)
+
+
+class FakeHAProxyRuntimeProtocol(Protocol):
+    """
+    Server side of the runtime API in non-interactive mode: read a single
+    command, with a payload if the command line ends in ``<<``, respond and
+    close the connection.
+    """
+
+    def __init__(self, runtime):
+        self._runtime = runtime
+        self._buffer = b''
+
+    def dataReceived(self, data):
+        self._buffer += data
+        if b'\n' not in self._buffer:
+            return
+
+        command, rest = self._buffer.split(b'\n', 1)
+        command = command.decode('utf-8')
+        payload = None
+        if command.endswith(' <<'):
+            # The payload is terminated by an empty line
+            if b'\n\n' not in rest:
+                return
+            payload, _ = rest.split(b'\n\n', 1)
+            payload = payload.decode('utf-8') + '\n'
+            command = command[:-len(' <<')]
+
+        response = self._runtime.handle_command(command, payload)
+        self.transport.write(response.encode('utf-8'))
+        self.transport.loseConnection()
+
+
+class _LoopbackTransport(object):
+    """
+    A minimal transport that delivers writes straight to the peer protocol.
+    """
+
+    def __init__(self, peer):
+        self._peer = peer
+        self.disconnecting = False
+        self.connection_lost = None
+
+    def write(self, data):
+        if not self.disconnecting:
+            self._peer.dataReceived(data)
+
+    def writeSequence(self, data):
+        self.write(b''.join(data))
+
+    def loseConnection(self):
+        if self.disconnecting:
+            return
+        self.disconnecting = True
+        self.connection_lost()
+
+
+@implementer(IStreamClientEndpoint)
+class FakeRuntimeEndpoint(object):
+    """
+    A client endpoint that connects to a ``FakeHAProxyRuntime`` in memory.
+    """
+
+    def __init__(self, runtime):
+        self._runtime = runtime
+
+    def connect(self, protocolFactory):
+        client = protocolFactory.buildProtocol(None)
+        server = self._runtime.protocol()
+
+        client_transport = _LoopbackTransport(server)
+        server_transport = _LoopbackTransport(client)
+
+        def connection_lost():
+            client_transport.disconnecting = True
+            server_transport.disconnecting = True
+            reason = Failure(ConnectionDone())
+            server.connectionLost(reason)
+            client.connectionLost(reason)
+        client_transport.connection_lost = connection_lost
+        server_transport.connection_lost = connection_lost
+
+        server.makeConnection(server_transport)
+        client.makeConnection(client_transport)
+        return succeed(client)
@@ -41,6 +41,12 @@ class FakeMarathon(object):
                            uri='/v2/apps/' + app_id.lstrip('/'),
                            appDefinition=app)
 
+    def remove_app(self, app_id):
+        assert app_id in self._apps
+        self._apps.pop(app_id)
+
+        self.trigger_event('app_terminated_event', appId=app_id)
+
     def get_apps(self):
         return list(self._apps.values())
 
@@ -88,8 +94,16 @@ class FakeMarathonAPI(object):
     @app.route('/v2/apps', methods=['GET'])
     def get_apps(self, request):
         self._called_get_apps = True
+        apps = self._marathon.get_apps()
+
+        # Only label existence selectors are supported
+        label = request.args.get(b'label')
+        if label is not None:
+            label = label[0].decode('utf-8')
+            apps = [app for app in apps if label in app.get('labels', {})]
+
         response = {
-            'apps': self._marathon.get_apps()
+            'apps': apps
         }
         request.setResponseCode(200)
         write_request_json(request, response)
@@ -138,6 +152,7 @@ class FakeMarathonLb(object):
         self.client = StubTreq(self.app.resource())
         self._signalled_hup = False
         self._signalled_usr1 = False
+        self.usr1_signal_count = 0
 
     def check_signalled_hup(self):
         """ Check and reset the ``_signalled_hup`` flag. """
@@ -158,5 +173,6 @@ class FakeMarathonLb(object):
     @app.route('/_mlb_signal/usr1')
     def signal_usr1(self, request):
         self._signalled_usr1 = True
+        self.usr1_signal_count += 1
         request.setHeader('content-type', 'text/plain')
         return u'Sent SIGUSR1 signal to marathon-lb'
@@ -40,6 +40,12 @@ class FakeVault(object):
         self._kv_data[path] = value
         return value['metadata']
 
+    def delete_kv_data(self, path):
+        """
+        Delete the KV data and metadata at the given path.
+        """
+        self._kv_data.pop(path, None)
+
     def _kv_v2(self, data, version=1):
         # NOTE: This ignores a bunch of response fields that are poorly
         # documented and that we don't care about anyway. It also uses some
@@ -58,8 +64,9 @@ class FakeVault(object):
 
 class FakeVaultAPI(object):
     """
-    A very simple fake Vault API. Only supports the key/value v2 read and
-    create/update APIs. Only supports a fixed mount path (``secret``).
+    A very simple fake Vault API. Only supports the key/value v2 read,
+    create/update, and delete metadata APIs. Only supports a fixed mount path
+    (``secret``).
     """
     app = Klein()
 
@@ -110,6 +117,15 @@ class FakeVaultAPI(object):
 
         self._reply(request, metadata)
 
+    @app.route('/v1/secret/metadata/', methods=['DELETE'], branch=True)
+    def delete_metadata(self, request):
+        if not self._check_token(request):
+            return
+
+        path = self._get_path(request, prefix='/v1/secret/metadata/')
+        self._vault.delete_kv_data(path)
+        request.setResponseCode(204)
+
     def _get_path(self, request, prefix='/v1/secret/data/'):
         # This is a workaround to get the full request path. Klein gives us
         # only the next path segment as the extra parameter to routes when
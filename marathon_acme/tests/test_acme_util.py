@@ -1,3 +1,4 @@
+import calendar
 from datetime import datetime, timedelta
 
 from cryptography import x509
@@ -5,6 +6,7 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+from josepy.jwa import RS256
 from josepy.jwk import JWKRSA
 
 import pem
@@ -13,22 +15,31 @@ import pytest
 
 from testtools.assertions import assert_that
 from testtools.matchers import (
-    Equals, HasLength, Is, IsInstance, MatchesDict, MatchesListwise,
-    MatchesStructure, Not)
-from testtools.twistedsupport import failed, succeeded
+    AllMatch, Equals, HasLength, Is, IsInstance, MatchesDict,
+    MatchesListwise, MatchesStructure, Not)
+from testtools.twistedsupport import failed, has_no_result, succeeded
 
-from twisted.internet.defer import succeed
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
 from twisted.python.compat import unicode
+from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
+from twisted.web.client import ResponseNeverReceived
+from twisted.web.http_headers import Headers
 
+from txacme.client import ServerError
+from txacme.interfaces import ICertificateStore
 from txacme.testing import MemoryStore
 from txacme.util import generate_private_key
 
 from marathon_acme.acme_util import (
-    MlbCertificateStore, _dump_pem_private_key_bytes,
-    _load_pem_private_key_bytes, generate_wildcard_pem_bytes, maybe_key,
-    maybe_key_vault)
-from marathon_acme.clients import MarathonLbClient, VaultClient
+    GroupCertificateStore, ListingDirectoryStore, MlbCertificateStore,
+    PersistentJWSClient, _dump_pem_private_key_bytes,
+    _load_pem_private_key_bytes, cert_not_after, generate_wildcard_pem_bytes,
+    get_expiries, get_server_names, maybe_key, maybe_key_vault)
+from marathon_acme.clients import (
+    HAProxyRuntimeClient, MarathonLbClient, VaultClient)
+from marathon_acme.tests.fake_haproxy import FakeHAProxyRuntime
 from marathon_acme.tests.fake_marathon import FakeMarathonLb
 from marathon_acme.tests.fake_vault import FakeVault, FakeVaultAPI
 from marathon_acme.tests.matchers import (
@@ -169,6 +180,261 @@ EXAMPLE_PEM_OBJECTS = [
     ]
 
 
+class TestGetServerNames(object):
+    def test_server_names(self):
+        """
+        When the certificate store can list server names, those names are
+        returned.
+        """
+        class ListingStore(object):
+            def server_names(self):
+                return succeed(['example.com'])
+
+            def as_dict(self):
+                raise AssertionError('as_dict() should not be called')
+
+        assert_that(get_server_names(ListingStore()),
+                    succeeded(Equals(['example.com'])))
+
+    def test_fallback_as_dict(self):
+        """
+        When the certificate store can't list server names, the names of the
+        certificates returned by ``as_dict()`` are returned.
+        """
+        store = MemoryStore({'example.com': EXAMPLE_PEM_OBJECTS})
+        assert_that(get_server_names(store),
+                    succeeded(Equals(['example.com'])))
+
+
+class TestGetExpiries(object):
+    def test_cert_not_after(self):
+        """
+        The expiry time of a list of PEM objects is the time, in seconds since
+        the epoch, that the certificate expires.
+        """
+        pem_objects = pem.parse(generate_wildcard_pem_bytes())
+        cert = x509.load_pem_x509_certificate(
+            pem_objects[1].as_bytes(), default_backend())
+
+        assert_that(cert_not_after(pem_objects), Equals(
+            calendar.timegm(cert.not_valid_after.utctimetuple())))
+
+    def test_cert_not_after_no_certs(self):
+        """
+        The expiry time of a list of PEM objects without any certificates is
+        None.
+        """
+        assert_that(cert_not_after(EXAMPLE_PEM_OBJECTS[:1]), Is(None))
+
+    def test_expiries(self):
+        """
+        When the certificate store can get expiry times, those times are
+        returned.
+        """
+        class ExpiriesStore(object):
+            def expiries(self):
+                return succeed({'example.com': 1234})
+
+            def as_dict(self):
+                raise AssertionError('as_dict() should not be called')
+
+        assert_that(get_expiries(ExpiriesStore()),
+                    succeeded(Equals({'example.com': 1234})))
+
+    def test_fallback_as_dict(self):
+        """
+        When the certificate store can't get expiry times, the certificates
+        returned by ``as_dict()`` are parsed for them.
+        """
+        pem_objects = pem.parse(generate_wildcard_pem_bytes())
+        store = MemoryStore({'example.com': pem_objects})
+        assert_that(get_expiries(store), succeeded(Equals(
+            {'example.com': cert_not_after(pem_objects)})))
+
+
+class TestListingDirectoryStore(object):
+    def test_server_names(self, tmpdir):
+        """
+        When the server names are listed, the names of the PEM files in the
+        directory are returned.
+        """
+        path = FilePath(str(tmpdir))
+        path.child('README').setContent(b'not a certificate')
+        store = ListingDirectoryStore(path)
+        assert_that(store.server_names(), succeeded(Equals([])))
+
+        assert_that(store.store('example.com', EXAMPLE_PEM_OBJECTS),
+                    succeeded(Is(None)))
+        assert_that(store.server_names(), succeeded(Equals(['example.com'])))
+
+
+class FakeAcmeResponse(object):
+    def __init__(self, nonce, error=None):
+        self.code = 200 if error is None else 400
+        content_type = (
+            'application/json' if error is None else
+            'application/problem+json')
+        self.headers = Headers({
+            'Content-Type': [content_type],
+            'Replay-Nonce': [nonce],
+        })
+        self._error = error
+
+    def json(self):
+        if self._error is None:
+            return succeed({})
+        return succeed({
+            'type': 'urn:ietf:params:acme:error:' + self._error,
+            'detail': 'error detail',
+        })
+
+
+class FakeAcmeTreq(object):
+    """
+    A treq client that gives the queued results in turn for each request.
+    """
+    def __init__(self, results):
+        self.results = results
+        self.methods = []
+
+    def request(self, method, url, **kwargs):
+        self.methods.append(method)
+        return self.results.pop(0)
+
+
+class EmptyMessage(object):
+    def json_dumps(self):
+        return '{}'
+
+
+class TestPersistentJWSClient(object):
+    def setup_method(self):
+        self.key = JWKRSA(key=generate_private_key(u'rsa'))
+
+    def test_post_retries_bad_nonce(self):
+        """
+        When a POST is rejected with a badNonce error again after txacme's
+        own retry, it is retried with the nonce from the error response.
+        """
+        treq = FakeAcmeTreq([
+            succeed(FakeAcmeResponse(b'bm9uY2Ux')),
+            succeed(FakeAcmeResponse(b'bm9uY2Uy', error='badNonce')),
+            succeed(FakeAcmeResponse(b'bm9uY2Uz', error='badNonce')),
+            succeed(FakeAcmeResponse(b'bm9uY2U0')),
+        ])
+        client = PersistentJWSClient(treq, self.key, RS256)
+
+        d = client.post(u'https://acme.example.com/new', EmptyMessage())
+
+        assert_that(d, succeeded(MatchesStructure(code=Equals(200))))
+        assert treq.methods == [u'HEAD', u'POST', u'POST', u'POST']
+
+    def test_post_bad_nonce_retries_exhausted(self):
+        """
+        When a POST is rejected with a badNonce error more times than it may
+        be retried, the error is returned.
+        """
+        treq = FakeAcmeTreq([
+            succeed(FakeAcmeResponse(b'bm9uY2Ux')),
+            succeed(FakeAcmeResponse(b'bm9uY2Uy', error='badNonce')),
+            succeed(FakeAcmeResponse(b'bm9uY2Uz', error='badNonce')),
+            succeed(FakeAcmeResponse(b'bm9uY2U0', error='badNonce')),
+            succeed(FakeAcmeResponse(b'bm9uY2U1', error='badNonce')),
+        ])
+        client = PersistentJWSClient(
+            treq, self.key, RS256, bad_nonce_retries=1)
+
+        d = client.post(u'https://acme.example.com/new', EmptyMessage())
+
+        assert_that(d, failed(MatchesStructure(value=MatchesStructure(
+            message=MatchesStructure(
+                typ=Equals('urn:ietf:params:acme:error:badNonce'))))))
+        # txacme retries once each time the POST is made
+        assert treq.methods == [u'HEAD', u'POST', u'POST', u'POST', u'POST']
+
+    def test_post_other_error(self):
+        """
+        When a POST is rejected with another ACME error, it is not retried.
+        """
+        treq = FakeAcmeTreq([
+            succeed(FakeAcmeResponse(b'bm9uY2Ux')),
+            succeed(FakeAcmeResponse(b'bm9uY2Uy', error='rateLimited')),
+        ])
+        client = PersistentJWSClient(treq, self.key, RS256)
+
+        d = client.post(u'https://acme.example.com/new', EmptyMessage())
+
+        assert_that(d, failed(MatchesStructure(value=IsInstance(ServerError))))
+        assert treq.methods == [u'HEAD', u'POST']
+
+    def test_post_lost_connection(self):
+        """
+        When a POST fails because the connection was lost, it is not retried
+        as the server may have acted on it.
+        """
+        treq = FakeAcmeTreq([
+            succeed(FakeAcmeResponse(b'bm9uY2Ux')),
+            fail(ResponseNeverReceived([Failure(RuntimeError())])),
+        ])
+        client = PersistentJWSClient(treq, self.key, RS256)
+
+        d = client.post(u'https://acme.example.com/new', EmptyMessage())
+
+        assert_that(d, failed(MatchesStructure(
+            value=IsInstance(ResponseNeverReceived))))
+        assert treq.methods == [u'HEAD', u'POST']
+
+
+class TestGroupCertificateStore(object):
+    def setup_method(self):
+        self.certificate_store = MemoryStore()
+        self.fake_marathon_lbs = {}
+        mlb_stores = {}
+        for group in ['external', 'internal']:
+            fake_marathon_lb = FakeMarathonLb()
+            client = MarathonLbClient(
+                ['http://lb1:9090'], client=fake_marathon_lb.client)
+            self.fake_marathon_lbs[group] = fake_marathon_lb
+            mlb_stores[group] = MlbCertificateStore(
+                self.certificate_store, client)
+
+        self.domain_groups = {}
+        self.store = GroupCertificateStore(
+            self.certificate_store, mlb_stores, self.domain_groups.get)
+
+    def signalled_groups(self):
+        return sorted(group for group, mlb in self.fake_marathon_lbs.items()
+                      if mlb.check_signalled_usr1())
+
+    def test_store(self):
+        """
+        When PEM objects are stored, the certificate is stored once and only
+        the marathon-lb for the groups that serve the server name are told to
+        send the USR1 signal.
+        """
+        self.domain_groups['example.com'] = set(['internal'])
+
+        d = self.store.store('example.com', EXAMPLE_PEM_OBJECTS)
+        assert_that(d, succeeded(Is(None)))
+
+        assert_that(self.signalled_groups(), Equals(['internal']))
+        assert_that(self.store.get('example.com'),
+                    succeeded(Equals(EXAMPLE_PEM_OBJECTS)))
+        assert_that(self.store.server_names(),
+                    succeeded(Equals(['example.com'])))
+
+    def test_store_unknown_groups(self):
+        """
+        When PEM objects are stored for a server name that isn't known to be
+        served by any group, the marathon-lb for every group is told to send
+        the USR1 signal.
+        """
+        d = self.store.store('example.com', EXAMPLE_PEM_OBJECTS)
+        assert_that(d, succeeded(Is(None)))
+
+        assert_that(self.signalled_groups(), Equals(['external', 'internal']))
+
+
 class TestMlbCertificateStore(object):
     def setup_method(self):
         self.fake_marathon_lb = FakeMarathonLb()
@@ -178,6 +444,12 @@ class TestMlbCertificateStore(object):
         certificate_store = MemoryStore()
         self.mlb_store = MlbCertificateStore(certificate_store, self.client)
 
+    def test_interface(self):
+        """
+        The store provides ``ICertificateStore``.
+        """
+        assert ICertificateStore.providedBy(self.mlb_store)
+
     def test_store(self):
         """
         When PEM objects are stored in the directory store, marathon-lb should
@@ -198,6 +470,8 @@ class TestMlbCertificateStore(object):
                     succeeded(Equals(EXAMPLE_PEM_OBJECTS)))
         assert_that(self.mlb_store.as_dict(),
                     succeeded(Equals({'example.com': EXAMPLE_PEM_OBJECTS})))
+        assert_that(self.mlb_store.server_names(),
+                    succeeded(Equals(['example.com'])))
 
     def test_store_unexpected_response(self):
         """
@@ -217,3 +491,122 @@ class TestMlbCertificateStore(object):
             RuntimeError,
             "Wrapped certificate store returned something non-None. Don't "
             "know what to do with 'foo'.")))
+
+    def mk_haproxy_store(self, runtime):
+        haproxy_client = HAProxyRuntimeClient([runtime.endpoint()])
+        return MlbCertificateStore(
+            MemoryStore(), self.client, haproxy_client=haproxy_client,
+            haproxy_cert_dir='/etc/ssl/mlb')
+
+    def test_store_haproxy_runtime(self):
+        """
+        When PEM objects are stored for a certificate that HAProxy already
+        knows about, the certificate should be updated through the HAProxy
+        runtime API and marathon-lb should not be reloaded.
+        """
+        runtime = FakeHAProxyRuntime({'/etc/ssl/mlb/example.com.pem': 'old'})
+        mlb_store = self.mk_haproxy_store(runtime)
+
+        d = mlb_store.store('example.com', EXAMPLE_PEM_OBJECTS)
+        assert_that(d, succeeded(HasLength(1)))
+
+        assert_that(
+            self.fake_marathon_lb.check_signalled_usr1(), Equals(False))
+        assert_that(runtime.certs['/etc/ssl/mlb/example.com.pem'], Equals(
+            ''.join(o.as_text() for o in EXAMPLE_PEM_OBJECTS)))
+        assert_that(mlb_store.get('example.com'),
+                    succeeded(Equals(EXAMPLE_PEM_OBJECTS)))
+
+    def test_store_haproxy_runtime_new_cert(self):
+        """
+        When PEM objects are stored for a certificate that HAProxy doesn't
+        know about, marathon-lb should be told to send the USR1 signal.
+        """
+        runtime = FakeHAProxyRuntime()
+        mlb_store = self.mk_haproxy_store(runtime)
+
+        d = mlb_store.store('example.com', EXAMPLE_PEM_OBJECTS)
+        assert_that(d, succeeded(MatchesListwise([
+            MatchesStructure(code=Equals(200))
+        ])))
+
+        assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
+        assert_that(runtime.certs, Equals({}))
+
+    def test_store_haproxy_runtime_error(self):
+        """
+        When PEM objects are stored, and updating the certificate through the
+        HAProxy runtime API fails, marathon-lb should be told to send the USR1
+        signal.
+        """
+        runtime = FakeHAProxyRuntime({'/etc/ssl/mlb/example.com.pem': 'old'})
+        runtime.transactions['/etc/ssl/mlb/other.com.pem'] = 'new'
+        mlb_store = self.mk_haproxy_store(runtime)
+
+        d = mlb_store.store('example.com', EXAMPLE_PEM_OBJECTS)
+        assert_that(d, succeeded(MatchesListwise([
+            MatchesStructure(code=Equals(200))
+        ])))
+
+        assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
+
+    def test_haproxy_cert_dir_required(self):
+        """
+        When an HAProxy runtime client is given without the directory that
+        HAProxy loads certificates from, an error is raised.
+        """
+        with pytest.raises(ValueError):
+            MlbCertificateStore(
+                MemoryStore(), self.client,
+                haproxy_client=HAProxyRuntimeClient([]))
+
+    def test_store_coalesced_reloads(self):
+        """
+        When PEM objects are stored in quick succession, marathon-lb should be
+        told to send the USR1 signal once for all the stores, after the quiet
+        period, and each store should complete once that reload is done.
+        """
+        clock = Clock()
+        mlb_store = MlbCertificateStore(
+            MemoryStore(), self.client, clock=clock, reload_quiet_period=5,
+            reload_max_delay=30)
+
+        ds = [mlb_store.store(name, EXAMPLE_PEM_OBJECTS)
+              for name in ['a.com', 'b.com', 'c.com']]
+        for d in ds:
+            assert_that(d, has_no_result())
+        assert_that(self.fake_marathon_lb.usr1_signal_count, Equals(0))
+
+        clock.advance(5)
+        assert_that(self.fake_marathon_lb.usr1_signal_count, Equals(1))
+        for d in ds:
+            assert_that(d, succeeded(MatchesListwise([
+                MatchesStructure(code=Equals(200))
+            ])))
+
+        assert_that(mlb_store.as_dict(), succeeded(HasLength(3)))
+
+    def test_store_coalesced_reloads_max_delay(self):
+        """
+        When PEM objects keep being stored, marathon-lb should be told to send
+        the USR1 signal once the maximum delay has passed.
+        """
+        clock = Clock()
+        mlb_store = MlbCertificateStore(
+            MemoryStore(), self.client, clock=clock, reload_quiet_period=5,
+            reload_max_delay=12)
+
+        ds = []
+        for i in range(4):
+            ds.append(mlb_store.store(
+                'example{}.com'.format(i), EXAMPLE_PEM_OBJECTS))
+            clock.advance(4)
+
+        # The first 3 were stored within the maximum delay
+        assert_that(self.fake_marathon_lb.usr1_signal_count, Equals(1))
+        assert_that(ds[:3], AllMatch(succeeded(HasLength(1))))
+        assert_that(ds[3], has_no_result())
+
+        clock.advance(5)
+        assert_that(self.fake_marathon_lb.usr1_signal_count, Equals(2))
+        assert_that(ds[3], succeeded(HasLength(1)))
@@ -0,0 +1,175 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is
+from testtools.twistedsupport import succeeded
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+
+from marathon_acme.backoff import FailureBackoff, FileFailureStore
+
+
+class MemoryFailureStore(object):
+    def __init__(self, failures=None):
+        self.failures = {} if failures is None else failures
+
+    def load(self):
+        return succeed(dict(self.failures))
+
+    def update(self, changes):
+        for domain, failure in changes.items():
+            if failure is None:
+                self.failures.pop(domain, None)
+            else:
+                self.failures[domain] = failure
+        return succeed(None)
+
+
+class TestFileFailureStore(object):
+    def test_load_not_exists(self, tmpdir):
+        """
+        When failures are loaded and the file does not exist, no failures are
+        returned.
+        """
+        store = FileFailureStore(FilePath(str(tmpdir)).child('failures.json'))
+        assert_that(store.load(), succeeded(Equals({})))
+
+    def test_update_load(self, tmpdir):
+        """
+        When failures are updated, the same failures can be loaded again.
+        """
+        path = FilePath(str(tmpdir)).child('failures.json')
+        failures = {'example.com': {
+            'failures': 1, 'retry_at': 10.0, 'error': 'connection'}}
+
+        assert_that(
+            FileFailureStore(path).update(failures), succeeded(Is(None)))
+        assert_that(FileFailureStore(path).load(), succeeded(Equals(failures)))
+
+    def test_update_merges(self, tmpdir):
+        """
+        When failures are updated, only the changed domains are written and
+        domains changed to None are removed.
+        """
+        path = FilePath(str(tmpdir)).child('failures.json')
+        a = {'failures': 1, 'retry_at': 10.0, 'error': 'connection'}
+        b = {'failures': 2, 'retry_at': 20.0, 'error': 'dns'}
+        store = FileFailureStore(path)
+        store.update({'a.com': a, 'b.com': b})
+
+        assert_that(store.update({'a.com': None, 'c.com': a}),
+                    succeeded(Is(None)))
+        assert_that(store.load(), succeeded(Equals({'b.com': b, 'c.com': a})))
+
+
+class TestFailureBackoff(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.store = MemoryFailureStore()
+
+    def mk_backoff(self, random=lambda: 1.0, **kwargs):
+        return FailureBackoff(
+            self.clock, store=self.store, base_delay=10, max_delay=100,
+            random=random, **kwargs)
+
+    def test_exponential_backoff(self):
+        """
+        Each consecutive failure for a domain doubles the backoff up to the
+        maximum delay.
+        """
+        backoff = self.mk_backoff()
+
+        delays = []
+        for _ in range(6):
+            backoff.record_failure('example.com', 'connection')
+            delays.append(backoff.retry_delay('example.com'))
+        assert_that(delays, Equals([10, 20, 40, 80, 100, 100]))
+
+    def test_jitter(self):
+        """
+        The backoff is jittered to between half and all of the delay.
+        """
+        backoff = self.mk_backoff(random=lambda: 0.0)
+        backoff.record_failure('example.com', 'connection')
+        assert_that(backoff.retry_delay('example.com'), Equals(5))
+
+    def test_retry_delay_passes(self):
+        """
+        Once the backoff for a domain has passed, it may be retried.
+        """
+        backoff = self.mk_backoff()
+        backoff.record_failure('example.com', 'connection')
+
+        self.clock.advance(9)
+        assert_that(backoff.retry_delay('example.com'), Equals(1))
+        self.clock.advance(1)
+        assert_that(backoff.retry_delay('example.com'), Equals(0))
+
+    def test_success_clears(self):
+        """
+        When issuance succeeds for a domain, the backoff for it is cleared and
+        the change is persisted.
+        """
+        backoff = self.mk_backoff()
+        backoff.record_failure('example.com', 'connection')
+        assert_that(self.store.failures, Equals({'example.com': {
+            'failures': 1, 'retry_at': 10, 'error': 'connection'}}))
+
+        backoff.record_success('example.com')
+        assert_that(backoff.retry_delay('example.com'), Equals(0))
+        assert_that(self.store.failures, Equals({}))
+
+    def test_load(self):
+        """
+        When the backoff is loaded, failures persisted in the store are used.
+        """
+        self.store.failures = {'example.com': {
+            'failures': 3, 'retry_at': 50, 'error': 'unknownHost'}}
+        backoff = self.mk_backoff()
+        assert_that(backoff.load(), succeeded(Is(None)))
+
+        assert_that(backoff.retry_delay('example.com'), Equals(50))
+        assert_that(backoff.status(), Equals({'example.com': {
+            'failures': 3, 'retry_in': 50, 'error': 'unknownHost'}}))
+
+    def test_keeps_other_changes(self):
+        """
+        When the backoff for a domain changes, changes made to the store by
+        other instances for other domains are kept.
+        """
+        backoff = self.mk_backoff()
+        backoff.record_failure('a.com', 'connection')
+
+        # Another instance backs off another domain
+        other = {'failures': 1, 'retry_at': 10, 'error': 'dns'}
+        self.store.failures['b.com'] = other
+
+        backoff.record_success('a.com')
+        assert_that(self.store.failures, Equals({'b.com': other}))
+
+    def test_reset_domain(self):
+        """
+        When the backoff is reset for a single domain, only that domain may be
+        retried.
+        """
+        backoff = self.mk_backoff()
+        backoff.record_failure('a.com', 'connection')
+        backoff.record_failure('b.com', 'connection')
+
+        assert_that(backoff.reset('a.com'), succeeded(Equals(['a.com'])))
+        assert_that(backoff.reset('c.com'), succeeded(Equals([])))
+        assert_that(backoff.retry_delay('a.com'), Equals(0))
+        assert_that(backoff.retry_delay('b.com'), Equals(10))
+        assert_that(sorted(self.store.failures.keys()), Equals(['b.com']))
+
+    def test_reset_all(self):
+        """
+        When the backoff is reset for all domains, all domains may be retried.
+        """
+        backoff = self.mk_backoff()
+        backoff.record_failure('a.com', 'connection')
+        backoff.record_failure('b.com', 'connection')
+
+        assert_that(backoff.reset(), succeeded(Equals(['a.com', 'b.com'])))
+        assert_that(backoff.status(), Equals({}))
+        assert_that(self.store.failures, Equals({}))
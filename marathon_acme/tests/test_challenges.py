@@ -0,0 +1,109 @@
+from acme import challenges
+
+from josepy.b64 import b64encode
+from josepy.jwk import JWKRSA
+
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is, MatchesStructure
+from testtools.twistedsupport import succeeded
+
+from treq.content import text_content
+from treq.testing import StubTreq
+
+from txacme.util import generate_private_key
+
+from marathon_acme.challenges import VaultKvHttp01Responder
+from marathon_acme.clients import VaultClient
+from marathon_acme.tests.fake_vault import FakeVault, FakeVaultAPI
+
+
+class TestVaultKvHttp01Responder(object):
+    def setup_method(self):
+        self.vault = FakeVault()
+        vault_api = FakeVaultAPI(self.vault)
+        self.client = VaultClient(
+            'http://localhost:8200', self.vault.token,
+            client=vault_api.client)
+        self.key = JWKRSA(key=generate_private_key(u'rsa'))
+
+    def mk_responder(self):
+        responder = VaultKvHttp01Responder(self.client, 'secret')
+        http = StubTreq(responder.resource)
+        return responder, http
+
+    def mk_challenge(self, token=b'0123456789abcdefghij'):
+        challenge = challenges.HTTP01(token=token)
+        response = challenge.response(self.key)
+        return challenge, response
+
+    def get(self, http, token):
+        return http.get('http://localhost/{}'.format(token))
+
+    def test_start_responding(self):
+        """
+        When we start responding to a challenge, the key authorization is
+        stored in Vault and served by the responder's resource.
+        """
+        responder, http = self.mk_responder()
+        challenge, response = self.mk_challenge()
+        token = challenge.encode('token')
+
+        d = responder.start_responding(u'example.com', challenge, response)
+        assert_that(d, succeeded(Is(None)))
+
+        data = self.vault.get_kv_data('challenges/{}'.format(token))
+        assert_that(data['data'], Equals(
+            {'key_authorization': response.key_authorization}))
+
+        d = self.get(http, token)
+        assert_that(d, succeeded(MatchesStructure(code=Equals(200))))
+        assert_that(d.addCallback(text_content),
+                    succeeded(Equals(response.key_authorization)))
+
+    def test_other_instance(self):
+        """
+        When another instance started responding to a challenge, the key
+        authorization is read from Vault and served.
+        """
+        responder, _ = self.mk_responder()
+        _, http = self.mk_responder()
+        challenge, response = self.mk_challenge()
+        token = challenge.encode('token')
+
+        responder.start_responding(u'example.com', challenge, response)
+
+        d = self.get(http, token)
+        assert_that(d, succeeded(MatchesStructure(code=Equals(200))))
+        assert_that(d.addCallback(text_content),
+                    succeeded(Equals(response.key_authorization)))
+
+    def test_stop_responding(self):
+        """
+        When we stop responding to a challenge, the key authorization is
+        removed from Vault and no longer served.
+        """
+        responder, http = self.mk_responder()
+        challenge, response = self.mk_challenge()
+        token = challenge.encode('token')
+
+        responder.start_responding(u'example.com', challenge, response)
+        d = responder.stop_responding(u'example.com', challenge, response)
+        assert_that(d, succeeded(Is(None)))
+
+        assert_that(self.vault.get_kv_data('challenges/{}'.format(token)),
+                    Is(None))
+        assert_that(self.get(http, token),
+                    succeeded(MatchesStructure(code=Equals(404))))
+
+    def test_unknown_token(self):
+        """
+        When there is no challenge for a token, or the token isn't a valid
+        ACME token, a 404 response is returned.
+        """
+        _, http = self.mk_responder()
+
+        token = b64encode(b'not-a-challenge').decode('ascii')
+        assert_that(self.get(http, token),
+                    succeeded(MatchesStructure(code=Equals(404))))
+        assert_that(self.get(http, 'not.a.token'),
+                    succeeded(MatchesStructure(code=Equals(404))))
@@ -0,0 +1,131 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, MatchesStructure
+from testtools.twistedsupport import failed, has_no_result, succeeded
+
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+
+from marathon_acme.coalesce import Coalescer
+
+
+class TestCoalescer(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.calls = []
+        self.call_ds = []
+
+    def func(self, triggers):
+        self.calls.append(triggers)
+        d = Deferred()
+        self.call_ds.append(d)
+        return d
+
+    def test_no_quiet_period(self):
+        """
+        When a trigger is made and there is no quiet period, the function is
+        called immediately and the trigger fires with the function's result.
+        """
+        coalescer = Coalescer(self.func, self.clock)
+
+        d = coalescer.trigger()
+        assert_that(self.calls, Equals([1]))
+        assert_that(d, has_no_result())
+
+        self.call_ds[0].callback('result')
+        assert_that(d, succeeded(Equals('result')))
+
+    def test_quiet_period(self):
+        """
+        When triggers are made within the quiet period of each other, a
+        single call is made once the quiet period passes without a trigger.
+        """
+        coalescer = Coalescer(self.func, self.clock, quiet_period=1)
+
+        d1 = coalescer.trigger()
+        self.clock.advance(0.9)
+        d2 = coalescer.trigger()
+        self.clock.advance(0.9)
+        assert_that(self.calls, Equals([]))
+
+        self.clock.advance(0.1)
+        assert_that(self.calls, Equals([2]))
+
+        self.call_ds[0].callback('result')
+        assert_that(d1, succeeded(Equals('result')))
+        assert_that(d2, succeeded(Equals('result')))
+
+    def test_max_delay(self):
+        """
+        When triggers keep arriving within the quiet period, the function is
+        called once the maximum delay after the first trigger passes.
+        """
+        coalescer = Coalescer(
+            self.func, self.clock, quiet_period=1, max_delay=2.5)
+
+        for _ in range(5):
+            coalescer.trigger()
+            self.clock.advance(0.5)
+        assert_that(self.calls, Equals([5]))
+
+    def test_immediate(self):
+        """
+        When an immediate trigger is made, the quiet period is skipped and any
+        waiting triggers are covered by the call.
+        """
+        coalescer = Coalescer(self.func, self.clock, quiet_period=1)
+
+        coalescer.trigger()
+        coalescer.trigger(immediate=True)
+        assert_that(self.calls, Equals([2]))
+        assert_that(self.clock.getDelayedCalls(), Equals([]))
+
+    def test_one_running_one_queued(self):
+        """
+        When triggers are made while a call is running, they are absorbed into
+        a single call after the running call finishes.
+        """
+        coalescer = Coalescer(self.func, self.clock)
+
+        d1 = coalescer.trigger()
+        d2 = coalescer.trigger()
+        d3 = coalescer.trigger()
+        assert_that(self.calls, Equals([1]))
+        assert_that(coalescer.pending, Equals(2))
+
+        self.call_ds[0].callback('first')
+        assert_that(d1, succeeded(Equals('first')))
+        assert_that(self.calls, Equals([1, 2]))
+        assert_that(d2, has_no_result())
+
+        self.call_ds[1].callback('second')
+        assert_that(d2, succeeded(Equals('second')))
+        assert_that(d3, succeeded(Equals('second')))
+        assert_that(coalescer.running, Equals(False))
+
+    def test_failure(self):
+        """
+        When the call fails, every trigger it covered fails and later triggers
+        still result in calls.
+        """
+        coalescer = Coalescer(
+            lambda triggers: fail(RuntimeError('oops')), self.clock)
+
+        d = coalescer.trigger()
+        assert_that(d, failed(MatchesStructure(
+            value=MatchesStructure(args=Equals(('oops',))))))
+
+        d = coalescer.trigger()
+        assert_that(d, failed(MatchesStructure(
+            value=MatchesStructure(args=Equals(('oops',))))))
+
+    def test_stop(self):
+        """
+        When the coalescer is stopped, any scheduled call is cancelled.
+        """
+        coalescer = Coalescer(self.func, self.clock, quiet_period=1)
+
+        coalescer.trigger()
+        coalescer.stop()
+        self.clock.advance(1)
+        assert_that(self.calls, Equals([]))
+        assert_that(coalescer.pending, Equals(0))
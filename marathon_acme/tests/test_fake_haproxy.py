@@ -0,0 +1,41 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals
+
+from twisted.test.proto_helpers import StringTransport
+
+from marathon_acme.tests.fake_haproxy import FakeHAProxyRuntime
+
+
+class TestFakeHAProxyRuntimeProtocol(object):
+    def setup_method(self):
+        self.runtime = FakeHAProxyRuntime({'/certs/example.com.pem': 'old'})
+        self.transport = StringTransport()
+        self.protocol = self.runtime.protocol()
+        self.protocol.makeConnection(self.transport)
+
+    def test_command(self):
+        """
+        When a command is received, the response is written and the
+        connection closed.
+        """
+        self.protocol.dataReceived(b'abort ssl cert /certs/example.com.pem\n')
+
+        assert_that(self.transport.value(),
+                    Equals(b'No ongoing transaction!\n'))
+        assert_that(self.transport.disconnecting, Equals(True))
+
+    def test_command_with_payload(self):
+        """
+        When a command with a payload is received in pieces, the command is
+        only handled once the payload is terminated by an empty line.
+        """
+        self.protocol.dataReceived(b'set ssl cert /certs/example.com.pem <<\n')
+        self.protocol.dataReceived(b'line 1\nline 2\n')
+        assert_that(self.transport.value(), Equals(b''))
+
+        self.protocol.dataReceived(b'\n')
+        assert_that(self.transport.value(), Equals(
+            b'Transaction created for certificate '
+            b'/certs/example.com.pem!\n'))
+        assert_that(self.runtime.transactions, Equals(
+            {'/certs/example.com.pem': 'line 1\nline 2\n'}))
@@ -263,6 +263,30 @@ class TestFakeMarathonAPI(object):
                         appDefinition=Equals(app)))
                 ]))))
 
+    def test_remove_app_triggers_app_terminated_event(self):
+        """
+        When an app is removed from the underlying fake Marathon, an
+        ``app_terminated_event`` should be received by any event listeners and
+        the app should no longer be returned.
+        """
+        self.marathon.add_app({'id': '/my-app_1', 'labels': {}})
+
+        response = self.client.get('http://localhost/v2/events', headers={
+            'Accept': 'text/event-stream'
+        })
+        assert_that(response, succeeded(IsSseResponse()))
+
+        self.marathon.remove_app('/my-app_1')
+
+        assert_that(response, succeeded(
+            After(
+                partial(collect_events, 'app_terminated_event'),
+                MatchesListwise([
+                    After(json.loads, IsMarathonEvent(
+                        'app_terminated_event', appId=Equals('/my-app_1')))
+                ]))))
+        assert_that(self.marathon.get_apps(), Equals([]))
+
     def test_get_events_event_types(self):
         """
         When a request is made to the event stream endpoint, and a set of
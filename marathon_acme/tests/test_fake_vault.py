@@ -1,6 +1,6 @@
 from testtools.assertions import assert_that
 from testtools.matchers import (
-    AfterPreprocessing as After, Equals, Is, MatchesAll)
+    AfterPreprocessing as After, Equals, Is, MatchesAll, MatchesStructure)
 from testtools.twistedsupport import succeeded
 
 from treq.content import json_content
@@ -309,3 +309,17 @@ class TestFakeVaultAPI(object):
         # Data unchanged since CAS didn't match
         assert_that(data['data'], Equals({'foo': 'bar'}))
         assert_that(data['metadata']['version'], Equals(1))
+
+    def test_delete_metadata(self):
+        """
+        When a request is made to delete the KV metadata for a path, the data
+        is removed and an empty response is returned.
+        """
+        self.vault.set_kv_data('my-secret', {'foo': 'bar'})
+
+        response = self.client.delete(
+            'http://localhost/v1/secret/metadata/my-secret',
+            headers={'X-Vault-Token': self.vault.token}
+        )
+        assert_that(response, succeeded(MatchesStructure(code=Equals(204))))
+        assert_that(self.vault.get_kv_data('my-secret'), Is(None))
@@ -0,0 +1,109 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is, MatchesStructure, Not
+
+from twisted.internet.task import Clock
+
+from marathon_acme.health import HealthMonitor
+
+
+class TestHealthMonitor(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+
+    def test_not_attached(self):
+        """
+        When we haven't attached to the event stream, the service is
+        unhealthy.
+        """
+        monitor = HealthMonitor(self.clock)
+        assert_that(monitor.health(), MatchesStructure(
+            healthy=Equals(False),
+            json_message=Equals({
+                'attached': False,
+                'last_event': None,
+                'last_sync': None,
+                'errors': ['Not attached to the Marathon event stream'],
+            })))
+
+    def test_attached(self):
+        """
+        When we're attached to the event stream, and no thresholds are set,
+        the service is healthy.
+        """
+        monitor = HealthMonitor(self.clock)
+        monitor.stream_attached()
+        monitor.sync_succeeded()
+
+        assert_that(monitor.health(), MatchesStructure(
+            healthy=Equals(True),
+            json_message=Equals({
+                'attached': True,
+                'last_event': 1000,
+                'last_sync': 1000,
+            })))
+
+        monitor.stream_detached()
+        assert_that(monitor.health().healthy, Equals(False))
+
+    def test_max_event_age(self):
+        """
+        When no events are received for longer than the maximum event age,
+        the service becomes unhealthy, and becomes healthy again once an
+        event is received.
+        """
+        monitor = HealthMonitor(self.clock, max_event_age=60)
+        monitor.stream_attached()
+
+        self.clock.advance(59)
+        assert_that(monitor.health().healthy, Equals(True))
+
+        self.clock.advance(1)
+        assert_that(monitor.health(), MatchesStructure(
+            healthy=Equals(False),
+            json_message=Equals({
+                'attached': True,
+                'last_event': 1000,
+                'last_sync': None,
+                'errors': ['No events received from Marathon in 60s'],
+            })))
+
+        monitor.event_received()
+        assert_that(monitor.health().healthy, Equals(True))
+
+    def test_max_sync_age(self):
+        """
+        When no sync has succeeded for longer than the maximum sync age, the
+        service is unhealthy.
+        """
+        monitor = HealthMonitor(self.clock, max_sync_age=60)
+        monitor.stream_attached()
+        assert_that(monitor.health().json_message['errors'],
+                    Equals(['No successful syncs']))
+
+        monitor.sync_succeeded()
+        assert_that(monitor.health().healthy, Equals(True))
+
+        self.clock.advance(60)
+        assert_that(monitor.health().json_message['errors'],
+                    Equals(['No successful syncs in 60s']))
+
+    def test_health_cached(self):
+        """
+        When the health is requested repeatedly, and nothing has changed, the
+        same health object is returned, and its JSON body is only serialized
+        once.
+        """
+        monitor = HealthMonitor(self.clock, max_event_age=60)
+        monitor.stream_attached()
+
+        health = monitor.health()
+        json_bytes = health.json_bytes
+        self.clock.advance(30)
+        assert_that(monitor.health(), Is(health))
+        assert_that(monitor.health().json_bytes, Is(json_bytes))
+
+        monitor.event_received()
+        assert_that(monitor.health(), Not(Is(health)))
+        assert_that(monitor.health().json_message['last_event'],
+                    Equals(1030))
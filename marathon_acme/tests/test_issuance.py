@@ -0,0 +1,139 @@
+import pytest
+
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, MatchesDict, MatchesStructure
+from testtools.twistedsupport import failed, has_no_result, succeeded
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from marathon_acme.issuance import IssuanceScheduler
+
+
+class TestIssuanceScheduler(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.issued = []
+        self.issue_ds = {}
+
+    def issue(self, domain):
+        self.issued.append(domain)
+        d = Deferred()
+        self.issue_ds[domain] = d
+        return d
+
+    def test_workers_must_be_positive(self):
+        """
+        When the scheduler is created with fewer than 1 worker, an error is
+        raised.
+        """
+        with pytest.raises(ValueError):
+            IssuanceScheduler(self.issue, self.clock, workers=0)
+
+    def test_bounded_concurrency(self):
+        """
+        When more domains are scheduled than there are workers, only as many
+        issuances as there are workers are in progress at once, and the rest
+        are started as issuances finish.
+        """
+        scheduler = IssuanceScheduler(self.issue, self.clock, workers=2)
+
+        ds = [scheduler.schedule(d) for d in ['a.com', 'b.com', 'c.com']]
+        assert_that(self.issued, Equals(['a.com', 'b.com']))
+        assert_that(scheduler.queue_depth, Equals(1))
+        assert_that(scheduler.issuing, Equals(2))
+
+        self.issue_ds['a.com'].callback('a')
+        assert_that(ds[0], succeeded(Equals('a')))
+        assert_that(self.issued, Equals(['a.com', 'b.com', 'c.com']))
+        assert_that(scheduler.queue_depth, Equals(0))
+        assert_that(ds[2], has_no_result())
+
+    def test_priority_order(self):
+        """
+        When domains are queued with different priorities, domains with lower
+        priority values are issued first, and domains with the same priority
+        are issued in the order they were scheduled.
+        """
+        scheduler = IssuanceScheduler(self.issue, self.clock, workers=1)
+
+        scheduler.schedule('first.com')
+        scheduler.schedule('low1.com', priority=10)
+        scheduler.schedule('high.com', priority=-1)
+        scheduler.schedule('low2.com', priority=10)
+        scheduler.schedule('normal.com')
+
+        for domain in ['first.com', 'high.com', 'normal.com', 'low1.com']:
+            self.issue_ds[domain].callback(None)
+
+        assert_that(self.issued, Equals([
+            'first.com', 'high.com', 'normal.com', 'low1.com', 'low2.com']))
+
+    def test_duplicate_domain(self):
+        """
+        When a domain is scheduled while it is already queued or being
+        issued, it is not issued again and both callers get the result.
+        """
+        scheduler = IssuanceScheduler(self.issue, self.clock, workers=1)
+
+        d1 = scheduler.schedule('a.com')
+        d2 = scheduler.schedule('a.com')
+        assert_that(self.issued, Equals(['a.com']))
+
+        self.issue_ds['a.com'].callback('a')
+        assert_that(d1, succeeded(Equals('a')))
+        assert_that(d2, succeeded(Equals('a')))
+
+        # Once finished, the domain can be scheduled again
+        scheduler.schedule('a.com')
+        assert_that(self.issued, Equals(['a.com', 'a.com']))
+
+    def test_failure(self):
+        """
+        When an issuance fails, the failure is returned for that domain and
+        the next queued domain is issued.
+        """
+        scheduler = IssuanceScheduler(self.issue, self.clock, workers=1)
+
+        d = scheduler.schedule('a.com')
+        scheduler.schedule('b.com')
+
+        self.issue_ds['a.com'].errback(RuntimeError('oops'))
+        assert_that(d, failed(MatchesStructure(
+            value=MatchesStructure(args=Equals(('oops',))))))
+        assert_that(self.issued, Equals(['a.com', 'b.com']))
+
+    def test_status(self):
+        """
+        The status of the scheduler reports the queue depth, issuances in
+        progress and how long each domain has been waiting.
+        """
+        scheduler = IssuanceScheduler(self.issue, self.clock, workers=1)
+
+        scheduler.schedule('a.com')
+        self.clock.advance(2)
+        scheduler.schedule('b.com', priority=1)
+        self.clock.advance(3)
+
+        assert_that(scheduler.status(), MatchesDict({
+            'workers': Equals(1),
+            'queue_depth': Equals(1),
+            'issuing': Equals(1),
+            'last_wait_time': Equals(0),
+            'domains': Equals({
+                'a.com': {
+                    'state': 'issuing',
+                    'priority': 0,
+                    'waited': 0,
+                    'issuing_for': 5,
+                },
+                'b.com': {
+                    'state': 'queued',
+                    'priority': 1,
+                    'waited': 3,
+                },
+            }),
+        }))
+
+        self.issue_ds['a.com'].callback(None)
+        assert_that(scheduler.last_wait_time, Equals(3))
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, IsInstance, MatchesStructure
+from testtools.twistedsupport import failed, has_no_result, succeeded
+
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
+
+from marathon_acme.json_stream import JsonArrayFieldProtocol
+
+
+class DummyTransport(object):
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+@pytest.fixture
+def items():
+    return list()
+
+
+@pytest.fixture
+def protocol(items):
+    protocol = JsonArrayFieldProtocol('apps', items.append)
+    protocol.makeConnection(DummyTransport())
+    return protocol
+
+
+def finish(protocol):
+    protocol.connectionLost(Failure(ResponseDone()))
+
+
+class TestJsonArrayFieldProtocol(object):
+    def test_items(self, protocol, items):
+        """
+        When a JSON object is received, each item in the array in the field
+        is passed to the handler and the number of items is returned once the
+        response is finished.
+        """
+        d = protocol.when_finished()
+        protocol.dataReceived(
+            b'{"apps": [{"id": "/app1"}, {"id": "/app2"}]}')
+
+        assert items == [{'id': '/app1'}, {'id': '/app2'}]
+        assert_that(d, has_no_result())
+
+        finish(protocol)
+        assert_that(d, succeeded(Equals(2)))
+
+    def test_items_in_pieces(self, protocol, items):
+        """
+        When a JSON object is received a byte at a time, each item is passed
+        to the handler as soon as all of it has been received, including
+        multi-byte characters split between pieces.
+        """
+        apps = [{'id': '/app{}'.format(i), 'labels': {'name': u'café'},
+                 'instances': i * 10} for i in range(5)]
+        data = json.dumps({'apps': apps, 'other': 123},
+                          ensure_ascii=False).encode('utf-8')
+
+        d = protocol.when_finished()
+        for i in range(len(data)):
+            protocol.dataReceived(data[i:i + 1])
+        finish(protocol)
+
+        assert items == apps
+        assert_that(d, succeeded(Equals(5)))
+
+    def test_other_fields(self, protocol, items):
+        """
+        When the JSON object has other fields before and after the array, they
+        are ignored.
+        """
+        d = protocol.when_finished()
+        protocol.dataReceived(
+            b'{"count": 1, "x": {"apps": [3]}, "apps": [1], "y": [2]}')
+        finish(protocol)
+
+        assert items == [1]
+        assert_that(d, succeeded(Equals(1)))
+
+    def test_empty_array(self, protocol, items):
+        """
+        When the array is empty, the handler is never called.
+        """
+        d = protocol.when_finished()
+        protocol.dataReceived(b' { "apps" : [ ] } ')
+        finish(protocol)
+
+        assert items == []
+        assert_that(d, succeeded(Equals(0)))
+
+    def test_missing_field(self, protocol, items):
+        """
+        When the JSON object doesn't have the field, an error is raised.
+        """
+        d = protocol.when_finished()
+        protocol.dataReceived(b'{"message": "hello"}')
+        finish(protocol)
+
+        assert_that(d, failed(MatchesStructure(
+            value=IsInstance(KeyError))))
+
+    def test_invalid_json(self, protocol, items):
+        """
+        When invalid JSON is received, the response is stopped and an error is
+        raised.
+        """
+        d = protocol.when_finished()
+        protocol.dataReceived(b'{"apps": [{"id": "/app1"} {"id": "/app2"}]}')
+
+        assert items == [{'id': '/app1'}]
+        assert protocol.transport.stopped
+
+        finish(protocol)
+        assert_that(d, failed(MatchesStructure(
+            value=IsInstance(ValueError))))
+
+    def test_incomplete_json(self, protocol, items):
+        """
+        When the response finishes before the whole JSON object has been
+        received, an error is raised.
+        """
+        d = protocol.when_finished()
+        protocol.dataReceived(b'{"apps": [{"id": "/app1"}, {"id": ')
+        finish(protocol)
+
+        assert items == [{'id': '/app1'}]
+        assert_that(d, failed(MatchesStructure(
+            value=IsInstance(ValueError))))
+
+    def test_max_length(self, items):
+        """
+        When a single item is longer than the maximum length, the response is
+        stopped and an error is raised.
+        """
+        protocol = JsonArrayFieldProtocol('apps', items.append, max_length=20)
+        protocol.makeConnection(DummyTransport())
+
+        d = protocol.when_finished()
+        protocol.dataReceived(b'{"apps": [{"id": "/a"}, {"id": "')
+        protocol.dataReceived(b'/a-very-long-app-id-that-goes-on')
+
+        assert items == [{'id': '/a'}]
+        assert protocol.transport.stopped
+
+        finish(protocol)
+        assert_that(d, failed(MatchesStructure(
+            value=IsInstance(ValueError))))
@@ -0,0 +1,154 @@
+import pytest
+
+from testtools.assertions import assert_that
+from testtools.matchers import Equals
+
+from twisted.internet.defer import fail
+from twisted.internet.task import Clock
+
+from marathon_acme.clients import VaultClient
+from marathon_acme.leader import VaultLeaderLease
+from marathon_acme.tests.fake_vault import FakeVault, FakeVaultAPI
+
+
+class FailableReadClient(object):
+    """
+    Wraps a ``VaultClient`` so that reads can be made to fail.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.read_error = None
+
+    def read_kv2(self, path, **kwargs):
+        if self.read_error is not None:
+            return fail(self.read_error)
+        return self._client.read_kv2(path, **kwargs)
+
+    def create_or_update_kv2(self, path, data, **kwargs):
+        return self._client.create_or_update_kv2(path, data, **kwargs)
+
+
+class TestVaultLeaderLease(object):
+    def setup_method(self):
+        self.vault = FakeVault()
+        vault_api = FakeVaultAPI(self.vault)
+        self.client = FailableReadClient(VaultClient(
+            'http://localhost:8200', self.vault.token,
+            client=vault_api.client))
+        self.events = []
+
+    def mk_lease(self, holder, clock=None):
+        clock = Clock() if clock is None else clock
+        lease = VaultLeaderLease(
+            self.client, 'secret', holder, clock, lease_duration=30,
+            renew_interval=10)
+        lease.start(lambda: self.events.append((holder, 'elected')),
+                    lambda: self.events.append((holder, 'demoted')))
+        return lease, clock
+
+    def lease_data(self):
+        return self.vault.get_kv_data('leader')
+
+    def test_renew_interval_too_long(self):
+        """
+        When the lease is created with a renew interval that isn't less than
+        the lease duration, an error is raised.
+        """
+        with pytest.raises(ValueError):
+            VaultLeaderLease(self.client, 'secret', 'a', Clock(),
+                             lease_duration=10, renew_interval=10)
+
+    def test_elected(self):
+        """
+        When the lease doesn't exist, the first replica takes it and becomes
+        the leader, and renews the lease every renew interval.
+        """
+        lease, clock = self.mk_lease('a')
+
+        assert_that(lease.is_leader, Equals(True))
+        assert_that(self.events, Equals([('a', 'elected')]))
+        assert_that(self.lease_data()['data'], Equals({'holder': 'a'}))
+        assert_that(self.lease_data()['metadata']['version'], Equals(1))
+
+        clock.advance(10)
+        assert_that(self.lease_data()['metadata']['version'], Equals(2))
+        assert_that(self.events, Equals([('a', 'elected')]))
+
+    def test_standby(self):
+        """
+        When another replica holds the lease and keeps renewing it, we stand
+        by.
+        """
+        leader, leader_clock = self.mk_lease('a')
+        standby, standby_clock = self.mk_lease('b')
+
+        for _ in range(10):
+            leader_clock.advance(10)
+            standby_clock.advance(10)
+
+        assert_that(leader.is_leader, Equals(True))
+        assert_that(standby.is_leader, Equals(False))
+        assert_that(self.events, Equals([('a', 'elected')]))
+
+    def test_takeover(self):
+        """
+        When the replica holding the lease stops renewing it, another replica
+        takes the lease over once the lease duration has passed since it saw
+        the lease change.
+        """
+        # The leader's clock never advances, so it never renews the lease
+        self.mk_lease('a')
+        standby, clock = self.mk_lease('b')
+
+        clock.advance(20)
+        assert_that(standby.is_leader, Equals(False))
+
+        clock.advance(10)
+        assert_that(standby.is_leader, Equals(True))
+        assert_that(self.events, Equals([('a', 'elected'), ('b', 'elected')]))
+        assert_that(self.lease_data()['data'], Equals({'holder': 'b'}))
+
+    def test_demoted_on_takeover(self):
+        """
+        When the leader finds that another replica has taken over the lease,
+        it is demoted.
+        """
+        leader, clock = self.mk_lease('a')
+        self.vault.set_kv_data('leader', {'holder': 'b'})
+
+        clock.advance(10)
+        assert_that(leader.is_leader, Equals(False))
+        assert_that(self.events, Equals([('a', 'elected'), ('a', 'demoted')]))
+
+    def test_step_down_on_errors(self):
+        """
+        When the leader can't renew the lease, it steps down before another
+        replica could take the lease over.
+        """
+        leader, clock = self.mk_lease('a')
+        self.client.read_error = RuntimeError('Vault is down')
+
+        clock.advance(10)
+        assert_that(leader.is_leader, Equals(True))
+
+        clock.advance(10)
+        assert_that(leader.is_leader, Equals(False))
+        assert_that(self.events, Equals([('a', 'elected'), ('a', 'demoted')]))
+
+    def test_stop_releases(self):
+        """
+        When the leader is stopped, it releases the lease so that another
+        replica takes over at its next check.
+        """
+        leader, _ = self.mk_lease('a')
+        standby, clock = self.mk_lease('b')
+
+        leader.stop()
+        assert_that(leader.is_leader, Equals(False))
+        assert_that(self.lease_data()['data'], Equals({'holder': None}))
+
+        clock.advance(10)
+        assert_that(standby.is_leader, Equals(True))
+        assert_that(self.events, Equals([
+            ('a', 'elected'), ('a', 'demoted'), ('b', 'elected')]))
@@ -4,7 +4,8 @@ from testtools import ExpectedException
 from testtools.assertions import assert_that
 from testtools.matchers import Equals
 
-from marathon_acme.marathon_util import get_number_of_app_ports
+from marathon_acme.marathon_util import (
+    get_deployment_apps, get_number_of_app_ports)
 
 TEST_APP = {
     'id': '/foovu1',
@@ -365,3 +366,75 @@ class TestGetNumberOfAppPortsFunc(object):
             RuntimeError,
                 r"Unknown Marathon networking mode 'container/iptables'"):
             get_number_of_app_ports(test_app)
+
+
+class TestGetDeploymentAppsFunc(object):
+    def test_apps_in_nested_groups(self):
+        """
+        When a deployment plan's steps have actions for apps in nested groups,
+        the definitions for those apps should be found in the target group.
+        """
+        app1 = {'id': '/app1', 'labels': {}}
+        app2 = {'id': '/group/app2', 'labels': {}}
+        plan = {
+            'target': {
+                'id': '/',
+                'apps': [app1, {'id': '/untouched', 'labels': {}}],
+                'groups': [{'id': '/group', 'apps': [app2], 'groups': []}],
+            },
+            'steps': [
+                {'actions': [{'action': 'StartApplication', 'app': '/app1'}]},
+                {'actions': [
+                    {'action': 'RestartApplication', 'app': '/group/app2'}]},
+            ]
+        }
+
+        assert_that(get_deployment_apps(plan), Equals({
+            '/app1': app1,
+            '/group/app2': app2,
+        }))
+
+    def test_removed_app(self):
+        """
+        When a deployment plan's steps have an action for an app that is not
+        in the target group, the app should be considered removed.
+        """
+        plan = {
+            'target': {'id': '/', 'apps': [], 'groups': []},
+            'steps': [
+                {'actions': [{'action': 'StopApplication', 'app': '/app1'}]},
+            ]
+        }
+
+        assert_that(get_deployment_apps(plan), Equals({'/app1': None}))
+
+    def test_legacy_steps(self):
+        """
+        When a deployment plan's steps are lists of actions, as in older
+        versions of Marathon, the actions should still be found.
+        """
+        app1 = {'id': '/app1', 'labels': {}}
+        plan = {
+            'target': {'id': '/', 'apps': [app1], 'groups': []},
+            'steps': [[{'action': 'ScaleApplication', 'app': '/app1'}]]
+        }
+
+        assert_that(get_deployment_apps(plan), Equals({'/app1': app1}))
+
+    def test_pod_actions(self):
+        """
+        When a deployment plan's steps have actions for pods rather than
+        apps, those actions should be ignored.
+        """
+        app1 = {'id': '/app1', 'labels': {}}
+        plan = {
+            'target': {'id': '/', 'apps': [app1], 'groups': []},
+            'steps': [
+                {'actions': [
+                    {'action': 'StartPod', 'pod': '/pod1'},
+                    {'action': 'StartApplication', 'app': '/app1'},
+                ]},
+            ]
+        }
+
+        assert_that(get_deployment_apps(plan), Equals({'/app1': app1}))
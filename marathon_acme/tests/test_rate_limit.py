@@ -0,0 +1,220 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is
+
+from twisted.internet.task import Clock
+from twisted.web.http_headers import Headers
+
+from marathon_acme.rate_limit import (
+    AcmeRateLimiter, TokenBucket, get_retry_after, registered_domain)
+
+
+class FakeResponse(object):
+    def __init__(self, headers):
+        self.headers = Headers(headers)
+
+
+class TestRegisteredDomain(object):
+    def test_simple(self):
+        """
+        The registered domain of a subdomain of a simple TLD is the domain
+        directly below the TLD.
+        """
+        assert_that(registered_domain('www.example.com'),
+                    Equals('example.com'))
+
+    def test_multi_label_suffix(self):
+        """
+        The registered domain of a domain with a multi-label public suffix is
+        the domain directly below the public suffix.
+        """
+        assert_that(registered_domain('a.b.example.co.uk'),
+                    Equals('example.co.uk'))
+
+    def test_case_and_trailing_dot(self):
+        """
+        The registered domain ignores case and any trailing dot.
+        """
+        assert_that(registered_domain('WWW.Example.COM.'),
+                    Equals('example.com'))
+
+
+class TestGetRetryAfter(object):
+    def test_no_response(self):
+        """ When there is no response, there is no Retry-After value. """
+        assert_that(get_retry_after(None, 0), Is(None))
+
+    def test_no_header(self):
+        """
+        When the response has no Retry-After header, there is no Retry-After
+        value.
+        """
+        assert_that(get_retry_after(FakeResponse({}), 0), Is(None))
+
+    def test_seconds(self):
+        """
+        When the Retry-After header is a number of seconds, that number is
+        returned.
+        """
+        response = FakeResponse({'Retry-After': ['120']})
+        assert_that(get_retry_after(response, 0), Equals(120))
+
+    def test_http_date(self):
+        """
+        When the Retry-After header is an HTTP date, the number of seconds
+        until that date is returned.
+        """
+        response = FakeResponse(
+            {'Retry-After': ['Wed, 21 Oct 2015 07:28:00 GMT']})
+        assert_that(get_retry_after(response, 1445412480 - 60), Equals(60))
+
+    def test_invalid(self):
+        """
+        When the Retry-After header can't be parsed, there is no Retry-After
+        value.
+        """
+        response = FakeResponse({'Retry-After': ['soon']})
+        assert_that(get_retry_after(response, 0), Is(None))
+
+
+class TestTokenBucket(object):
+    def setup_method(self):
+        self.clock = Clock()
+
+    def test_take_until_empty(self):
+        """
+        Tokens can be taken from a bucket until it is empty, at which point
+        the delay until the next token is available is the refill interval.
+        """
+        bucket = TokenBucket(2, 10, self.clock)
+
+        assert_that(bucket.take(), Equals(True))
+        assert_that(bucket.take(), Equals(True))
+        assert_that(bucket.take(), Equals(False))
+        assert_that(bucket.delay(), Equals(5))
+
+    def test_refill(self):
+        """
+        Tokens are refilled at a constant rate up to the bucket's capacity.
+        """
+        bucket = TokenBucket(2, 10, self.clock)
+        bucket.take()
+        bucket.take()
+
+        self.clock.advance(5)
+        assert_that(bucket.delay(), Equals(0))
+        assert_that(bucket.take(), Equals(True))
+
+        self.clock.advance(100)
+        assert_that(bucket.tokens, Equals(2))
+
+    def test_drain_retry_after(self):
+        """
+        When a bucket is drained with a Retry-After value, no tokens are
+        available until that time has passed.
+        """
+        bucket = TokenBucket(10, 10, self.clock)
+        bucket.drain(retry_after=30)
+
+        assert_that(bucket.delay(), Equals(30))
+        self.clock.advance(29)
+        assert_that(bucket.take(), Equals(False))
+
+        self.clock.advance(1)
+        assert_that(bucket.take(), Equals(True))
+
+
+class TestAcmeRateLimiter(object):
+    def setup_method(self):
+        self.clock = Clock()
+
+    def test_unlimited(self):
+        """
+        When no limits are configured, every order is admitted.
+        """
+        limiter = AcmeRateLimiter(self.clock)
+        for _ in range(1000):
+            assert_that(limiter.admit('example.com'), Equals(0))
+
+    def test_orders_per_account(self):
+        """
+        When the number of orders per account is exceeded, orders for any
+        domain are not admitted.
+        """
+        limiter = AcmeRateLimiter(
+            self.clock, orders_per_account=2, orders_period=10)
+
+        assert_that(limiter.admit('a.com'), Equals(0))
+        assert_that(limiter.admit('b.com'), Equals(0))
+        assert_that(limiter.admit('c.com'), Equals(5))
+
+    def test_certs_per_registered_domain(self):
+        """
+        When the number of certificates per registered domain is exceeded,
+        orders for subdomains of that domain are not admitted but orders for
+        other registered domains are.
+        """
+        limiter = AcmeRateLimiter(
+            self.clock, certs_per_domain=2, certs_period=10)
+
+        assert_that(limiter.admit('a.example.com'), Equals(0))
+        assert_that(limiter.admit('b.example.com'), Equals(0))
+        assert_that(limiter.admit('c.example.com'), Equals(5))
+        assert_that(limiter.admit('example.org'), Equals(0))
+
+    def test_renewal_exempt_from_certs_per_registered_domain(self):
+        """
+        When an order is for a renewal, it is admitted even if the number of
+        certificates per registered domain is exceeded, but it still takes a
+        token from the orders per account bucket.
+        """
+        limiter = AcmeRateLimiter(
+            self.clock, orders_per_account=10, certs_per_domain=1,
+            certs_period=10)
+
+        assert_that(limiter.admit('a.example.com'), Equals(0))
+        assert_that(limiter.admit('b.example.com'), Equals(10))
+        assert_that(
+            limiter.admit('a.example.com', renewal=True), Equals(0))
+        assert_that(limiter.status()['account'], Equals(8))
+
+    def test_not_admitted_takes_no_tokens(self):
+        """
+        When an order is not admitted because of one bucket, no tokens are
+        taken from the other buckets.
+        """
+        limiter = AcmeRateLimiter(
+            self.clock, orders_per_account=10, certs_per_domain=1)
+
+        limiter.admit('a.example.com')
+        limiter.admit('b.example.com')
+        assert_that(limiter.status()['account'], Equals(9))
+
+    def test_rate_limited_domain(self):
+        """
+        When the CA rejects an order because of the certificates per domain
+        limit, the bucket for the registered domain is drained until the
+        Retry-After time.
+        """
+        limiter = AcmeRateLimiter(
+            self.clock, orders_per_account=10, certs_per_domain=10)
+
+        limiter.rate_limited(
+            'a.example.com', 'Error creating new order :: too many '
+            'certificates already issued for: example.com', retry_after=60)
+
+        assert_that(limiter.admit('b.example.com'), Equals(60))
+        assert_that(limiter.admit('example.org'), Equals(0))
+
+    def test_rate_limited_account(self):
+        """
+        When the CA rejects an order because of the new orders limit, the
+        account bucket is drained.
+        """
+        limiter = AcmeRateLimiter(
+            self.clock, orders_per_account=10, certs_per_domain=10)
+
+        limiter.rate_limited(
+            'a.example.com', 'Error creating new order :: too many new '
+            'orders recently', retry_after=60)
+
+        assert_that(limiter.admit('example.org'), Equals(60))
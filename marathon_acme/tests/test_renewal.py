@@ -0,0 +1,186 @@
+from testtools.assertions import assert_that
+from testtools.matchers import (
+    AllMatch, Equals, GreaterThan, HasLength, Is, MatchesPredicate)
+
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+
+from marathon_acme.renewal import RenewalScheduler
+
+
+class TestRenewalScheduler(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.renewed = []
+        self.renew_ds = {}
+        self.scheduler = RenewalScheduler(
+            self.renew, self.clock, renew_before=100, retry_interval=10)
+
+    def renew(self, server_name):
+        self.renewed.append(server_name)
+        d = Deferred()
+        self.renew_ds[server_name] = d
+        return d
+
+    def test_single_timer(self):
+        """
+        When several certificates are tracked, only a single timer is
+        scheduled, for the time the earliest certificate enters its renewal
+        window.
+        """
+        self.scheduler.update('b.com', 1300)
+        self.scheduler.update('a.com', 1200)
+        self.scheduler.update('c.com', 1400)
+
+        assert_that(self.scheduler, HasLength(3))
+        assert_that(self.scheduler.next_renewal, Equals(1100))
+        [call] = self.clock.getDelayedCalls()
+        assert_that(call.getTime(), Equals(1100))
+
+    def test_renew_in_expiry_order(self):
+        """
+        When time passes, certificates are renewed as they enter their
+        renewal windows, in the order that they expire.
+        """
+        self.scheduler.update('b.com', 1300)
+        self.scheduler.update('a.com', 1200)
+
+        self.clock.advance(99)
+        assert_that(self.renewed, Equals([]))
+
+        self.clock.advance(1)
+        assert_that(self.renewed, Equals(['a.com']))
+
+        self.clock.advance(100)
+        assert_that(self.renewed, Equals(['a.com', 'b.com']))
+
+    def test_renew_already_due(self):
+        """
+        When a certificate is tracked that is already in its renewal window,
+        it is renewed straight away.
+        """
+        self.scheduler.update('a.com', 1050)
+        self.clock.advance(0)
+        assert_that(self.renewed, Equals(['a.com']))
+
+    def test_update_reschedules(self):
+        """
+        When a certificate is renewed, and the new expiry time is set, the
+        certificate is renewed again when the new certificate enters its
+        renewal window.
+        """
+        self.scheduler.update('a.com', 1200)
+        self.clock.advance(100)
+        assert_that(self.renewed, Equals(['a.com']))
+
+        self.scheduler.update('a.com', 2000)
+        self.renew_ds['a.com'].callback(None)
+        assert_that(self.scheduler.next_renewal, Equals(1900))
+
+        self.clock.advance(799)
+        assert_that(self.renewed, Equals(['a.com']))
+        self.clock.advance(1)
+        assert_that(self.renewed, Equals(['a.com', 'a.com']))
+
+    def test_update_earlier(self):
+        """
+        When the expiry time of a certificate is moved earlier, the timer is
+        moved earlier too, and the old renewal time is ignored.
+        """
+        self.scheduler.update('a.com', 1500)
+        self.scheduler.update('a.com', 1200)
+        assert_that(self.scheduler, HasLength(1))
+        assert_that(self.scheduler.next_renewal, Equals(1100))
+
+        self.clock.advance(100)
+        self.renew_ds['a.com'].callback(None)
+        self.scheduler.update('a.com', 2000)
+        self.clock.advance(300)
+        assert_that(self.renewed, Equals(['a.com']))
+
+    def test_retry_not_renewed(self):
+        """
+        When a renewal completes without the expiry time being updated, the
+        renewal is retried after the retry interval.
+        """
+        self.scheduler.update('a.com', 1200)
+        self.clock.advance(100)
+        self.renew_ds['a.com'].callback(None)
+        assert_that(self.scheduler.next_renewal, Equals(1110))
+
+        self.clock.advance(10)
+        assert_that(self.renewed, Equals(['a.com', 'a.com']))
+
+    def test_retry_failed(self):
+        """
+        When a renewal fails, the renewal is retried after the retry
+        interval.
+        """
+        scheduler = RenewalScheduler(
+            lambda _: fail(RuntimeError('boom')), self.clock,
+            renew_before=100, retry_interval=10)
+        scheduler.update('a.com', 1200)
+        self.clock.advance(100)
+        assert_that(scheduler.next_renewal, Equals(1110))
+
+    def test_remove(self):
+        """
+        When a certificate is removed, it is not renewed and the timer is
+        cancelled if there are no other certificates.
+        """
+        self.scheduler.update('a.com', 1200)
+        self.scheduler.remove('a.com')
+
+        assert_that(self.scheduler, HasLength(0))
+        assert_that(self.scheduler.next_renewal, Is(None))
+        assert_that(self.clock.getDelayedCalls(), Equals([]))
+
+    def test_stop(self):
+        """
+        When the scheduler is stopped, the timer is cancelled.
+        """
+        self.scheduler.update('a.com', 1200)
+        self.scheduler.stop()
+
+        assert_that(self.clock.getDelayedCalls(), Equals([]))
+        self.clock.advance(200)
+        assert_that(self.renewed, Equals([]))
+
+    def test_renew_spread(self):
+        """
+        When renewals are spread, each server name is renewed earlier by an
+        offset within the spread that is the same every time, and different
+        server names get different offsets.
+        """
+        scheduler = RenewalScheduler(
+            self.renew, self.clock, renew_before=100, renew_spread=50)
+        names = ['a%d.com' % (i,) for i in range(100)]
+        offsets = [scheduler.renew_offset(name) for name in names]
+
+        assert_that(offsets, AllMatch(MatchesPredicate(
+            lambda offset: 0 <= offset < 50, '%s is not within the spread')))
+        assert_that(len(set(offsets)), GreaterThan(90))
+        assert_that([scheduler.renew_offset(name) for name in names],
+                    Equals(offsets))
+
+        scheduler.update('a0.com', 1200)
+        assert_that(scheduler.next_renewal, Equals(1100 - offsets[0]))
+
+    def test_renew_spread_storm(self):
+        """
+        When many certificates that expire at the same time are renewed with
+        a spread, they are renewed at different times across the spread.
+        """
+        scheduler = RenewalScheduler(
+            self.renew, self.clock, renew_before=100, renew_spread=50)
+        for i in range(100):
+            scheduler.update('a%d.com' % (i,), 1200)
+
+        self.clock.advance(50)
+        assert_that(len(self.renewed), Equals(0))
+        self.clock.advance(25)
+        assert_that(len(self.renewed), MatchesPredicate(
+            lambda count: 25 < count < 75, '%s is not about half'))
+        self.clock.advance(25)
+        assert_that(self.renewed, HasLength(100))
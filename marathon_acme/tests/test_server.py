@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 from operator import methodcaller
 
+from prometheus_client import CONTENT_TYPE_LATEST
+
 from testtools.assertions import assert_that
 from testtools.matchers import AfterPreprocessing as After
-from testtools.matchers import Equals, MatchesAll, MatchesStructure
+from testtools.matchers import (
+    Contains, Equals, MatchesAll, MatchesStructure)
 from testtools.twistedsupport import succeeded
 
 from treq.content import json_content
 from treq.testing import StubTreq
 
+from twisted.internet.defer import succeed
 from twisted.web.resource import Resource
 from twisted.web.static import Data
 
@@ -65,6 +69,20 @@ class TestMarathonAcmeServer(object):
             After(json_content, succeeded(Equals({'message': 'pong'})))
         )))
 
+    def test_metrics(self):
+        """
+        When a GET request is made to the metrics endpoint, the metrics are
+        returned in the Prometheus text format.
+        """
+        response = self.client.get('http://localhost/metrics')
+        assert_that(response, succeeded(MatchesAll(
+            MatchesStructure(
+                code=Equals(200),
+                headers=HasHeader('Content-Type', [CONTENT_TYPE_LATEST])),
+            After(methodcaller('text', encoding='utf-8'), succeeded(Contains(
+                '# TYPE marathon_acme_syncs_total counter')))
+        )))
+
     def test_health_healthy(self):
         """
         When a GET request is made to the health endpoint, and the health
@@ -123,3 +141,100 @@ class TestMarathonAcmeServer(object):
             IsJsonResponseWithCode(503),
             After(json_content, succeeded(Equals({'error': u"I'm sad 🙁"})))
         )))
+
+    def test_issuance(self):
+        """
+        When a GET request is made to the issuance endpoint, the status from
+        the issuance handler should be returned as JSON.
+        """
+        self.server.set_issuance_handler(lambda: {'queue_depth': 3})
+
+        response = self.client.get('http://localhost/issuance')
+        assert_that(response, succeeded(MatchesAll(
+            IsJsonResponseWithCode(200),
+            After(json_content, succeeded(Equals({'queue_depth': 3})))
+        )))
+
+    def test_issuance_handler_unset(self):
+        """
+        When a GET request is made to the issuance endpoint, and the issuance
+        handler hasn't been set, a 501 status code should be returned together
+        with a JSON message that explains that the handler is not set.
+        """
+        response = self.client.get('http://localhost/issuance')
+        assert_that(response, succeeded(MatchesAll(
+            IsJsonResponseWithCode(501),
+            After(json_content, succeeded(Equals({
+                'error': 'Cannot determine issuance status: no handler set'
+            })))
+        )))
+
+    def test_backoff_status(self):
+        """
+        When a GET request is made to the backoff endpoint, the status from
+        the backoff status handler should be returned as JSON.
+        """
+        self.server.set_backoff_handlers(
+            lambda: {'example.com': {'failures': 1}}, None)
+
+        response = self.client.get('http://localhost/backoff')
+        assert_that(response, succeeded(MatchesAll(
+            IsJsonResponseWithCode(200),
+            After(json_content, succeeded(Equals({
+                'example.com': {'failures': 1}
+            })))
+        )))
+
+    def test_backoff_reset_all(self):
+        """
+        When a DELETE request is made to the backoff endpoint, the backoff
+        reset handler should be called for all domains and the domains that
+        were reset returned as JSON.
+        """
+        calls = []
+
+        def reset(domain):
+            calls.append(domain)
+            return succeed(['a.com', 'b.com'])
+        self.server.set_backoff_handlers(None, reset)
+
+        response = self.client.delete('http://localhost/backoff')
+        assert_that(response, succeeded(MatchesAll(
+            IsJsonResponseWithCode(200),
+            After(json_content, succeeded(Equals({
+                'reset': ['a.com', 'b.com']
+            })))
+        )))
+        assert_that(calls, Equals([None]))
+
+    def test_backoff_reset_domain(self):
+        """
+        When a DELETE request is made to the backoff endpoint for a domain,
+        the backoff reset handler should be called for that domain.
+        """
+        calls = []
+
+        def reset(domain):
+            calls.append(domain)
+            return succeed([domain])
+        self.server.set_backoff_handlers(None, reset)
+
+        response = self.client.delete('http://localhost/backoff/example.com')
+        assert_that(response, succeeded(MatchesAll(
+            IsJsonResponseWithCode(200),
+            After(json_content, succeeded(Equals({
+                'reset': ['example.com']
+            })))
+        )))
+        assert_that(calls, Equals(['example.com']))
+
+    def test_backoff_handlers_unset(self):
+        """
+        When a request is made to the backoff endpoints, and the handlers
+        haven't been set, a 501 status code should be returned.
+        """
+        response = self.client.get('http://localhost/backoff')
+        assert_that(response, succeeded(IsJsonResponseWithCode(501)))
+
+        response = self.client.delete('http://localhost/backoff')
+        assert_that(response, succeeded(IsJsonResponseWithCode(501)))
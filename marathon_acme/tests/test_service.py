@@ -13,13 +13,17 @@ from testtools.twistedsupport import failed, succeeded
 
 from twisted.internet.defer import succeed
 from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
 
 from txacme.client import ServerError as txacme_ServerError
 from txacme.testing import FakeClient, MemoryStore
 from txacme.util import generate_private_key
 
+from marathon_acme.backoff import FileFailureStore
 from marathon_acme.clients import MarathonClient, MarathonLbClient
+from marathon_acme.metrics import REGISTRY
 from marathon_acme.service import MarathonAcme, parse_domain_label
+from marathon_acme.sharding import HashRing
 from marathon_acme.tests.fake_marathon import (
     FakeMarathon, FakeMarathonAPI, FakeMarathonLb)
 from marathon_acme.tests.helpers import failing_client
@@ -77,6 +81,41 @@ is_marathon_lb_sigusr_response = MatchesListwise([  # Per marathon-lb instance
 ])
 
 
+def get_metric(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class FakeLeaderLease(object):
+    """
+    A leader lease that is only won or lost when the test says so.
+    """
+
+    def __init__(self):
+        self.is_leader = False
+
+    def elect(self, marathon_acme):
+        self.is_leader = True
+        marathon_acme._on_elected()
+
+    def demote(self, marathon_acme):
+        self.is_leader = False
+        marathon_acme._on_demoted()
+
+
+class FakeShardMembership(object):
+    """
+    Shard membership that only changes when the test says so.
+    """
+
+    def __init__(self, member):
+        self.member = member
+        self.members = []
+
+    def change(self, marathon_acme, members):
+        self.members = members
+        marathon_acme._on_shards_changed(members)
+
+
 class FailableTxacmeClient(FakeClient):
     """
     A fake txacme client that raises an error during the CSR issuance phase if
@@ -156,6 +195,26 @@ class TestMarathonAcme(object):
         })))
         assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
 
+    def test_listen_events_health(self):
+        """
+        When we listen for events from Marathon, the service is unhealthy
+        until we receive the event for ourselves subscribing, and the sync
+        and events are tracked by the health endpoint.
+        """
+        marathon_acme = self.mk_marathon_acme()
+        assert_that(marathon_acme.health_monitor.health().healthy,
+                    Equals(False))
+
+        marathon_acme.listen_events()
+
+        health = marathon_acme.health_monitor.health()
+        assert_that(health.healthy, Equals(True))
+        assert_that(health.json_message, MatchesDict({
+            'attached': Equals(True),
+            'last_event': Equals(self.clock.seconds()),
+            'last_sync': Equals(self.clock.seconds()),
+        }))
+
     def test_listen_events_attach_only_first(self):
         """
         When we're listening for events and receive multiple
@@ -228,6 +287,190 @@ class TestMarathonAcme(object):
         })))
         assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
 
+    def test_listen_events_api_requests_coalesced(self):
+        """
+        When we listen for events from Marathon with a sync quiet period, and
+        a burst of API request events is received, a single sync should be
+        performed once the events stop arriving.
+        """
+        marathon_acme = self.mk_marathon_acme(sync_quiet_period=1)
+        marathon_acme.listen_events()
+
+        # The initial sync on attaching is not delayed
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+        synced_events = get_metric('marathon_acme_sync_events_sum')
+
+        for i in range(3):
+            self.fake_marathon.add_app({
+                'id': '/my-app_%d' % (i,),
+                'labels': {
+                    'HAPROXY_GROUP': 'external',
+                    'MARATHON_ACME_0_DOMAIN': 'example%d.com' % (i,)
+                },
+                'portDefinitions': [
+                    {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+                ]
+            })
+            self.clock.advance(0.5)
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+
+        # The sync uses the app index rather than fetching all the apps
+        self.clock.advance(0.5)
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+        assert_that(marathon_acme.last_sync_events, Equals(3))
+        assert_that(get_metric('marathon_acme_sync_events_sum'),
+                    Equals(synced_events + 3))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example0.com': Not(Is(None)),
+            'example1.com': Not(Is(None)),
+            'example2.com': Not(Is(None)),
+        })))
+
+    def test_listen_events_api_request_uses_app_index(self):
+        """
+        When we listen for events from Marathon, and an API request event is
+        received with an app definition, the app index should be updated and
+        the sync should use it rather than fetching all the apps.
+        """
+        marathon_acme = self.mk_marathon_acme()
+        marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
+    def test_listen_events_api_request_no_app_definition(self):
+        """
+        When we listen for events from Marathon, and an API request event is
+        received without an app definition, a full sync should be performed.
+        """
+        marathon_acme = self.mk_marathon_acme()
+        marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        self.fake_marathon.trigger_event(
+            'api_post_event', clientIp=None, uri='/v2/groups/my-group')
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+    def test_listen_events_app_terminated_removes_from_index(self):
+        """
+        When we listen for events from Marathon, and an app terminated event
+        is received, the app should be removed from the app index without
+        running a sync.
+        """
+        marathon_acme = self.mk_marathon_acme()
+        marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        assert_that(marathon_acme._app_domains, Equals({
+            '/my-app_1': [('external', 'example.com')]
+        }))
+        assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
+
+        self.fake_marathon.remove_app('/my-app_1')
+        assert_that(marathon_acme._app_domains, Equals({}))
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+
+    def test_listen_events_deployment_success_updates_index(self):
+        """
+        When we listen for events from Marathon, and a deployment success
+        event is received, the apps affected by the deployment should be
+        updated in the app index and a sync should be performed using it.
+        """
+        marathon_acme = self.mk_marathon_acme()
+        marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        app = {
+            'id': '/group/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+        self.fake_marathon.trigger_event('deployment_success', id='1', plan={
+            'target': {
+                'id': '/',
+                'apps': [],
+                'groups': [{'id': '/group', 'apps': [app], 'groups': []}],
+            },
+            'steps': [{'actions': [
+                {'action': 'StartApplication', 'app': '/group/my-app_1'}]}],
+        })
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
+    def test_sync_app_index_updates_during_fetch(self):
+        """
+        When the app index is updated while a full sync is fetching the apps,
+        the updates should be applied on top of the fetched apps.
+        """
+        self.fake_marathon.add_app({
+            'id': '/old-app',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        marathon_acme = self.mk_marathon_acme()
+
+        # Simulate an event arriving while the apps are being fetched
+        stream_apps = marathon_acme.marathon_client.stream_apps
+
+        def stream_apps_with_event(handler, **kwargs):
+            d = stream_apps(handler, **kwargs)
+            marathon_acme._update_app_index({'/old-app': None})
+            return d
+        marathon_acme.marathon_client.stream_apps = stream_apps_with_event
+
+        assert_that(marathon_acme.sync(), succeeded(Equals([])))
+        assert_that(marathon_acme._app_domains, Equals({}))
+
     def test_listen_events_reconnects(self):
         """
         When we listen for events, and we connect successfully but the
@@ -362,6 +605,299 @@ class TestMarathonAcme(object):
 
         assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
 
+    def test_sync_unchanged(self):
+        """
+        When a sync is run after a sync that found that all the domains had
+        certificates, and the domains haven't changed, the certificate store
+        isn't checked again. Once the domains change, the certificate store is
+        checked again and new certificates are issued.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        marathon_acme = self.mk_marathon_acme()
+        assert_that(marathon_acme.sync(), succeeded(HasLength(1)))
+        assert_that(marathon_acme.sync(), succeeded(Equals([])))
+
+        as_dict_calls = []
+        as_dict = self.cert_store.as_dict
+
+        def counting_as_dict():
+            as_dict_calls.append(None)
+            return as_dict()
+        self.cert_store.as_dict = counting_as_dict
+
+        assert_that(marathon_acme.sync(), succeeded(Equals([])))
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+        assert_that(as_dict_calls, Equals([]))
+
+        self.fake_marathon.add_app({
+            'id': '/my-app_2',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example2.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        assert_that(marathon_acme.sync(), succeeded(HasLength(1)))
+        assert_that(as_dict_calls, HasLength(1))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None)),
+            'example2.com': Not(Is(None))
+        })))
+
+    def test_sync_app_schedules_renewal(self):
+        """
+        When a sync is run and a new certificate is issued, the certificate is
+        renewed when it enters its renewal window, without a sync.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        renew_before = 30 * 24 * 60 * 60
+        marathon_acme = self.mk_marathon_acme(renew_before=renew_before)
+        assert_that(marathon_acme.sync(), succeeded(HasLength(1)))
+
+        # The fake ACME client issues certificates valid for 90 days
+        scheduler = marathon_acme.renewal_scheduler
+        first_renewal = scheduler.next_renewal
+        assert_that(first_renewal - self.clock.seconds(), MatchesPredicate(
+            lambda delay: abs(delay - 60 * 24 * 60 * 60) < 2,
+            '%s is not about 60 days'))
+        first_certs = self.cert_store.as_dict().result['example.com']
+
+        self.clock.advance(first_renewal - self.clock.seconds())
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Equals(first_certs))
+        })))
+        assert_that(scheduler.next_renewal - first_renewal, MatchesPredicate(
+            lambda delay: abs(delay - 60 * 24 * 60 * 60) < 2,
+            '%s is not about 60 days'))
+
+    def test_load_expiries(self):
+        """
+        When the expiry times of the stored certificates are loaded, the
+        certificates are scheduled for renewal.
+        """
+        marathon_acme = self.mk_marathon_acme()
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        assert_that(marathon_acme.sync(), succeeded(HasLength(1)))
+
+        # Another instance doesn't know about the certificate until it loads
+        # the expiry times from the store
+        other = self.mk_marathon_acme()
+        assert_that(other.renewal_scheduler.next_renewal, Is(None))
+        assert_that(other.load_expiries(), succeeded(Is(None)))
+        assert_that(other.renewal_scheduler.next_renewal,
+                    Equals(marathon_acme.renewal_scheduler.next_renewal))
+
+    def test_sync_metrics(self):
+        """
+        When a sync is run and a certificate is issued, the sync, the apps
+        and domains seen, the ACME order and the certificate's expiry are
+        recorded in the metrics.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'metrics.example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        syncs = get_metric('marathon_acme_syncs_total', result='success')
+        orders = get_metric(
+            'marathon_acme_acme_order_duration_seconds_count',
+            result='success')
+
+        marathon_acme = self.mk_marathon_acme()
+        assert_that(marathon_acme.sync(), succeeded(HasLength(1)))
+
+        assert_that(get_metric('marathon_acme_syncs_total', result='success'),
+                    Equals(syncs + 1))
+        assert_that(get_metric('marathon_acme_apps'), Equals(1))
+        assert_that(get_metric('marathon_acme_domains'), Equals(1))
+        assert_that(get_metric(
+            'marathon_acme_acme_order_duration_seconds_count',
+            result='success'), Equals(orders + 1))
+        assert_that(get_metric(
+            'marathon_acme_certificate_expiry_timestamp_seconds',
+            domain='metrics.example.com'), MatchesPredicate(
+                lambda expiry: expiry > self.clock.seconds(),
+                '%s is not in the future'))
+
+    def test_sync_standby(self):
+        """
+        When a sync is run on a replica that isn't the leader, no
+        certificates are issued, and once the replica is elected the
+        certificates are issued.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        lease = FakeLeaderLease()
+        marathon_acme = self.mk_marathon_acme(leader_lease=lease)
+        assert_that(marathon_acme.sync(), succeeded(Equals([])))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+        assert_that(marathon_acme.issuance_status()['leader'], Equals(False))
+
+        lease.elect(marathon_acme)
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+        assert_that(marathon_acme.renewal_scheduler, HasLength(1))
+
+        # Once demoted, certificates aren't renewed
+        certs = self.cert_store.as_dict().result['example.com']
+        lease.demote(marathon_acme)
+        self.clock.advance(90 * 24 * 60 * 60)
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({
+            'example.com': certs
+        })))
+
+    def test_demoted_drops_queued_orders(self):
+        """
+        When an instance is demoted while certificate orders are queued, the
+        queued orders are not issued.
+        """
+        lease = FakeLeaderLease()
+        marathon_acme = self.mk_marathon_acme(leader_lease=lease)
+        lease.elect(marathon_acme)
+        lease.demote(marathon_acme)
+
+        # An order that was queued before the demotion reaches a worker
+        d = marathon_acme.issuance_scheduler.schedule('example.com')
+        assert_that(d, succeeded(Is(None)))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+
+    def test_elected_reloads_failure_backoff(self, tmpdir):
+        """
+        When an instance is elected leader, it reloads the failure backoff
+        from the store so that it doesn't retry domains that the previous
+        leader backed off.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        lease = FakeLeaderLease()
+        store = FileFailureStore(FilePath(str(tmpdir)).child('failures.json'))
+        marathon_acme = self.mk_marathon_acme(
+            leader_lease=lease, failure_store=store)
+        assert_that(marathon_acme.failure_backoff.load(), succeeded(Is(None)))
+
+        # The previous leader backs off issuing for the domain
+        store.update({'example.com': {
+            'failures': 1, 'retry_at': self.clock.seconds() + 300,
+            'error': 'dns'}})
+
+        lease.elect(marathon_acme)
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+        assert_that(marathon_acme.failure_backoff.status(), MatchesDict({
+            'example.com': MatchesDict({
+                'failures': Equals(1),
+                'retry_in': Equals(300),
+                'error': Equals('dns'),
+            })
+        }))
+
+        # Once the backoff passes, the certificate is issued
+        self.clock.advance(300)
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
+    def test_sync_sharded(self):
+        """
+        When a sync is run on an instance that shares out the domains with
+        other instances, certificates are only issued for the domains that it
+        owns, and once the other instances leave, the certificates for the
+        rest of the domains are issued.
+        """
+        domains = ['example{}.com'.format(i) for i in range(10)]
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': ','.join(domains)
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        ring = HashRing(['a', 'b'])
+        owned = [d for d in domains if ring.owner(d) == 'a']
+        # Sanity check that the domains are shared out
+        assert_that(owned, Not(Equals([])))
+        assert_that(owned, Not(Equals(domains)))
+
+        membership = FakeShardMembership('a')
+        marathon_acme = self.mk_marathon_acme(
+            shard_membership=membership, allow_multiple_certs=True)
+
+        # Until we know the members, we don't own any domains
+        assert_that(marathon_acme.sync(), succeeded(Equals([])))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+
+        membership.change(marathon_acme, ['a', 'b'])
+        assert_that(self.cert_store.as_dict(), succeeded(
+            AfterPreprocessing(sorted, Equals(owned))))
+        assert_that(marathon_acme.renewal_scheduler, HasLength(len(owned)))
+        assert_that(marathon_acme.issuance_status()['shard'], Equals({
+            'member': 'a',
+            'members': ['a', 'b'],
+        }))
+
+        membership.change(marathon_acme, ['a'])
+        assert_that(self.cert_store.as_dict(), succeeded(
+            AfterPreprocessing(sorted, Equals(domains))))
+        assert_that(marathon_acme.renewal_scheduler, HasLength(len(domains)))
+
     def test_sync_app_multiple_ports(self):
         """
         When a sync is run and there is an app with domain labels for multiple
@@ -635,6 +1171,90 @@ class TestMarathonAcme(object):
         assert_that(self.fake_marathon_lb.check_signalled_usr1(),
                     Equals(False))
 
+    def test_sync_multiple_groups(self):
+        """
+        When a sync is run for several groups, certificates are issued for
+        the domains of apps in any of the groups from a single fetch of the
+        apps, and only the marathon-lb for the group that serves each domain
+        is notified.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'HAPROXY_1_GROUP': 'internal',
+                'MARATHON_ACME_0_DOMAIN': 'example.com',
+                'MARATHON_ACME_1_DOMAIN': 'internal.example.com',
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}},
+                {'port': 9001, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        self.fake_marathon.add_app({
+            'id': '/my-app_2',
+            'labels': {
+                'HAPROXY_GROUP': 'other',
+                'MARATHON_ACME_0_DOMAIN': 'other.com',
+            },
+            'portDefinitions': [
+                {'port': 8000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        internal_marathon_lb = FakeMarathonLb()
+        internal_mlb_client = MarathonLbClient(
+            ['http://localhost:9091'], client=internal_marathon_lb.client,
+            reactor=self.clock)
+
+        marathon_acme = self.mk_marathon_acme(
+            extra_groups={'internal': internal_mlb_client})
+        assert_that(marathon_acme.sync(), succeeded(HasLength(2)))
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None)),
+            'internal.example.com': Not(Is(None))
+        })))
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+        assert_that(self.fake_marathon_lb.usr1_signal_count, Equals(1))
+        assert_that(internal_marathon_lb.usr1_signal_count, Equals(1))
+
+    def test_sync_app_labels(self):
+        """
+        When a sync is run with label selectors for the first ports' domain
+        labels, only the apps with those labels are fetched and certificates
+        are issued for their domains.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com',
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        self.fake_marathon.add_app({
+            'id': '/my-app_2',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+            },
+            'portDefinitions': [
+                {'port': 8000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        marathon_acme = self.mk_marathon_acme(app_label_ports=1)
+        assert_that(marathon_acme.sync(), succeeded(HasLength(1)))
+
+        assert_that(marathon_acme._app_domains, Equals({
+            '/my-app_1': [('external', 'example.com')]
+        }))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
     def test_sync_app_port_group_mismatch(self):
         """
         When a sync is run and Marathon has an app and that app has a matching
@@ -740,6 +1360,158 @@ class TestMarathonAcme(object):
         assert_that(self.fake_marathon_lb.check_signalled_usr1(),
                     Equals(False))
 
+    def test_sync_acme_server_failure_metrics(self):
+        """
+        When a sync is run and the ACME server returns an error, the failure
+        is counted by its error code.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        acme_error = acme_Error(
+            typ='urn:acme:error:serverInternal', detail='bar')
+        self.txacme_client.issuance_error = txacme_ServerError(
+            acme_error, None)
+        failures = get_metric(
+            'marathon_acme_acme_order_failures_total', code='serverInternal')
+
+        marathon_acme = self.mk_marathon_acme()
+        assert_that(marathon_acme.sync(), succeeded(Equals([None])))
+
+        assert_that(get_metric(
+            'marathon_acme_acme_order_failures_total', code='serverInternal'),
+            Equals(failures + 1))
+
+    def test_sync_acme_order_limit_deferred(self):
+        """
+        When a sync is run and issuing certificates for all the new domains
+        would exceed the ACME order limit, the orders beyond the limit are
+        deferred and a sync is run again once the limit allows them.
+        """
+        for i in range(2):
+            self.fake_marathon.add_app({
+                'id': '/my-app_%d' % (i,),
+                'labels': {
+                    'HAPROXY_GROUP': 'external',
+                    'MARATHON_ACME_0_DOMAIN': 'example%d.com' % (i,)
+                },
+                'portDefinitions': [
+                    {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+                ]
+            })
+
+        marathon_acme = self.mk_marathon_acme(acme_order_limit=1)
+        d = marathon_acme.sync()
+        assert_that(d, succeeded(HasLength(2)))
+
+        # Only one certificate issued
+        assert_that(self.cert_store.as_dict(), succeeded(HasLength(1)))
+
+        # After the order limit period, the other is issued
+        self.clock.advance(3 * 60 * 60)
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example0.com': Not(Is(None)),
+            'example1.com': Not(Is(None)),
+        })))
+
+    def test_sync_acme_server_rate_limited_defers_orders(self):
+        """
+        When a sync is run and the ACME server rejects an order because of a
+        rate limit, further orders for that registered domain are deferred
+        rather than sent to the server.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'a.example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        acme_error = acme_Error(typ='urn:acme:error:rateLimited', detail='bar')
+        self.txacme_client.issuance_error = txacme_ServerError(
+            acme_error, None)
+
+        marathon_acme = self.mk_marathon_acme(acme_domain_cert_limit=50)
+        assert_that(marathon_acme.sync(), succeeded(Equals([None])))
+        assert_that(marathon_acme.rate_limiter.admit('b.example.com'),
+                    Not(Equals(0)))
+
+    def test_sync_acme_server_failure_backoff(self):
+        """
+        When a sync is run and issuing a certificate for a domain fails with
+        an acceptable error, the domain is not retried on the next sync, but
+        is retried once the backoff has passed.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        acme_error = acme_Error(typ='urn:acme:error:connection', detail='bar')
+        self.txacme_client.issuance_error = txacme_ServerError(
+            acme_error, None)
+
+        marathon_acme = self.mk_marathon_acme(failure_backoff_base=60)
+        assert_that(marathon_acme.sync(), succeeded(Equals([None])))
+        assert_that(marathon_acme.failure_backoff.status(), MatchesDict({
+            'example.com': MatchesDict({
+                'failures': Equals(1),
+                'error': Equals('connection'),
+                'retry_in': Not(Equals(0)),
+            })
+        }))
+
+        # The next sync skips the domain
+        self.txacme_client.issuance_error = None
+        assert_that(marathon_acme.sync(), succeeded(Equals([])))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+
+        # Once the backoff passes, a sync is run and the domain retried
+        self.clock.advance(60)
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+        assert_that(marathon_acme.failure_backoff.status(), Equals({}))
+
+    def test_reset_backoff(self):
+        """
+        When the failure backoff is reset, a sync is run and certificates are
+        issued for the domains that were reset.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        marathon_acme = self.mk_marathon_acme()
+        marathon_acme.failure_backoff.record_failure('example.com', 'dns')
+
+        d = marathon_acme.reset_backoff('example.com')
+        assert_that(d, succeeded(Equals(['example.com'])))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
     def test_sync_acme_server_failure_unacceptable(self):
         """
         When a sync is run and we try to issue a certificate for a domain but
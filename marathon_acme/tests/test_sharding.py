@@ -0,0 +1,140 @@
+import pytest
+
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is, LessThan
+
+from twisted.internet.task import Clock
+
+from marathon_acme.clients import VaultClient
+from marathon_acme.sharding import HashRing, VaultShardMembership
+from marathon_acme.tests.fake_vault import FakeVault, FakeVaultAPI
+
+
+class TestHashRing(object):
+    def test_no_members(self):
+        """
+        When there are no members, no member owns a server name.
+        """
+        ring = HashRing([])
+        assert_that(ring.owner('example.com'), Is(None))
+
+    def test_stable(self):
+        """
+        The owner of a server name doesn't depend on the order the members
+        are given in.
+        """
+        domains = ['example{}.com'.format(i) for i in range(100)]
+        ring1 = HashRing(['a', 'b', 'c'])
+        ring2 = HashRing(['c', 'a', 'b'])
+        assert_that([ring1.owner(d) for d in domains],
+                    Equals([ring2.owner(d) for d in domains]))
+
+    def test_member_leaves(self):
+        """
+        When a member leaves, only the server names that it owned move to
+        other members.
+        """
+        domains = ['example{}.com'.format(i) for i in range(100)]
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b'])
+
+        for domain in domains:
+            if before.owner(domain) != 'c':
+                assert_that(after.owner(domain),
+                            Equals(before.owner(domain)))
+
+        # And the server names are spread out reasonably evenly
+        owned = [d for d in domains if before.owner(d) == 'c']
+        assert_that(abs(len(owned) - 33), LessThan(20))
+
+
+class TestVaultShardMembership(object):
+    def setup_method(self):
+        self.vault = FakeVault()
+        vault_api = FakeVaultAPI(self.vault)
+        self.client = VaultClient(
+            'http://localhost:8200', self.vault.token,
+            client=vault_api.client)
+        self.changes = []
+
+    def mk_membership(self, member, clock=None):
+        clock = Clock() if clock is None else clock
+        membership = VaultShardMembership(
+            self.client, 'secret', member, clock, member_timeout=30,
+            heartbeat_interval=10)
+        membership.start(
+            lambda members: self.changes.append((member, members)))
+        return membership, clock
+
+    def members_data(self):
+        return self.vault.get_kv_data('members')
+
+    def test_heartbeat_interval_too_long(self):
+        """
+        When the membership is created with a heartbeat interval that isn't
+        less than the member timeout, an error is raised.
+        """
+        with pytest.raises(ValueError):
+            VaultShardMembership(self.client, 'secret', 'a', Clock(),
+                                 member_timeout=10, heartbeat_interval=10)
+
+    def test_first_member(self):
+        """
+        When there are no members yet, the first member finds only itself
+        and sends a heartbeat every heartbeat interval.
+        """
+        membership, clock = self.mk_membership('a')
+
+        assert_that(membership.members, Equals(['a']))
+        assert_that(self.changes, Equals([('a', ['a'])]))
+        assert_that(self.members_data()['data'], Equals({'a': 1}))
+
+        clock.advance(10)
+        assert_that(self.members_data()['data'], Equals({'a': 2}))
+        assert_that(self.changes, Equals([('a', ['a'])]))
+
+    def test_member_joins(self):
+        """
+        When another member joins, the existing member finds it at its next
+        heartbeat.
+        """
+        membership_a, clock_a = self.mk_membership('a')
+        membership_b, _ = self.mk_membership('b')
+
+        assert_that(membership_b.members, Equals(['a', 'b']))
+
+        clock_a.advance(10)
+        assert_that(membership_a.members, Equals(['a', 'b']))
+        assert_that(self.changes, Equals([
+            ('a', ['a']), ('b', ['a', 'b']), ('a', ['a', 'b'])]))
+
+    def test_member_times_out(self):
+        """
+        When a member stops sending heartbeats, the other members drop it
+        once the member timeout has passed since its heartbeat last changed.
+        """
+        # The clock for 'a' never advances, so it never sends heartbeats
+        self.mk_membership('a')
+        membership, clock = self.mk_membership('b')
+
+        # Heartbeat after each heartbeat interval
+        clock.pump([10, 10])
+        assert_that(membership.members, Equals(['a', 'b']))
+
+        clock.advance(10)
+        assert_that(membership.members, Equals(['b']))
+        assert_that(self.members_data()['data'], Equals({'b': 4}))
+
+    def test_stop_leaves(self):
+        """
+        When a member is stopped, it leaves so that the other members take
+        over its domains at their next heartbeat.
+        """
+        membership_a, _ = self.mk_membership('a')
+        membership_b, clock = self.mk_membership('b')
+
+        membership_a.stop()
+        assert_that(self.members_data()['data'], Equals({'b': 1}))
+
+        clock.advance(10)
+        assert_that(membership_b.members, Equals(['b']))
@@ -12,13 +12,18 @@ import pytest
 
 from testtools.assertions import assert_that
 from testtools.matchers import (
-    AfterPreprocessing as After, Equals, Is, IsInstance, MatchesDict)
-from testtools.twistedsupport import failed, succeeded
+    AfterPreprocessing as After, Equals, HasLength, Is, IsInstance,
+    MatchesDict, Not)
+from testtools.twistedsupport import failed, has_no_result, succeeded
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
 
 from marathon_acme.clients import VaultClient
 from marathon_acme.tests.fake_vault import FakeVault, FakeVaultAPI
 from marathon_acme.tests.matchers import WithErrorTypeAndMessage
-from marathon_acme.vault_store import VaultKvCertificateStore, sort_pem_objects
+from marathon_acme.vault_store import (
+    VaultKvCertificateStore, VaultKvFailureStore, sort_pem_objects)
 
 
 FIXTURES = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'fixtures')
@@ -26,10 +31,12 @@ BUNDLE1_FILENAME = 'marathon-acme.example.org.pem'
 BUNDLE1_FINGERPRINT = (
     'BA09FBE7D87BF98800F3EA73F8A47271104C5036140E267ECF4BCA64DF6EE2A2')
 BUNDLE1_DNS_NAMES = ['marathon-acme.example.org']
+BUNDLE1_NOT_AFTER = '2019-09-13T12:16:00Z'
 BUNDLE2_FILENAME = 'mc2.example.org.pem'
 BUNDLE2_FINGERPRINT = (
     'C2220107708F22E74CAB2A168DFC6082D44B8DCD33EDB01659C605D4F5FE9519')
 BUNDLE2_DNS_NAMES = ['mc2.example.org']
+BUNDLE2_NOT_AFTER = '2019-09-13T13:07:00Z'
 
 
 def bundle_pem_objects(filename):
@@ -91,20 +98,24 @@ def EqualsFingerprint(fingerprint):
     return After(hex_str_to_bytes, Equals(hex_str_to_bytes(fingerprint)))
 
 
-def EqualsLiveValue(version, fingerprint, dns_names):
+def EqualsLiveValue(version, fingerprint, dns_names, not_after):
     return After(json.loads, MatchesDict({
         'version': Equals(version),
         'fingerprint': EqualsFingerprint(fingerprint),
-        'dns_names': Equals(dns_names)
+        'dns_names': Equals(dns_names),
+        'not_after': Equals(not_after)
     }))
 
 
-def live_value(version, fingerprint, dns_names):
-    return json.dumps({
+def live_value(version, fingerprint, dns_names, not_after=None):
+    value = {
         'version': version,
         'fingerprint': fingerprint,
         'dns_names': dns_names
-    })
+    }
+    if not_after is not None:
+        value['not_after'] = not_after
+    return json.dumps(value)
 
 
 def certificate_value(pem_objects):
@@ -116,6 +127,72 @@ def certificate_value(pem_objects):
     }
 
 
+class DelayedReadClient(object):
+    """
+    Wraps a ``VaultClient`` so that reads of certificates only happen when the
+    test releases them.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.pending = []
+
+    def read_kv2(self, path, **kwargs):
+        if not path.startswith('certificates/'):
+            return self._client.read_kv2(path, **kwargs)
+
+        d = Deferred()
+        self.pending.append((d, path, kwargs))
+        return d
+
+    def release(self):
+        d, path, kwargs = self.pending.pop(0)
+        self._client.read_kv2(path, **kwargs).chainDeferred(d)
+
+
+class RecordingReadClient(object):
+    """
+    Wraps a ``VaultClient`` to record the paths that are read.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.reads = []
+
+    def read_kv2(self, path, **kwargs):
+        self.reads.append(path)
+        return self._client.read_kv2(path, **kwargs)
+
+    def create_or_update_kv2(self, path, data, **kwargs):
+        return self._client.create_or_update_kv2(path, data, **kwargs)
+
+
+class HeldLiveWriteClient(RecordingReadClient):
+    """
+    Wraps a ``VaultClient`` so that writes to the live mapping only happen
+    when the test releases them.
+    """
+
+    def __init__(self, client):
+        super(HeldLiveWriteClient, self).__init__(client)
+        self.pending_writes = []
+        self.live_writes = []
+
+    def create_or_update_kv2(self, path, data, **kwargs):
+        if path != 'live':
+            return self._client.create_or_update_kv2(path, data, **kwargs)
+
+        self.live_writes.append(dict(data))
+        d = Deferred()
+        self.pending_writes.append((d, path, data, kwargs))
+        return d
+
+    def release_write(self):
+        d, path, data, kwargs = self.pending_writes.pop(0)
+        write_d = self._client.create_or_update_kv2(path, data, **kwargs)
+        write_d.chainDeferred(d)
+
+
 class TestVaultKvCertificateStore(object):
     def setup_method(self):
         self.vault = FakeVault()
@@ -164,7 +241,8 @@ class TestVaultKvCertificateStore(object):
         live_data = self.vault.get_kv_data('live')
         assert_that(live_data['data'], MatchesDict({
             'bundle1': EqualsLiveValue(cert_data['metadata']['version'],
-                                       BUNDLE1_FINGERPRINT, BUNDLE1_DNS_NAMES)
+                                       BUNDLE1_FINGERPRINT,
+                                       BUNDLE1_DNS_NAMES, BUNDLE1_NOT_AFTER)
         }))
         assert live_data['metadata']['version'] == 1
 
@@ -185,7 +263,8 @@ class TestVaultKvCertificateStore(object):
         assert_that(live_data['data'], MatchesDict({
             'p16n.org': Equals('dummy_data'),
             'bundle1': EqualsLiveValue(cert_data['metadata']['version'],
-                                       BUNDLE1_FINGERPRINT, BUNDLE1_DNS_NAMES)
+                                       BUNDLE1_FINGERPRINT,
+                                       BUNDLE1_DNS_NAMES, BUNDLE1_NOT_AFTER)
         }))
         assert live_data['metadata']['version'] == 2
 
@@ -214,7 +293,8 @@ class TestVaultKvCertificateStore(object):
         live_data = self.vault.get_kv_data('live')
         assert_that(live_data['data'], MatchesDict({
             'bundle': EqualsLiveValue(cert_data['metadata']['version'],
-                                      BUNDLE2_FINGERPRINT, BUNDLE2_DNS_NAMES)
+                                      BUNDLE2_FINGERPRINT,
+                                      BUNDLE2_DNS_NAMES, BUNDLE2_NOT_AFTER)
         }))
         assert live_data['metadata']['version'] == 2
 
@@ -240,7 +320,8 @@ class TestVaultKvCertificateStore(object):
             if writes == [1]:
                 self.vault.set_kv_data('live', {
                     'bundle':
-                        live_value(2, BUNDLE2_FINGERPRINT, BUNDLE2_DNS_NAMES)
+                        live_value(2, BUNDLE2_FINGERPRINT, BUNDLE2_DNS_NAMES,
+                                   BUNDLE2_NOT_AFTER)
                 })
             writes[0] += 1
         self.vault_api.set_pre_create_update(pre_create_update)
@@ -261,7 +342,8 @@ class TestVaultKvCertificateStore(object):
         live_data = self.vault.get_kv_data('live')
         assert_that(live_data['data'], MatchesDict({
             'bundle': EqualsLiveValue(cert_data['metadata']['version'],
-                                      BUNDLE2_FINGERPRINT, BUNDLE2_DNS_NAMES)
+                                      BUNDLE2_FINGERPRINT,
+                                      BUNDLE2_DNS_NAMES, BUNDLE2_NOT_AFTER)
         }))
         assert live_data['metadata']['version'] == 2
 
@@ -299,10 +381,117 @@ class TestVaultKvCertificateStore(object):
         assert_that(live_data['data'], MatchesDict({
             'p16n.org': Equals('dummy_data'),
             'bundle1': EqualsLiveValue(cert_data['metadata']['version'],
-                                       BUNDLE1_FINGERPRINT, BUNDLE1_DNS_NAMES)
+                                       BUNDLE1_FINGERPRINT,
+                                       BUNDLE1_DNS_NAMES, BUNDLE1_NOT_AFTER)
+        }))
+        assert live_data['metadata']['version'] == 2
+
+    def test_store_update_live_cas_backoff(self, bundle1):
+        """
+        When a certificate is stored in the store, and the live map update has
+        a CAS mismatch, the update is retried after a jittered delay that
+        increases with each mismatch.
+        """
+        clock = Clock()
+        store = VaultKvCertificateStore(
+            VaultClient('http://localhost:8200', self.vault.token,
+                        client=self.client),
+            'secret', clock=clock, cas_backoff_base=1, random=lambda: 0.5)
+
+        writes = [0]
+
+        def pre_create_update():
+            # Change the live mapping before the first two live map writes
+            if writes[0] in [1, 2]:
+                self.vault.set_kv_data(
+                    'live', {'p16n.org': 'dummy_data{}'.format(writes[0])})
+            writes[0] += 1
+        self.vault_api.set_pre_create_update(pre_create_update)
+
+        d = store.store('bundle1', bundle1)
+        assert_that(d, has_no_result())
+        assert_that(writes, Equals([2]))
+
+        clock.advance(0.5)
+        assert_that(d, has_no_result())
+        assert_that(writes, Equals([3]))
+
+        clock.advance(1)
+        assert_that(d, succeeded(IsInstance(dict)))
+        assert_that(writes, Equals([4]))
+
+        live_data = self.vault.get_kv_data('live')
+        assert_that(live_data['data'], MatchesDict({
+            'p16n.org': Equals('dummy_data2'),
+            'bundle1': EqualsLiveValue(1, BUNDLE1_FINGERPRINT,
+                                       BUNDLE1_DNS_NAMES, BUNDLE1_NOT_AFTER)
+        }))
+
+    def test_store_concurrent_group_commit(self, bundle1, bundle2):
+        """
+        When certificates are stored concurrently, the live mapping updates
+        queued while the live mapping is being written are written together
+        in a single write, and each store completes once its update is
+        written.
+        """
+        client = HeldLiveWriteClient(VaultClient(
+            'http://localhost:8200', self.vault.token, client=self.client))
+        store = VaultKvCertificateStore(client, 'secret')
+
+        d1 = store.store('bundle1', bundle1)
+        d2 = store.store('bundle2', bundle2)
+        d3 = store.store('bundle3', bundle1)
+        assert_that(client.live_writes, HasLength(1))
+
+        client.release_write()
+        assert_that(d1, succeeded(IsInstance(dict)))
+        assert_that(d2, has_no_result())
+        assert_that(d3, has_no_result())
+
+        # The other two updates are written together
+        assert_that(client.live_writes, HasLength(2))
+        assert_that(sorted(client.live_writes[1].keys()), Equals(
+            ['bundle1', 'bundle2', 'bundle3']))
+
+        client.release_write()
+        assert_that(d2, succeeded(IsInstance(dict)))
+        assert_that(d3, succeeded(IsInstance(dict)))
+        assert_that(client.live_writes, HasLength(2))
+
+        live_data = self.vault.get_kv_data('live')
+        assert_that(live_data['data'], MatchesDict({
+            'bundle1': EqualsLiveValue(1, BUNDLE1_FINGERPRINT,
+                                       BUNDLE1_DNS_NAMES, BUNDLE1_NOT_AFTER),
+            'bundle2': EqualsLiveValue(1, BUNDLE2_FINGERPRINT,
+                                       BUNDLE2_DNS_NAMES, BUNDLE2_NOT_AFTER),
+            'bundle3': EqualsLiveValue(1, BUNDLE1_FINGERPRINT,
+                                       BUNDLE1_DNS_NAMES, BUNDLE1_NOT_AFTER),
         }))
         assert live_data['metadata']['version'] == 2
 
+    def test_store_live_write_error(self, bundle1, bundle2):
+        """
+        When certificates are stored concurrently, and writing the live
+        mapping fails with an error other than a CAS mismatch, every store
+        waiting on that write fails.
+        """
+        client = HeldLiveWriteClient(VaultClient(
+            'http://localhost:8200', self.vault.token, client=self.client))
+        store = VaultKvCertificateStore(client, 'secret')
+
+        d1 = store.store('bundle1', bundle1)
+        d2 = store.store('bundle2', bundle2)
+        d3 = store.store('bundle3', bundle1)
+
+        client.release_write()
+        write_d, _, _, _ = client.pending_writes.pop(0)
+        write_d.errback(RuntimeError('Vault is down'))
+
+        assert_that(d1, succeeded(IsInstance(dict)))
+        for d in [d2, d3]:
+            assert_that(d, failed(WithErrorTypeAndMessage(
+                RuntimeError, 'Vault is down')))
+
     def test_as_dict(self, bundle1):
         """
         When the certificates are fetched as a dict, all certificates are
@@ -315,6 +504,88 @@ class TestVaultKvCertificateStore(object):
         d = self.store.as_dict()
         assert_that(d, succeeded(Equals({'bundle1': bundle1})))
 
+    def test_as_dict_concurrency(self, bundle1):
+        """
+        When the certificates are fetched as a dict, no more than the read
+        concurrency number of certificates are read at once.
+        """
+        names = ['bundle{}'.format(i) for i in range(5)]
+        for name in names:
+            self.vault.set_kv_data(
+                'certificates/' + name, certificate_value(bundle1))
+        self.vault.set_kv_data('live', dict((n, 'FINGERPRINT') for n in names))
+
+        client = DelayedReadClient(VaultClient(
+            'http://localhost:8200', self.vault.token, client=self.client))
+        store = VaultKvCertificateStore(client, 'secret', read_concurrency=2)
+
+        d = store.as_dict()
+        assert_that(d, has_no_result())
+        assert_that(client.pending, HasLength(2))
+
+        client.release()
+        assert_that(client.pending, HasLength(2))
+        client.release()
+        client.release()
+        client.release()
+        assert_that(client.pending, HasLength(1))
+        assert_that(d, has_no_result())
+
+        client.release()
+        assert_that(d, succeeded(
+            Equals(dict((n, bundle1) for n in names))))
+
+    def test_as_dict_paced(self, bundle1):
+        """
+        When the certificates are fetched as a dict, and the reads per second
+        are limited, the reads are spread out over time.
+        """
+        names = ['bundle{}'.format(i) for i in range(3)]
+        for name in names:
+            self.vault.set_kv_data(
+                'certificates/' + name, certificate_value(bundle1))
+        self.vault.set_kv_data('live', dict((n, 'FINGERPRINT') for n in names))
+
+        clock = Clock()
+        store = VaultKvCertificateStore(
+            VaultClient('http://localhost:8200', self.vault.token,
+                        client=self.client),
+            'secret', reads_per_second=2, clock=clock)
+
+        d = store.as_dict()
+        assert_that(d, has_no_result())
+
+        clock.advance(0.5)
+        assert_that(d, has_no_result())
+
+        clock.advance(0.5)
+        assert_that(d, succeeded(
+            Equals(dict((n, bundle1) for n in names))))
+
+    def test_as_dict_read_error(self, bundle1):
+        """
+        When the certificates are fetched as a dict, and a certificate in the
+        live mapping can't be read, the error is returned.
+        """
+        self.vault.set_kv_data(
+            'certificates/bundle1', certificate_value(bundle1))
+        self.vault.set_kv_data(
+            'live', {'bundle1': 'FINGERPRINT', 'bundle2': 'FINGERPRINT'})
+
+        d = self.store.as_dict()
+        assert_that(d, failed(WithErrorTypeAndMessage(
+            KeyError, repr('bundle2'))))
+
+    def test_invalid_read_options(self):
+        """
+        When the store is created with a read concurrency less than 1, or with
+        paced reads but no clock, an error is raised.
+        """
+        with pytest.raises(ValueError):
+            VaultKvCertificateStore(None, 'secret', read_concurrency=0)
+        with pytest.raises(ValueError):
+            VaultKvCertificateStore(None, 'secret', reads_per_second=10)
+
     def test_as_dict_empty(self):
         """
         When the certificates are fetched as a dict, and the live mapping does
@@ -322,3 +593,366 @@ class TestVaultKvCertificateStore(object):
         """
         d = self.store.as_dict()
         assert_that(d, succeeded(Equals({})))
+
+    def test_server_names(self):
+        """
+        When the server names are listed, the names in the live mapping are
+        returned without reading the certificates.
+        """
+        # No certificates are stored, so reading them would fail
+        self.vault.set_kv_data('live', {
+            'bundle1': 'FINGERPRINT', 'bundle2': 'FINGERPRINT'})
+
+        d = self.store.server_names()
+        assert_that(d, succeeded(
+            After(sorted, Equals(['bundle1', 'bundle2']))))
+
+    def test_server_names_empty(self):
+        """
+        When the server names are listed, and the live mapping does not exist,
+        an empty list is returned.
+        """
+        assert_that(self.store.server_names(), succeeded(Equals([])))
+
+
+class TestVaultKvCertificateStoreCache(object):
+    def setup_method(self):
+        self.vault = FakeVault()
+        vault_api = FakeVaultAPI(self.vault)
+        self.vault_client = VaultClient(
+            'http://localhost:8200', self.vault.token, client=vault_api.client)
+        self.client = RecordingReadClient(self.vault_client)
+
+    def mk_store(self, **kwargs):
+        return VaultKvCertificateStore(self.client, 'secret', **kwargs)
+
+    def store_cert(self, store, server_name, pem_objects):
+        d = store.store(server_name, pem_objects)
+        assert_that(d, succeeded(IsInstance(dict)))
+
+    def test_get_cached(self, bundle1):
+        """
+        When a certificate that was stored is fetched, and the live mapping
+        hasn't changed, the certificate is not read from Vault.
+        """
+        store = self.mk_store()
+        self.store_cert(store, 'bundle1', bundle1)
+        del self.client.reads[:]
+
+        assert_that(store.get('bundle1'), succeeded(Equals(bundle1)))
+        assert_that(self.client.reads, Equals(['live']))
+
+    def test_get_read_once(self, bundle1):
+        """
+        When a certificate is fetched twice, it is only read from Vault the
+        first time.
+        """
+        self.vault.set_kv_data(
+            'certificates/bundle1', certificate_value(bundle1))
+        self.vault.set_kv_data('live', {'bundle1': json.dumps({
+            'version': 1, 'fingerprint': BUNDLE1_FINGERPRINT,
+            'dns_names': BUNDLE1_DNS_NAMES})})
+        store = self.mk_store()
+
+        assert_that(store.get('bundle1'), succeeded(Equals(bundle1)))
+        assert_that(store.get('bundle1'), succeeded(Equals(bundle1)))
+        assert_that(self.client.reads, Equals(
+            ['live', 'certificates/bundle1', 'live']))
+
+    def test_as_dict_cached(self, bundle1, bundle2):
+        """
+        When the certificates are fetched as a dict, and the live mapping
+        hasn't changed, only the live mapping is read from Vault.
+        """
+        store = self.mk_store()
+        self.store_cert(store, 'bundle1', bundle1)
+        self.store_cert(store, 'bundle2', bundle2)
+        del self.client.reads[:]
+
+        assert_that(store.as_dict(), succeeded(Equals({
+            'bundle1': bundle1, 'bundle2': bundle2})))
+        assert_that(self.client.reads, Equals(['live']))
+
+    def test_as_dict_changed(self, bundle1, bundle2):
+        """
+        When the certificates are fetched as a dict, and a certificate was
+        changed by another store, only that certificate is read from Vault.
+        """
+        store = self.mk_store()
+        self.store_cert(store, 'bundle1', bundle1)
+        self.store_cert(store, 'bundle2', bundle2)
+
+        other_store = VaultKvCertificateStore(self.vault_client, 'secret')
+        self.store_cert(other_store, 'bundle1', bundle2)
+        del self.client.reads[:]
+
+        assert_that(store.as_dict(), succeeded(Equals({
+            'bundle1': bundle2, 'bundle2': bundle2})))
+        assert_that(sorted(self.client.reads), Equals(
+            ['certificates/bundle1', 'live']))
+
+        # The changed certificate is now cached
+        del self.client.reads[:]
+        assert_that(store.as_dict(), succeeded(HasLength(2)))
+        assert_that(self.client.reads, Equals(['live']))
+
+    def test_expiries(self, bundle1, bundle2):
+        """
+        When the expiry times of the certificates are fetched, they are taken
+        from the live mapping without reading the certificates.
+        """
+        store = self.mk_store()
+        self.store_cert(store, 'bundle1', bundle1)
+        self.store_cert(store, 'bundle2', bundle2)
+        del self.client.reads[:]
+
+        assert_that(store.expiries(), succeeded(Equals({
+            'bundle1': 1568376960,
+            'bundle2': 1568380020,
+        })))
+        assert_that(self.client.reads, Equals(['live']))
+
+    def test_expiries_legacy_live_value(self, bundle1, bundle2):
+        """
+        When the expiry times of the certificates are fetched, and some live
+        mapping entries don't have an expiry time, only those certificates
+        are read.
+        """
+        store = self.mk_store()
+        self.store_cert(store, 'bundle1', bundle1)
+        self.vault.set_kv_data(
+            'certificates/bundle2', certificate_value(bundle2))
+        live = self.vault.get_kv_data('live')['data']
+        live['bundle2'] = live_value(1, BUNDLE2_FINGERPRINT, BUNDLE2_DNS_NAMES)
+        self.vault.set_kv_data('live', live)
+        del self.client.reads[:]
+
+        assert_that(store.expiries(), succeeded(Equals({
+            'bundle1': 1568376960,
+            'bundle2': 1568380020,
+        })))
+        assert_that(
+            self.client.reads, Equals(['live', 'certificates/bundle2']))
+
+    def test_cache_size(self, bundle1, bundle2):
+        """
+        When more certificates are stored than fit in the cache, the least
+        recently used certificates are read from Vault again.
+        """
+        store = self.mk_store(cache_size=1)
+        self.store_cert(store, 'bundle1', bundle1)
+        self.store_cert(store, 'bundle2', bundle2)
+        del self.client.reads[:]
+
+        assert_that(store.as_dict(), succeeded(HasLength(2)))
+        assert_that(sorted(self.client.reads), Equals(
+            ['certificates/bundle1', 'live']))
+
+    def test_cache_disabled(self, bundle1):
+        """
+        When the cache is disabled, certificates are always read from Vault
+        and the live mapping is not read to get them.
+        """
+        store = self.mk_store(cache_size=0)
+        self.store_cert(store, 'bundle1', bundle1)
+        del self.client.reads[:]
+
+        assert_that(store.get('bundle1'), succeeded(Equals(bundle1)))
+        assert_that(store.get('bundle1'), succeeded(Equals(bundle1)))
+        assert_that(self.client.reads, Equals(
+            ['certificates/bundle1', 'certificates/bundle1']))
+
+
+class TestVaultKvCertificateStoreShards(object):
+    def setup_method(self):
+        self.vault = FakeVault()
+        vault_api = FakeVaultAPI(self.vault)
+        vault_client = VaultClient(
+            'http://localhost:8200', self.vault.token, client=vault_api.client)
+
+        self.store = VaultKvCertificateStore(
+            vault_client, 'secret', live_shards=4)
+
+    def shard_data(self):
+        shards = {}
+        for i in range(4):
+            data = self.vault.get_kv_data('live-shards/{}'.format(i))
+            if data is not None:
+                shards[i] = data
+        return shards
+
+    def test_store(self, bundle1, bundle2):
+        """
+        When certificates are stored in the store, the live mapping for each
+        is only written to the shard for its server name and the single-key
+        live mapping is not written.
+        """
+        # Find two server names in different shards
+        live_path = self.store._live_path
+        names = ['bundle{}'.format(i) for i in range(10)]
+        name1 = names[0]
+        name2 = next(n for n in names if live_path(n) != live_path(name1))
+
+        d = self.store.store(name1, bundle1)
+        assert_that(d, succeeded(IsInstance(dict)))
+        d = self.store.store(name2, bundle2)
+        assert_that(d, succeeded(IsInstance(dict)))
+
+        assert_that(self.vault.get_kv_data('live'), Is(None))
+        shards = self.shard_data()
+        assert_that(shards, HasLength(2))
+        for shard in shards.values():
+            # Each shard was written once, independently
+            assert_that(shard['data'], HasLength(1))
+            assert_that(shard['metadata']['version'], Equals(1))
+
+        live1 = self.vault.get_kv_data(self.store._live_path(name1))
+        assert_that(live1['data'], MatchesDict({
+            name1: EqualsLiveValue(1, BUNDLE1_FINGERPRINT,
+                                   BUNDLE1_DNS_NAMES, BUNDLE1_NOT_AFTER)
+        }))
+
+    def test_as_dict(self, bundle1, bundle2):
+        """
+        When the certificates are fetched as a dict, the certificates from all
+        the live mapping shards are returned.
+        """
+        names = ['bundle{}'.format(i) for i in range(10)]
+        for name in names:
+            d = self.store.store(name, bundle1)
+            assert_that(d, succeeded(IsInstance(dict)))
+        assert_that(self.shard_data(), Not(HasLength(1)))
+
+        assert_that(self.store.as_dict(), succeeded(
+            Equals(dict((n, bundle1) for n in names))))
+        assert_that(self.store.server_names(), succeeded(
+            After(sorted, Equals(sorted(names)))))
+
+    def test_migrate_live(self, bundle1, bundle2):
+        """
+        When the live mapping is migrated, the entries from the single-key
+        live mapping are copied into the shards, unless the shards already
+        have a newer version.
+        """
+        self.vault.set_kv_data(
+            'certificates/bundle1', certificate_value(bundle1))
+        self.vault.set_kv_data(
+            'certificates/bundle2', certificate_value(bundle2))
+        self.vault.set_kv_data(
+            'certificates/bundle2', certificate_value(bundle1))
+        self.vault.set_kv_data('live', {
+            'bundle1': live_value(1, BUNDLE1_FINGERPRINT, BUNDLE1_DNS_NAMES),
+            'bundle2': live_value(1, BUNDLE2_FINGERPRINT, BUNDLE2_DNS_NAMES),
+            'p16n.org': 'dummy_data',
+        })
+        # A newer version of bundle2 is already in the shards
+        self.vault.set_kv_data(self.store._live_path('bundle2'), {
+            'bundle2': live_value(2, BUNDLE1_FINGERPRINT, BUNDLE1_DNS_NAMES),
+        })
+
+        assert_that(self.store.migrate_live(), succeeded(Is(None)))
+        assert_that(self.store.as_dict(), succeeded(Equals({
+            'bundle1': bundle1, 'bundle2': bundle1})))
+
+        # Migrating again changes nothing
+        shards = self.shard_data()
+        assert_that(self.store.migrate_live(), succeeded(Is(None)))
+        assert_that(self.shard_data(), Equals(shards))
+
+        # The single-key live mapping is left as it was
+        assert_that(self.vault.get_kv_data('live')['data'], HasLength(3))
+
+    def test_migrate_live_not_sharded(self):
+        """
+        When the live mapping is migrated, and the live mapping is not
+        sharded, nothing is done.
+        """
+        self.vault.set_kv_data('live', {
+            'bundle1': live_value(1, BUNDLE1_FINGERPRINT, BUNDLE1_DNS_NAMES),
+        })
+        store = VaultKvCertificateStore(None, 'secret')
+        assert_that(store.migrate_live(), succeeded(Is(None)))
+        assert_that(self.shard_data(), Equals({}))
+
+
+class TestVaultKvFailureStore(object):
+    def setup_method(self):
+        self.vault = FakeVault()
+        self.vault_api = FakeVaultAPI(self.vault)
+        self.vault_client = VaultClient(
+            'http://localhost:8200', self.vault.token,
+            client=self.vault_api.client)
+
+        self.store = VaultKvFailureStore(self.vault_client, 'secret')
+
+    def test_load_not_exists(self):
+        """
+        When failures are loaded and none have been stored, no failures are
+        returned.
+        """
+        assert_that(self.store.load(), succeeded(Equals({})))
+
+    def test_update_load(self):
+        """
+        When failures are updated, they are stored as JSON values in Vault and
+        the same failures can be loaded again.
+        """
+        failures = {'example.com': {
+            'failures': 1, 'retry_at': 10.0, 'error': 'connection'}}
+
+        assert_that(self.store.update(failures), succeeded(Is(None)))
+        data = self.vault.get_kv_data('failures')['data']
+        assert_that(data, MatchesDict({
+            'example.com': After(json.loads, Equals(failures['example.com']))
+        }))
+
+        assert_that(self.store.load(), succeeded(Equals(failures)))
+
+    def test_update_merges(self):
+        """
+        When failures are updated, failures stored by other instances for
+        other domains are kept, and domains changed to None are removed.
+        """
+        a = {'failures': 1, 'retry_at': 10.0, 'error': 'connection'}
+        b = {'failures': 2, 'retry_at': 20.0, 'error': 'dns'}
+        self.vault.set_kv_data('failures', {
+            'a.com': json.dumps(a),
+            'b.com': json.dumps(b),
+        })
+
+        assert_that(self.store.update({'a.com': None, 'c.com': a}),
+                    succeeded(Is(None)))
+        assert_that(self.store.load(), succeeded(Equals({
+            'b.com': b,
+            'c.com': a,
+        })))
+
+    def test_update_cas_retry(self):
+        """
+        When failures are updated, and another instance updates them between
+        the read and the write, the update is retried after a jittered delay
+        and the other instance's changes are kept.
+        """
+        clock = Clock()
+        store = VaultKvFailureStore(
+            self.vault_client, 'secret', clock=clock, cas_backoff_base=1,
+            random=lambda: 0.5)
+
+        b = {'failures': 2, 'retry_at': 20.0, 'error': 'dns'}
+        writes = [0]
+
+        def pre_create_update():
+            if writes == [0]:
+                self.vault.set_kv_data('failures', {'b.com': json.dumps(b)})
+            writes[0] += 1
+        self.vault_api.set_pre_create_update(pre_create_update)
+
+        a = {'failures': 1, 'retry_at': 10.0, 'error': 'connection'}
+        d = store.update({'a.com': a})
+        assert_that(d, has_no_result())
+        assert_that(writes, Equals([1]))
+
+        clock.advance(0.5)
+        assert_that(d, succeeded(Is(None)))
+        assert_that(writes, Equals([2]))
+        assert_that(store.load(), succeeded(Equals({'a.com': a, 'b.com': b})))
@@ -1,5 +1,10 @@
 import binascii
+import calendar
+import hashlib
 import json
+import random
+import time
+from collections import OrderedDict
 
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
@@ -7,13 +12,16 @@ from cryptography.hazmat.primitives import hashes
 
 import pem
 
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, FirstError, gatherResults, succeed)
+from twisted.internet.task import deferLater
 from twisted.logger import Logger
 
 from txacme.interfaces import ICertificateStore
 
 from zope.interface import implementer
 
+from marathon_acme.acme_util import cert_not_after
 from marathon_acme.clients.vault import CasError
 
 
@@ -70,6 +78,9 @@ def _cert_data_to_pem_objects(cert_data):
     return pem_objects
 
 
+_NOT_AFTER_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
 def _live_value(cert_pem_object, version):
     # https://cryptography.io/en/stable/x509/reference/#cryptography.x509.load_pem_x509_certificate
     cert = x509.load_pem_x509_certificate(
@@ -87,24 +98,179 @@ def _live_value(cert_pem_object, version):
     return {
         'version': version,
         'fingerprint': fingerprint,
-        'dns_names': dns_names
+        'dns_names': dns_names,
+        'not_after': cert.not_valid_after.strftime(_NOT_AFTER_FORMAT),
     }
 
 
+def _live_not_after(live_value):
+    """
+    Get the certificate expiry time from a live mapping value, in seconds since
+    the epoch, or None if the value predates the ``not_after`` field or isn't
+    in the expected format.
+    """
+    try:
+        not_after = json.loads(live_value)['not_after']
+        return calendar.timegm(time.strptime(not_after, _NOT_AFTER_FORMAT))
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def _live_version(live_value):
+    """
+    Get the certificate version from a live mapping value, or None if the value
+    isn't in the expected format.
+    """
+    try:
+        return json.loads(live_value)['version']
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+class _CertificateCache(object):
+    """
+    A least-recently-used cache of parsed certificates keyed by server name and
+    certificate version. Only the latest cached version of each certificate is
+    kept.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, server_name, version):
+        if version is None:
+            return None
+
+        entry = self._entries.get(server_name)
+        if entry is None or entry[0] != version:
+            return None
+
+        # Move the entry to the end as the most recently used
+        del self._entries[server_name]
+        self._entries[server_name] = entry
+        return entry[1]
+
+    def put(self, server_name, version, pem_objects):
+        if self._max_size < 1:
+            return
+
+        existing = self._entries.pop(server_name, None)
+        if existing is not None and existing[0] > version:
+            # Never replace a newer version with an older one
+            self._entries[server_name] = existing
+            return
+
+        self._entries[server_name] = (version, pem_objects)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
+def _unwrap_first_error(failure):
+    failure.trap(FirstError)
+    return failure.value.subFailure
+
+
 @implementer(ICertificateStore)
 class VaultKvCertificateStore(object):
     """
     A ``txacme.interfaces.ICertificateStore`` implementation that stores
     certificates in a Vault key/value version 2 secret engine.
+
+    The live mapping of server names to the current version of their
+    certificates is either stored in a single ``live`` key, or sharded across
+    a fixed number of ``live-shards/<n>`` keys by a hash of the server name.
     """
 
     log = Logger()
 
-    def __init__(self, client, mount_path):
+    def __init__(self, client, mount_path, read_concurrency=16,
+                 reads_per_second=None, clock=None, cache_size=1000,
+                 cas_backoff_base=0.05, cas_backoff_max=2.0,
+                 random=random.random, live_shards=None):
+        """
+        :param client: The ``VaultClient`` to use.
+        :param mount_path: The mount path of the key/value secret engine.
+        :param read_concurrency:
+            The maximum number of certificates to read from Vault at once when
+            reading all the certificates.
+        :param reads_per_second:
+            If set, the maximum rate at which to start reading certificates
+            when reading all the certificates. Requires ``clock``.
+        :param clock:
+            The ``IReactorTime`` provider to use for pacing reads and backing
+            off after Check-And-Set mismatches. If None, reads can't be paced
+            and live mapping updates are retried immediately.
+        :param cache_size:
+            The maximum number of parsed certificates to cache in memory. A
+            cached certificate is used while the live mapping still points to
+            its version. Set to 0 to disable the cache.
+        :param cas_backoff_base:
+            The maximum amount of time in seconds to wait before retrying the
+            first time that the live mapping update has a Check-And-Set
+            mismatch. This doubles with each consecutive mismatch.
+        :param cas_backoff_max:
+            The maximum amount of time in seconds to wait before retrying an
+            update of the live mapping.
+        :param random:
+            A function returning a random float in [0, 1) for the jitter.
+        :param live_shards:
+            The number of keys to shard the live mapping across. If None, the
+            live mapping is stored in the single ``live`` key. Use
+            ``migrate_live()`` to copy an existing single-key live mapping
+            into the shards.
+        """
+        if read_concurrency < 1:
+            raise ValueError('read_concurrency must be at least 1')
+        if reads_per_second and clock is None:
+            raise ValueError('a clock is required to pace reads')
+
         self._client = client
         self._mount_path = mount_path
+        self._read_semaphore = DeferredSemaphore(read_concurrency)
+        self._reads_per_second = reads_per_second
+        self._clock = clock
+        self._next_read_at = 0
+        self._cache = _CertificateCache(cache_size)
+        self._cache_enabled = cache_size > 0
+
+        self._cas_backoff_base = cas_backoff_base
+        self._cas_backoff_max = cas_backoff_max
+        self._random = random
+
+        self._live_shards = live_shards
+        if live_shards:
+            self._live_paths = [
+                'live-shards/{}'.format(i) for i in range(live_shards)]
+        else:
+            self._live_paths = ['live']
+        # Live mapping updates waiting to be written for each live mapping
+        # key, and the keys with a write in progress
+        self._live_pending = {}
+        self._live_writing = set()
 
     def get(self, server_name):
+        if not self._cache_enabled:
+            return self._read_cert(server_name)
+
+        # Look up the current version in the live mapping so that we can use
+        # the cached certificate if it's still current
+        d = self._read_live_data_and_version(self._live_path(server_name))
+
+        def get_cached_or_read(live_data_and_version):
+            live, _ = live_data_and_version
+            version = _live_version(live.get(server_name))
+            pem_objects = self._cache.get(server_name, version)
+            if pem_objects is not None:
+                return pem_objects
+            return self._read_cert(server_name)
+
+        return d.addCallback(get_cached_or_read)
+
+    def _read_cert(self, server_name):
         d = self._client.read_kv2(
             'certificates/' + server_name, mount_path=self._mount_path)
 
@@ -113,12 +279,14 @@ class VaultKvCertificateStore(object):
                 raise KeyError(server_name)
             return response
 
-        def get_data(response):
-            return response['data']['data']
+        def parse_and_cache(response):
+            pem_objects = _cert_data_to_pem_objects(response['data']['data'])
+            version = response['data']['metadata']['version']
+            self._cache.put(server_name, version, pem_objects)
+            return pem_objects
 
         d.addCallback(handle_not_found)
-        d.addCallback(get_data)
-        d.addCallback(_cert_data_to_pem_objects)
+        d.addCallback(parse_and_cache)
         return d
 
     def store(self, server_name, pem_objects):
@@ -136,7 +304,14 @@ class VaultKvCertificateStore(object):
                 2.2.1 If so, assume somebody else updated the live map. Finish.
                 2.2.2 If not, continue.
         3. Update the live map and write it with ``cas=v_live``.
-            3.1 If the CAS fails, go back to step 2.
+            3.1 If the CAS fails, wait a jittered, increasing amount of time
+                and go back to step 2.
+
+        Steps 2 and 3 are group-committed: while the live map is being
+        written, updates from concurrent calls are queued, and are then all
+        written together by the next write. Each call's Deferred fires once
+        its update is in the live map. If the live map is sharded, this
+        happens independently for each shard.
         """
         # First store the certificate
         key, cert, ca_certs = sort_pem_objects(pem_objects)
@@ -150,6 +325,7 @@ class VaultKvCertificateStore(object):
 
         def live_value(cert_response):
             cert_version = cert_response['data']['version']
+            self._cache.put(server_name, cert_version, pem_objects)
             return _live_value(cert, cert_version)
 
         d.addCallback(live_value)
@@ -157,20 +333,65 @@ class VaultKvCertificateStore(object):
         # Then update the live mapping
         return d.addCallback(self._update_live, server_name)
 
-    def _update_live(self, new_live_value, server_name):
-        d = self._read_live_data_and_version()
+    def _live_path(self, server_name):
+        """
+        Get the path of the live mapping key for a server name.
+        """
+        if not self._live_shards:
+            return 'live'
 
-        # When we fail to update the live mapping due to a Check-And-Set
-        # mismatch, try again from scratch
-        def retry_on_cas_error(failure):
-            failure.trap(CasError)
-            self.log.warn('Check-And-Set mismatch while updating live '
-                          'mapping. Retrying...')
-            return self._update_live(new_live_value, server_name)
+        # Use a stable hash rather than hash() which varies between processes
+        digest = hashlib.sha256(server_name.encode('utf-8')).hexdigest()
+        return self._live_paths[int(digest, 16) % self._live_shards]
 
-        def update(live_data_and_version):
-            live, version = live_data_and_version
+    def _update_live(self, new_live_value, server_name):
+        path = self._live_path(server_name)
+        pending = self._live_pending.setdefault(path, {})
 
+        d = Deferred()
+        if server_name not in pending:
+            pending[server_name] = (new_live_value, [d])
+        else:
+            # Only the newest version of a certificate needs to be written
+            pending_live_value, waiting = pending[server_name]
+            if pending_live_value['version'] < new_live_value['version']:
+                pending_live_value = new_live_value
+            waiting.append(d)
+            pending[server_name] = (pending_live_value, waiting)
+
+        if path not in self._live_writing:
+            self._write_live(path)
+        return d
+
+    def _write_live(self, path, batch=None, attempt=0):
+        """
+        Write all the pending updates for a live mapping key in a single
+        Check-And-Set write of the key.
+        """
+        self._live_writing.add(path)
+
+        # Merge in anything queued since the last attempt
+        batch = {} if batch is None else batch
+        pending = self._live_pending.pop(path, {})
+        for server_name, (live_value, waiting) in pending.items():
+            if server_name in batch:
+                batch_live_value, batch_waiting = batch[server_name]
+                if batch_live_value['version'] > live_value['version']:
+                    live_value = batch_live_value
+                waiting = batch_waiting + waiting
+            batch[server_name] = (live_value, waiting)
+
+        d = self._read_live_data_and_version(path)
+        d.addCallback(self._merge_live, path, batch)
+        d.addCallbacks(
+            self._live_written, self._live_write_failed,
+            callbackArgs=(path, batch), errbackArgs=(path, batch, attempt))
+
+    def _merge_live(self, live_data_and_version, path, batch):
+        live, version = live_data_and_version
+
+        updated = set()
+        for server_name, (new_live_value, _) in batch.items():
             # Get the existing version of the cert in the live mapping
             existing_live_value = live.get(server_name)
             if existing_live_value is not None:
@@ -183,7 +404,8 @@ class VaultKvCertificateStore(object):
                 existing_cert_version = 0
 
             # If the existing cert version is lower than what we want to update
-            # it to, then try update it
+            # it to, then try update it. Else assume somebody else updated the
+            # live mapping.
             new_cert_version = new_live_value['version']
             if existing_cert_version < new_cert_version:
                 self.log.debug(
@@ -191,24 +413,57 @@ class VaultKvCertificateStore(object):
                     'from version {v1} to {v2}', server_name=server_name,
                     v1=existing_cert_version, v2=new_cert_version)
                 live[server_name] = json.dumps(new_live_value)
+                updated.add(server_name)
+
+        if not updated:
+            return None, updated
 
-                d = self._client.create_or_update_kv2(
-                    'live', live, cas=version, mount_path=self._mount_path)
-                d.addErrback(retry_on_cas_error)
-                return d
+        d = self._client.create_or_update_kv2(
+            path, live, cas=version, mount_path=self._mount_path)
+        return d.addCallback(lambda response: (response, updated))
+
+    def _live_written(self, response_and_updated, path, batch):
+        response, updated = response_and_updated
+        self._live_write_done(path)
+
+        for server_name, (_, waiting) in batch.items():
+            # Callers whose update was skipped get nothing, as before
+            result = response if server_name in updated else None
+            for d in waiting:
+                d.callback(result)
+
+    def _live_write_failed(self, failure, path, batch, attempt):
+        # When we fail to update the live mapping due to a Check-And-Set
+        # mismatch, try again from scratch after backing off a bit
+        if failure.check(CasError):
+            delay = self._cas_backoff_delay(attempt)
+            self.log.warn('Check-And-Set mismatch while updating live '
+                          'mapping. Retrying in {delay:.3f}s...', delay=delay)
+            if self._clock is None or delay <= 0:
+                self._write_live(path, batch, attempt + 1)
             else:
-                # Else assume somebody else updated the live mapping and stop
-                self.log.warn(
-                    'Existing certificate version ({v1}) >= version we are '
-                    'trying to store ({v2}). Not updating...',
-                    v1=existing_cert_version, v2=new_cert_version)
-                return
+                self._clock.callLater(
+                    delay, self._write_live, path, batch, attempt + 1)
+            return
 
-        d.addCallback(update)
-        return d
+        self._live_write_done(path)
+        for _, waiting in batch.values():
+            for d in waiting:
+                d.errback(failure)
+
+    def _live_write_done(self, path):
+        self._live_writing.discard(path)
+        if self._live_pending.get(path):
+            self._write_live(path)
 
-    def _read_live_data_and_version(self):
-        d = self._client.read_kv2('live', mount_path=self._mount_path)
+    def _cas_backoff_delay(self, attempt):
+        # "Full jitter" exponential backoff
+        max_delay = min(
+            self._cas_backoff_max, self._cas_backoff_base * 2 ** attempt)
+        return self._random() * max_delay
+
+    def _read_live_data_and_version(self, path='live'):
+        d = self._client.read_kv2(path, mount_path=self._mount_path)
 
         def get_data_and_version(response):
             if response is not None:
@@ -218,38 +473,242 @@ class VaultKvCertificateStore(object):
                 data = {}
                 version = 0
 
-            self.log.debug('Read live mapping version {v} with {len_live} '
-                           'entries.', v=version, len_live=len(data))
+            self.log.debug('Read live mapping {path} version {v} with '
+                           '{len_live} entries.', path=path, v=version,
+                           len_live=len(data))
 
             return data, version
 
         return d.addCallback(get_data_and_version)
 
+    def _read_all_live(self):
+        """
+        Read the whole live mapping, from all the shards if it is sharded.
+        """
+        ds = [self._read_live_data_and_version(path)
+              for path in self._live_paths]
+
+        def merge(live_data_and_versions):
+            live = {}
+            for data, _ in live_data_and_versions:
+                live.update(data)
+            return live
+
+        d = gatherResults(ds, consumeErrors=True)
+        d.addCallbacks(merge, _unwrap_first_error)
+        return d
+
+    def migrate_live(self):
+        """
+        Copy the entries from a single-key live mapping into the live mapping
+        shards, if the live mapping is sharded. Entries are only copied if
+        they are newer than what is already in the shards, so this is safe to
+        run every time the store is started. The single ``live`` key is left
+        as it is.
+
+        :return: A Deferred that fires when the entries have been copied.
+        """
+        if not self._live_shards:
+            return succeed(None)
+
+        d = self._read_live_data_and_version('live')
+
+        def copy_entries(live_data_and_version):
+            live, _ = live_data_and_version
+            ds = []
+            for server_name, value in live.items():
+                if _live_version(value) is None:
+                    self.log.warn(
+                        "Not migrating live mapping entry for '{server_name}' "
+                        'with unexpected value: {value!r}',
+                        server_name=server_name, value=value)
+                    continue
+                ds.append(self._update_live(json.loads(value), server_name))
+
+            self.log.info('Migrating {count} live mapping entries to '
+                          '{shards} shards...', count=len(ds),
+                          shards=self._live_shards)
+            d = gatherResults(ds, consumeErrors=True)
+            d.addCallbacks(lambda _: None, _unwrap_first_error)
+            return d
+
+        return d.addCallback(copy_entries)
+
     def as_dict(self):
-        d = self._read_live_data_and_version()
+        d = self._read_all_live()
         d.addCallback(self._read_all_certs)
         return d
 
-    def _read_all_certs(self, live_data_and_version):
-        live, _ = live_data_and_version
-        certs = {}
+    def server_names(self):
+        """
+        Get the names of the stored certificates from the live mapping alone,
+        without reading the certificates.
+        """
+        d = self._read_all_live()
+        return d.addCallback(lambda live: list(live.keys()))
 
-        def read_cert(_result, name):
-            self.log.debug("Reading certificate '{name}'...", name=name)
-            return self.get(name)
+    def expiries(self):
+        """
+        Get the expiry times of the stored certificates from the live
+        mapping. Certificates are only read for entries written before the
+        live mapping recorded expiry times.
+        """
+        d = self._read_all_live()
+
+        def get_expiries(live):
+            expiries = {}
+            missing = {}
+            for name, value in live.items():
+                not_after = _live_not_after(value)
+                if not_after is not None:
+                    expiries[name] = not_after
+                else:
+                    missing[name] = value
+
+            if not missing:
+                return expiries
+
+            d = self._read_all_certs(missing)
+
+            def add_expiries(certs):
+                for name, pem_objects in certs.items():
+                    expiries[name] = cert_not_after(pem_objects)
+                return expiries
+            return d.addCallback(add_expiries)
+
+        return d.addCallback(get_expiries)
+
+    def _read_all_certs(self, live):
+        certs = {}
 
         def collect_cert(pem_objects, name):
             certs[name] = pem_objects
 
-        # Chain some deferreds to execute in series so we don't DoS Vault
-        d = Deferred()
+        # Take what we can from the cache before reading anything, so that
+        # reads don't evict cached certificates that we're about to use
+        uncached = []
         for name, value in live.items():
-            d.addCallback(read_cert, name)
+            pem_objects = self._cache.get(name, _live_version(value))
+            if pem_objects is not None:
+                certs[name] = pem_objects
+            else:
+                uncached.append(name)
+
+        # Read the rest in parallel, but with a bounded number of reads in
+        # flight (and optionally a bounded rate) so we don't DoS Vault
+        ds = []
+        for name in uncached:
             # TODO: Try update live mapping on version mismatchs
             # TODO: Warn on certificate fingerprint, or dns_names mismatch
+            d = self._read_semaphore.run(self._paced_read, name)
             d.addCallback(collect_cert, name)
+            ds.append(d)
+
+        d = gatherResults(ds, consumeErrors=True)
+        d.addCallbacks(lambda _result: certs, _unwrap_first_error)
+        return d
+
+    def _paced_read(self, name):
+        delay = 0
+        if self._reads_per_second:
+            now = self._clock.seconds()
+            start = max(now, self._next_read_at)
+            self._next_read_at = start + 1.0 / self._reads_per_second
+            delay = start - now
+
+        def read_cert():
+            self.log.debug("Reading certificate '{name}'...", name=name)
+            return self._read_cert(name)
 
-        d.addCallback(lambda _result: certs)
-        # First deferred does nothing. Callback it to get the chain going.
-        d.callback(None)
+        if delay > 0:
+            return deferLater(self._clock, delay, read_cert)
+        return read_cert()
+
+
+class VaultKvFailureStore(object):
+    """
+    Persists domain failure state for ``FailureBackoff`` in a Vault key/value
+    version 2 secret engine, alongside the certificates.
+
+    Other instances may update the failure state at the same time, so changes
+    are merged into the stored state with a Check-And-Set write.
+    """
+
+    log = Logger()
+
+    def __init__(self, client, mount_path, clock=None, cas_backoff_base=0.05,
+                 cas_backoff_max=2.0, random=random.random):
+        """
+        :param client: The ``VaultClient`` to use.
+        :param mount_path: The mount path of the key/value secret engine.
+        :param clock:
+            The ``IReactorTime`` provider to use for backing off after
+            Check-And-Set mismatches. If None, updates are retried
+            immediately.
+        :param cas_backoff_base:
+            The maximum amount of time in seconds to wait before retrying the
+            first time that an update has a Check-And-Set mismatch. This
+            doubles with each consecutive mismatch.
+        :param cas_backoff_max:
+            The maximum amount of time in seconds to wait before retrying an
+            update.
+        :param random:
+            A function returning a random float in [0, 1) for the jitter.
+        """
+        self._client = client
+        self._mount_path = mount_path
+        self._clock = clock
+        self._cas_backoff_base = cas_backoff_base
+        self._cas_backoff_max = cas_backoff_max
+        self._random = random
+
+    def _read(self):
+        d = self._client.read_kv2('failures', mount_path=self._mount_path)
+
+        def get_data_and_version(response):
+            if response is None:
+                return {}, 0
+            return (response['data']['data'],
+                    response['data']['metadata']['version'])
+
+        return d.addCallback(get_data_and_version)
+
+    def load(self):
+        def get_failures(data_and_version):
+            data, _ = data_and_version
+            return dict((k, json.loads(v)) for k, v in data.items())
+
+        return self._read().addCallback(get_failures)
+
+    def update(self, changes, attempt=0):
+        d = self._read()
+
+        def merge(data_and_version):
+            data, version = data_and_version
+            for domain, failure in changes.items():
+                if failure is None:
+                    data.pop(domain, None)
+                else:
+                    # Store the values as JSON strings, as with the live
+                    # mapping
+                    data[domain] = json.dumps(failure)
+            return self._client.create_or_update_kv2(
+                'failures', data, cas=version, mount_path=self._mount_path)
+
+        def retry(failure):
+            # Somebody else updated the failures between our read and write,
+            # so try again from scratch after backing off a bit
+            failure.trap(CasError)
+            max_delay = min(
+                self._cas_backoff_max, self._cas_backoff_base * 2 ** attempt)
+            delay = self._random() * max_delay
+            self.log.warn('Check-And-Set mismatch while updating issuance '
+                          'failures. Retrying in {delay:.3f}s...', delay=delay)
+            if self._clock is None or delay <= 0:
+                return self.update(changes, attempt + 1)
+            return deferLater(
+                self._clock, delay, self.update, changes, attempt + 1)
+
+        d.addCallback(merge)
+        d.addCallbacks(lambda _: None, retry)
         return d
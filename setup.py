@@ -28,6 +28,8 @@ install_requires = [
     'josepy',
     'klein',
     'pem >= 16.1.0',
+    'prometheus_client',
+    'publicsuffix2',
     'requests',
     # treq.testing broken on older versions of treq with Twisted 17.1.0
     'treq >= 17.3.1',